@@ -1,5 +1,6 @@
 from . import models
 from . import controllers
+from . import wizards
 
 from odoo.addons.payment import setup_provider, reset_payment_provider
 
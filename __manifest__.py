@@ -7,11 +7,17 @@
     'description': """
         KamiPay payment provider to handle PIX payments in BRL and convert to USDT.
     """,
-    'depends': ['payment'],
+    'depends': ['bus', 'payment'],
     'data': [
+        'security/ir.model.access.csv',
+        'security/payment_kamipay_security.xml',
         'views/payment_kamipay_templates.xml',
+        'views/payment_kamipay_settlement_views.xml',
+        'wizards/payment_kamipay_charge_wizard_views.xml',
+        'wizards/payment_kamipay_reconciliation_wizard_views.xml',
         'views/payment_provider_views.xml',
         'data/payment_provider_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'assets': {
         'web.assets_frontend': [
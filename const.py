@@ -0,0 +1,150 @@
+# Base URLs of the KamiPay API, by provider state
+API_URLS = {
+    'enabled': 'https://api2.kamipay.io',
+    'test': 'https://devnakamotoapi2.kamipay.io',
+}
+
+# Timeout (in seconds) of the requests made to the KamiPay API, unless the endpoint has its own
+# budget: status checks are cheap and must fail fast, charge creation may take longer. A budget
+# bounds the whole call, the requests to these endpoints are therefore never retried
+DEFAULT_TIMEOUT = 10
+ENDPOINT_TIMEOUTS = {
+    '/v2/status/tx_status': 3,
+    '/v2/charge/create_dynamic_pix_b2b': 15,
+}
+
+# Circuit breaker of the KamiPay API: consecutive failures opening the circuit, and seconds before
+# a single probe request is let through to check whether the API recovered
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_INTERVAL = 30
+
+# Default settings of the pooled HTTP sessions used to reach the KamiPay API
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEPALIVE = 60  # Seconds a session may stay idle before being recycled
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.3
+
+# HTTP statuses for which idempotent requests are retried
+RETRY_STATUSES = (502, 503, 504)
+
+# Access tokens are assumed valid for 1 hour unless KamiPay states otherwise, and refreshed
+# 5 minutes before they expire
+DEFAULT_TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = 300
+
+# Namespace of the PostgreSQL advisory lock serializing token refreshes across workers
+TOKEN_REFRESH_LOCK_ID = 0x4B504159  # 'KPAY'
+
+# Validity of the PIX charges, in seconds, and minimum validity left for a charge to be reused by
+# another payment attempt
+CHARGE_EXPIRY = 600
+CHARGE_REUSE_MIN_VALIDITY = 180
+
+# Lifetime, in hours, of the charges created ahead of their payment links, e.g. for a billing
+# campaign: by default and at most
+CAMPAIGN_CHARGE_LIFETIME = 72
+CAMPAIGN_CHARGE_MAX_LIFETIME = 720
+
+# Charges that expired within this window, in seconds, may have been paid right before their expiry
+# and are verified with KamiPay before being canceled
+CHARGE_SETTLEMENT_WINDOW = 3600
+
+# Age, in hours, of the transactions whose status is polled by the reconciliation cron; the expired
+# charges of older transactions were not necessarily polled and are verified before being canceled
+RECONCILE_MAX_AGE_HOURS = 24
+
+# Queued charge creation: charges created per cron run, and attempts before giving up
+CHARGE_QUEUE_BATCH_SIZE = 50
+CHARGE_MAX_ATTEMPTS = 3
+
+# Maximum number of concurrent requests sent by batch operations (bounded by the pool size)
+DEFAULT_MAX_WORKERS = 8
+
+# Statuses of KamiPay charges, and those after which a charge no longer changes
+STATUS_HANDLED = ('processing', 'done', 'expired', 'failed')
+STATUS_FINAL = ('done', 'expired', 'failed')
+
+# States of the transactions whose charge reached a final status
+STATUS_TX_STATES = {
+    'done': 'done',
+    'expired': 'cancel',
+    'failed': 'error',
+}
+
+# Progression of the statuses of a charge: a notification whose status does not progress from the
+# last processed one is a retry or arrived out of order, and is dropped
+STATUS_RANK = {
+    'processing': 1,
+    'expired': 2,
+    'failed': 2,
+    'done': 3,
+}
+
+# QR code images: side length in pixels, number of images cached per worker and browser cache
+# duration, matching the 10 minutes validity of the charges
+QR_SIZE = 300
+QR_CACHE_SIZE = 512
+QR_CACHE_MAX_AGE = 600
+QR_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# Logging: payload keys whose values are never logged, and the system parameter holding the share
+# of operations whose full payload is logged at INFO level
+SENSITIVE_KEYS = {
+    'access_token', 'authorization', 'password', 'username', 'api_key', 'api_secret',
+    'signature', 'x-kamipay-auth', 'bank_account_nr', 'name',
+}
+LOG_SAMPLE_RATE_PARAM = 'payment_kamipay.log_payload_sample_rate'
+
+# Number of days webhook deliveries are remembered to detect their retries
+WEBHOOK_EVENT_RETENTION_DAYS = 7
+
+# Deferred webhook processing: attempts before giving up, and base delay (in seconds) between
+# attempts, doubled after each failure
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BACKOFF = 30
+
+# Number of orders confirmed in a single call by the batched post-processing
+ORDER_CHUNK_SIZE = 50
+
+# Seconds during which a worker reuses the webhook signature keys it loaded; changes made in
+# another worker are picked up after this delay at the latest
+SIGNATURE_KEYS_TTL = 300
+
+# Seconds during which a BRL/USDT quote is served from memory before being reloaded, and age in
+# seconds after which the quote of the latest charge is too old to estimate a payment
+QUOTE_TTL = 60
+QUOTE_MAX_AGE = 3600
+
+# Lines sharing the settlement totals of a day, provider and company, see
+# `payment.kamipay.settlement`
+SETTLEMENT_STRIPES = 8
+SETTLEMENT_EXPORT_BATCH_SIZE = 1000  # Rows fetched at once when exporting the summary
+
+# Statement rows matched and applied together by the reconciliation import
+RECONCILIATION_BATCH_SIZE = 2000
+
+# Seconds during which a fetched charge status is shared by the status checks of the worker; final
+# statuses never change and are kept until evicted
+STATUS_CACHE_TTL = 5
+STATUS_CACHE_SIZE = 4096
+
+# Seconds during which a worker serves the state of a transaction to the polling payment pages from
+# memory; the worker committing a state change drops its entry at once, the others within the delay
+POLL_STATE_TTL = 3
+POLL_STATE_CACHE_SIZE = 8192
+
+# Token buckets limiting the public routes, as (tokens added per second, capacity): per client IP,
+# per transaction, and per transaction for the status checks sent to KamiPay
+RATE_LIMITS = {
+    'ip': (5.0, 60),
+    'tx': (1.0, 10),
+    'tx_status': (0.1, 3),
+}
+# System parameter overriding the limit of a scope, as "rate,capacity", e.g. for load tests
+RATE_LIMIT_PARAM = 'payment_kamipay.rate_limit.%s'
+RATE_LIMIT_CACHE_SIZE = 10000  # Buckets kept by each worker with the local backend
+RATE_LIMIT_RETENTION = 3600  # Seconds after which the idle shared buckets are removed
+RATE_LIMIT_BACKEND_PARAM = 'payment_kamipay.rate_limit_backend'  # 'local' (default) or 'db'
@@ -1,17 +1,24 @@
 # controllers/main.py
+import csv
+import hashlib
+import io
+import json
 import logging
-import pprint
-from datetime import datetime
+import re
+from datetime import date, datetime
 import pytz
 import werkzeug
 import requests
-import hmac
-import hashlib
-import json
+
+from markupsafe import Markup
 
 from odoo import http, _
 from odoo.exceptions import ValidationError
-from odoo.http import request
+from odoo.http import content_disposition, request
+from odoo.tools import consteq
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_kamipay import const, metrics, utils
 
 _logger = logging.getLogger(__name__)
 
@@ -21,126 +28,223 @@ class KamiPayController(http.Controller):
     _webhook_url = '/payment/kamipay/webhook'
     _simulate_webhook_url = '/payment/kamipay/test/simulate_webhook'
     _qr_url = '/payment/kamipay/qr'
+    _metrics_url = '/payment/kamipay/metrics'
+    _quote_url = '/payment/kamipay/quote'
+    _prepare_url = '/payment/kamipay/prepare'
+    _poll_url = '/payment/kamipay/poll'
+    _settlement_export_url = '/payment/kamipay/settlements/export'
 
-    @http.route(_webhook_url, type='json', auth='public', csrf=False)
-    def kamipay_webhook(self, **data):
-        """ Process KamiPay webhook notifications."""
-        timestamp = datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S.%f%z')
-        
-        _logger.info("--- KamiPay Webhook Received at %s ---", timestamp)
-        
-        try:
-            webhook_data = request.get_json_data()
-            _logger.info("Webhook Data:\n%s", pprint.pformat(webhook_data))
-            
-            # Verify signature
-            signature = request.httprequest.headers.get('X-Kamipay-Auth')
-            if not signature:
-                _logger.error("No signature provided in webhook")
-                return {'status': 'error', 'message': 'Missing signature'}, 403
-                
-            calculated_signature = self._verify_webhook_signature(webhook_data)
-            if not calculated_signature:
-                _logger.error("Could not calculate signature - invalid payload or missing provider")
-                return {'status': 'error', 'message': 'Invalid payload'}, 403
-                
-            if signature != calculated_signature and not self._is_test_mode(webhook_data):
-                _logger.error("Invalid signature in webhook")
-                return {'status': 'error', 'message': 'Invalid signature'}, 403
-            
-            # Extract data from params if it's in JSON-RPC format
-            if webhook_data.get('jsonrpc') == '2.0' and webhook_data.get('params'):
-                webhook_data = webhook_data['params']
-                
-            # Process the webhook data and update transaction status
-            tx_sudo = request.env['payment.transaction'].sudo()._handle_notification_data(
-                'kamipay', webhook_data
-            )
-            _logger.info(
-                "Successfully processed KamiPay webhook for transaction ref %s (ID %s)",
-                tx_sudo.reference, tx_sudo.id
-            )
-            return {'status': 'ok'}
-            
-        except Exception as e:
-            _logger.exception("Error processing webhook: %s", str(e))
-            return {'status': 'error', 'message': str(e)}, 500
+    @http.route(
+        [_webhook_url, _webhook_url + '/<int:provider_id>'], type='json', auth='public', csrf=False
+    )
+    def kamipay_webhook(self, provider_id=None, **data):
+        """ Process KamiPay webhook notifications.
+
+        Webhooks sent to the URL of a provider are only checked against the key of that provider;
+        those sent to the shared URL are checked against the keys of all the providers.
+
+        :param int provider_id: The provider whose webhook URL was called, if any
+        """
+        with utils.log_operation(_logger, 'webhook') as log_fields, metrics.track(
+            'kamipay_webhook_stage_duration_seconds', stage='total'
+        ):
+            try:
+                # Verify signature over the raw body, before parsing it or querying the database
+                signature = request.httprequest.headers.get('X-Kamipay-Auth')
+                if not signature:
+                    log_fields['error'] = 'missing_signature'
+                    return {'status': 'error', 'message': 'Missing signature'}, 403
+
+                with metrics.track('kamipay_webhook_stage_duration_seconds', stage='signature'):
+                    signature_keys = request.env['payment.provider']._kamipay_get_signature_keys()
+                    if provider_id:
+                        signature_keys = [keys for keys in signature_keys if keys[0] == provider_id]
+                    provider_id = self._verify_webhook_signature(
+                        request.httprequest.get_data(), signature, signature_keys
+                    )
+                log_fields['provider_id'] = provider_id
+                # Invalid signatures are only tolerated for test transactions
+                may_be_test = any(is_test for _provider_id, _key, is_test in signature_keys)
+                if not provider_id and not may_be_test:
+                    log_fields['error'] = 'invalid_signature'
+                    return {'status': 'error', 'message': 'Invalid signature'}, 403
+
+                with metrics.track('kamipay_webhook_stage_duration_seconds', stage='parse'):
+                    webhook_data = request.get_json_data()
+                utils.log_payload(
+                    _logger, 'webhook', webhook_data,
+                    sample_rate=utils.get_payload_sample_rate(request.env),
+                )
+
+                # Extract data from params if it's in JSON-RPC format
+                notification_data = webhook_data
+                if webhook_data.get('jsonrpc') == '2.0' and webhook_data.get('params'):
+                    notification_data = webhook_data['params']
+                log_fields['pix_id'] = notification_data.get('pix_id')
+                log_fields['status'] = notification_data.get('status')
+
+                # Resolve the transaction once and reuse it for every step below
+                with metrics.track('kamipay_webhook_stage_duration_seconds', stage='lookup'):
+                    tx_sudo = request.env['payment.transaction'].sudo()._kamipay_get_tx_from_operation_id(
+                        notification_data.get('pix_id')
+                    )
+                if not tx_sudo:
+                    log_fields['error'] = 'invalid_payload'
+                    return {'status': 'error', 'message': 'Invalid payload'}, 403
+
+                if provider_id != tx_sudo.provider_id.id and not self._is_test_mode(tx_sudo):
+                    # Not signed, or signed with the key of another provider
+                    log_fields['error'] = 'invalid_signature'
+                    return {'status': 'error', 'message': 'Invalid signature'}, 403
+
+                # Acknowledge retried and out-of-order deliveries without touching the transaction
+                event_sudo = request.env['payment.kamipay.webhook.event'].sudo()
+                event_key = event_sudo._get_event_key(notification_data)
+                if tx_sudo.provider_id.kamipay_async_webhook:
+                    # Only queue the delivery, the inbox is processed in the background
+                    with metrics.track('kamipay_webhook_stage_duration_seconds', stage='enqueue'):
+                        is_new_event = event_sudo._enqueue(event_key, notification_data, tx_sudo)
+                    log_fields['result'] = 'queued' if is_new_event else 'duplicate'
+                    return {'status': 'ok'}
+
+                with metrics.track('kamipay_webhook_stage_duration_seconds', stage='dedup'):
+                    is_new_event = event_sudo._register(event_key, notification_data, tx_sudo)
+                if not is_new_event:
+                    log_fields['result'] = 'duplicate'
+                    return {'status': 'ok'}
+                if tx_sudo._kamipay_is_status_regression(notification_data.get('status')):
+                    log_fields['result'] = 'stale'
+                    return {'status': 'ok'}
 
-    def _is_test_mode(self, webhook_data):
+                # Process the webhook data and update transaction status
+                try:
+                    with metrics.track(
+                        'kamipay_webhook_stage_duration_seconds', stage='process'
+                    ), request.env.cr.savepoint():
+                        tx_sudo = tx_sudo._handle_notification_data('kamipay', notification_data)
+                except Exception:
+                    event_sudo._forget(event_key)  # Let the retries of the delivery be processed
+                    raise
+                log_fields['reference'] = tx_sudo.reference
+                return {'status': 'ok'}
+
+            except Exception as e:
+                _logger.exception("Error processing webhook: %s", str(e))
+                log_fields['error'] = type(e).__name__
+                return {'status': 'error', 'message': str(e)}, 500
+
+            finally:
+                metrics.inc('kamipay_webhook_total', outcome=log_fields.get('error', 'ok'))
+
+    def _is_test_mode(self, tx_sudo):
         """Check if the webhook is for a test transaction."""
-        try:
-            operation_id = webhook_data.get('pix_id')
-            if operation_id:
-                tx = request.env['payment.transaction'].sudo().search([
-                    ('kamipay_operation_id', '=', operation_id)
-                ], limit=1)
-                return tx.provider_id.state == 'test'
-        except Exception:
-            pass
-        return False
+        return bool(tx_sudo) and tx_sudo.provider_id.state == 'test'
     
-    def _verify_webhook_signature(self, payload):
-        """Verify the webhook signature using the provider's signature key."""
-        # First, get the operation ID from the payload
-        operation_id = payload.get('pix_id')
-        if not operation_id:
-            _logger.error("Cannot verify signature: missing operation_id in payload")
-            return False
-            
-        # Find the corresponding transaction and provider
-        tx = request.env['payment.transaction'].sudo().search([
-            ('kamipay_operation_id', '=', operation_id)
-        ], limit=1)
-        
-        if not tx or not tx.provider_id or not tx.provider_id.kamipay_signature_key:
-            _logger.error("Cannot verify signature: transaction not found or missing provider signature key")
-            return False
-            
-        # Get the signature key from the provider
-        signature_key = tx.provider_id.kamipay_signature_key
-        
-        # Directly encode the JSON string to match the sample implementation
-        payload_string = json.dumps(
-            payload, 
-            sort_keys=False,
-            ensure_ascii=False,
-            separators=(',', ':')
-        ).encode('utf-8')
-        
-        calculated_signature = hmac.new(
-            signature_key.encode('utf-8'),
-            payload_string,
-            hashlib.sha256
-        ).hexdigest()
-        
-        return calculated_signature
+    def _verify_webhook_signature(self, raw_body, signature, signature_keys):
+        """Verify the webhook signature using the providers' signature keys.
+
+        :param bytes raw_body: The raw body of the webhook request
+        :param str signature: The signature sent in the `X-Kamipay-Auth` header
+        :param list signature_keys: The cached signature keys of the providers
+        :return: The id of the provider whose key matches the signature, or None
+        :rtype: int
+        """
+        return utils.find_signing_key(signature_keys, raw_body, signature)
+
+    def _check_rate_limit(self, scope, key):
+        """ Reject the request if the rate limit of the key is exceeded, see `utils.get_rate_limit`.
+
+        :param str scope: The scope of the limit
+        :param key: The client or resource limited within the scope
+        :return: None
+        :raise TooManyRequests: If the limit is exceeded
+        """
+        if not utils.check_rate_limit(request.env, scope, key):
+            raise werkzeug.exceptions.TooManyRequests()
+
+    def _check_public_access(self, tx_id, access_token, scope='tx'):
+        """ Reject the requests of a public route that are not entitled to the transaction.
+
+        The checks run before the transaction is read: the client's rate limit first, then the
+        access token, and the limit of the transaction last so that requests with an invalid
+        token cannot exhaust it.
+
+        :param int tx_id: The transaction id
+        :param str access_token: The access token of the transaction
+        :param str scope: The scope of the per-transaction limit
+        :return: None
+        :raise TooManyRequests: If a rate limit is exceeded
+        :raise Forbidden: If the access token is invalid
+        """
+        self._check_rate_limit('ip', request.httprequest.remote_addr)
+        if not access_token or not payment_utils.check_access_token(access_token, tx_id):
+            raise werkzeug.exceptions.Forbidden()
+        self._check_rate_limit(scope, tx_id)
         
     @http.route(_qr_url + '/<int:tx_id>', type='http', auth='public', website=True)
-    def kamipay_qr_display(self, tx_id=None, **kwargs):
+    def kamipay_qr_display(self, tx_id=None, access_token=None, **kwargs):
         """ Display the QR code payment page """
-        _logger.info("KamiPay QR display request for tx_id: %s", tx_id)
-        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id)
+        self._check_public_access(tx_id, access_token)
+        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id).exists()
         if not tx_sudo or tx_sudo.provider_code != 'kamipay':
             _logger.error("Transaction not found or invalid provider: %s", tx_id)
             raise werkzeug.exceptions.NotFound()
             
-        # Create KamiPay payment if not already done
-        if not tx_sudo.kamipay_operation_id:
-            tx_sudo._create_kamipay_payment()
+        # Create KamiPay payment, or queue its creation, if not already done
+        tx_sudo._kamipay_ensure_charge()
 
         values = {
             'tx': tx_sudo,
             'qr_code': tx_sudo.kamipay_emv,  # Use EMV code from transaction
             #'qr_code': f"http://{tx_sudo.kamipay_emv}",  # Add ´http://´ to EMV code
+            'qr_svg': tx_sudo.provider_id.kamipay_qr_inline_svg and tx_sudo.kamipay_emv and Markup(
+                utils.get_qr_inline_svg(tx_sudo.kamipay_emv)
+            ),
+            'bus_channel': tx_sudo._kamipay_get_bus_channel(),
+            'access_token': access_token,
+            'expires_in': tx_sudo._kamipay_get_charge_expires_in(),
             'title': _('PIX QR Code for Payment'),
         }
-        _logger.info("Rendering QR page for transaction %s", tx_sudo.reference)
         return request.render('payment_kamipay.qr_display_page', values)
 
+    @http.route(
+        _qr_url + '/<int:tx_id>/image', type='http', auth='public', methods=['GET'],
+        save_session=False,
+    )
+    def kamipay_qr_image(self, tx_id, access_token=None, image_format='png', **kwargs):
+        """ Serve the QR code image of the transaction's charge.
+
+        The image only depends on the EMV payload, so it is generated once and cached, and can be
+        revalidated by browsers with its ETag without being sent again.
+
+        :param int tx_id: The transaction id
+        :param str access_token: The access token of the transaction
+        :param str image_format: The format of the image, 'png' or 'svg'
+        """
+        if image_format not in const.QR_MIMETYPES:
+            raise werkzeug.exceptions.NotFound()
+        self._check_public_access(tx_id, access_token)
+
+        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id).exists()
+        if not tx_sudo or tx_sudo.provider_code != 'kamipay' or not tx_sudo.kamipay_emv:
+            raise werkzeug.exceptions.NotFound()
+
+        etag = utils.get_qr_etag(tx_sudo.kamipay_emv, image_format)
+        headers = [('Cache-Control', f'private, max-age={const.QR_CACHE_MAX_AGE}, immutable')]
+        if request.httprequest.if_none_match.contains(etag):
+            response = request.make_response('', headers=headers, status=304)
+        else:
+            image = utils.get_qr_image(tx_sudo.kamipay_emv, image_format)
+            headers.append(('Content-Type', const.QR_MIMETYPES[image_format]))
+            response = request.make_response(image, headers=headers)
+        response.set_etag(etag)
+        return response
+
     @http.route('/payment/kamipay/test/console/<int:tx_id>', type='http', auth='public', website=True)
-    def kamipay_test_console(self, tx_id=None, **kwargs):
+    def kamipay_test_console(self, tx_id=None, access_token=None, **kwargs):
         """Test console page for KamiPay transactions."""
-        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id)
+        self._check_public_access(tx_id, access_token)
+        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id).exists()
         if not tx_sudo or tx_sudo.provider_code != 'kamipay' or tx_sudo.provider_id.state != 'test':
             raise werkzeug.exceptions.NotFound()
             
@@ -161,6 +265,8 @@ class KamiPayController(http.Controller):
             if not tx_id:
                 return {'error': 'Missing transaction ID'}
 
+            # Each check sends a request to KamiPay, hence the stricter per-transaction limit
+            self._check_public_access(int(tx_id), data.get('access_token'), scope='tx_status')
             tx_sudo = request.env['payment.transaction'].sudo().browse(int(tx_id))
             if not tx_sudo.exists():
                 return {'error': 'Transaction not found'}
@@ -172,73 +278,188 @@ class KamiPayController(http.Controller):
             if not tx_sudo.kamipay_operation_id:
                 return {'error': 'Missing operation ID'}
                 
-            endpoint = '/v2/status/tx_status'
-            query_params = {
-                'target': 'operation_id',
-                'type': 'charge',
-                'id': tx_sudo.kamipay_operation_id,
-                'chain': 'polygon'
-            }
-            
-            _logger.info(
-                "Checking status for transaction %s with params:\n%s",
-                tx_sudo.reference, 
-                pprint.pformat(query_params)
-            )
-            
-            status_response = tx_sudo.provider_id._kamipay_make_request(
-                endpoint=endpoint,
-                query_params=query_params,
-                method='GET'
-            )
-            
-            _logger.info(
-                "Status response for transaction %s:\n%s",
-                tx_sudo.reference, pprint.pformat(status_response)
+            status_response = tx_sudo._kamipay_fetch_status()
+            utils.log_payload(
+                _logger, f'status response {tx_sudo.reference}', status_response,
+                sample_rate=utils.get_payload_sample_rate(request.env),
             )
-            
-            if status_response.get('status') == 'ok':
-                status_data = status_response.get('data', {})
-                notification_data = {
-                    'pix_id': tx_sudo.kamipay_operation_id,
-                    'status': status_data.get('status', 'error'),
-                    'external_reference': tx_sudo.reference,
-                    'data': status_data
-                }
-                request.env['payment.transaction'].sudo()._handle_notification_data(
-                    'kamipay', notification_data
-                )
-                
+            tx_sudo._kamipay_process_status_response(status_response)
             return status_response
 
+        except werkzeug.exceptions.HTTPException:
+            raise
         except Exception as e:
             _logger.exception("Error checking KamiPay status: %s", str(e))
             return {'error': str(e)}
 
-    @http.route('/payment/kamipay/poll/<int:tx_id>', type='json', auth='public')
-    def poll_kamipay_status(self, tx_id, **kwargs):
+    @http.route(_quote_url, type='json', auth='public')
+    def kamipay_quote(self, amount, provider_id=None, **kwargs):
+        """ Estimate the USDT amount credited for a BRL amount, e.g. to display it in the cart.
+
+        The estimate is based on the latest quote of the provider and does not create a charge.
+
+        :param float amount: The amount to pay, in BRL
+        :param int provider_id: The KamiPay provider; the first one of the company by default
+        :return: The estimate, or an error if no quote is available
+        :rtype: dict
+        """
+        self._check_rate_limit('ip', request.httprequest.remote_addr)
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            return {'error': 'Invalid amount'}
+
+        provider_model_sudo = request.env['payment.provider'].sudo()
+        if provider_id:
+            provider_sudo = provider_model_sudo.browse(int(provider_id)).exists()
+        else:
+            provider_sudo = provider_model_sudo.search([
+                ('code', '=', 'kamipay'),
+                ('state', '!=', 'disabled'),
+                ('company_id', '=', request.env.company.id),
+            ], limit=1)
+        if not provider_sudo or provider_sudo.code != 'kamipay':
+            return {'error': 'Invalid payment provider'}
+
+        return provider_sudo._kamipay_estimate_usdt(amount) or {'error': 'No quote available'}
+
+    @http.route(_prepare_url, type='json', auth='public')
+    def kamipay_prepare_charge(
+        self, provider_id, amount, currency_id, partner_id, access_token, transaction_route=None,
+        **kwargs
+    ):
+        """ Create a charge ahead of the payment once the customer selected KamiPay.
+
+        The charge is taken over by the transaction created when the customer clicks on Pay, so
+        that the QR code is displayed without waiting for KamiPay.
+
+        :param int provider_id: The KamiPay provider
+        :param float amount: The amount of the payment
+        :param int currency_id: The currency of the payment
+        :param int partner_id: The paying customer
+        :param str access_token: The access token of the payment form
+        :param str transaction_route: The route of the payment form creating the transaction
+        :return: Whether a charge is prepared
+        :rtype: dict
+        """
+        self._check_rate_limit('ip', request.httprequest.remote_addr)
+        amount = float(amount)
+        if not self._check_payment_form_access(
+            access_token, amount, int(currency_id), int(partner_id), transaction_route
+        ):
+            raise werkzeug.exceptions.Forbidden()
+
+        provider_sudo = request.env['payment.provider'].sudo().browse(int(provider_id)).exists()
+        if (
+            not provider_sudo
+            or provider_sudo.code != 'kamipay'
+            or provider_sudo.state == 'disabled'
+            or provider_sudo.kamipay_async_charge  # Charges must not be created in HTTP workers
+        ):
+            return {'prepared': False}
+
+        request.env['payment.kamipay.prepared.charge'].sudo()._prepare(
+            provider_sudo,
+            amount,
+            request.env['res.currency'].browse(int(currency_id)),
+            request.env['res.partner'].sudo().browse(int(partner_id)),
+        )
+        return {'prepared': True}
+
+    def _check_payment_form_access(
+        self, access_token, amount, currency_id, partner_id, transaction_route
+    ):
+        """ Check that the payment values come from a payment form rendered for the customer.
+
+        The generic payment form signs the partner, amount and currency; the shop's payment form
+        uses the access token of the order instead.
+
+        :return: Whether the access is granted
+        :rtype: bool
+        """
+        if payment_utils.check_access_token(access_token, partner_id, amount, currency_id):
+            return True
+
+        order_match = transaction_route and re.fullmatch(
+            r'/shop/payment/transaction/(\d+)', transaction_route
+        )
+        if not order_match or 'sale.order' not in request.env:
+            return False
+        order_sudo = request.env['sale.order'].sudo().browse(int(order_match[1])).exists()
+        return bool(
+            order_sudo
+            and order_sudo.access_token
+            and consteq(order_sudo.access_token, access_token)
+            and order_sudo.partner_invoice_id.id == partner_id
+            and order_sudo.currency_id.id == currency_id
+            and order_sudo.currency_id.compare_amounts(order_sudo.amount_total, amount) == 0
+        )
+
+    @http.route(_poll_url + '/<int:tx_id>', type='json', auth='public')
+    def poll_kamipay_status(self, tx_id, access_token=None, **kwargs):
         """Poll the local transaction status."""
-        tx_sudo = request.env['payment.transaction'].sudo().browse(tx_id)
-        if not tx_sudo.exists() or tx_sudo.provider_code != 'kamipay':
+        self._check_public_access(tx_id, access_token)
+        poll_state = self._get_poll_state(tx_id)
+        if not poll_state:
             return {'error': 'Transaction not found'}
-            
-        return {
-            'state': tx_sudo.state,
-            'state_message': tx_sudo.state_message,
-        }
+        return poll_state['values']
+
+    @http.route(_poll_url + '/<int:tx_id>/state', type='http', auth='public', methods=['GET'])
+    def kamipay_poll_state(self, tx_id, access_token=None, **kwargs):
+        """ Return the local transaction status, revalidated by the browser with its ETag. """
+        self._check_public_access(tx_id, access_token)
+        poll_state = self._get_poll_state(tx_id)
+        if not poll_state:
+            raise werkzeug.exceptions.NotFound()
+        response = request.make_json_response(
+            poll_state['values'], headers=[('Cache-Control', 'private, no-cache')]
+        )
+        response.set_etag(poll_state['etag'])
+        return response.make_conditional(request.httprequest)  # 304 if the state is unchanged
+
+    def _get_poll_state(self, tx_id):
+        """ Return the state of a KamiPay transaction served to the polling payment pages.
+
+        The state is read with a single query on the primary key, without going through the ORM,
+        and kept by the worker for `const.POLL_STATE_TTL` seconds; the worker committing a change
+        of the transaction drops it at once, see `_kamipay_notify_update`.
+
+        :param int tx_id: The transaction id
+        :return: The values served and their ETag, or None if it is not a KamiPay transaction
+        :rtype: dict
+        """
+        def read_poll_state():
+            request.env.cr.execute("""
+                SELECT tx.state, tx.state_message, tx.kamipay_emv
+                  FROM payment_transaction tx
+                  JOIN payment_provider provider ON provider.id = tx.provider_id
+                 WHERE tx.id = %s
+                   AND provider.code = 'kamipay'
+            """, [tx_id])
+            row = request.env.cr.fetchone()
+            if not row:
+                return None
+            values = {
+                'state': row[0],
+                'state_message': row[1],
+                # Picked up by the QR page when the charge was created asynchronously
+                'emv': row[2],
+            }
+            content = json.dumps(values, sort_keys=True).encode()
+            return {'values': values, 'etag': hashlib.sha256(content).hexdigest()[:32]}
+
+        return utils.poll_state_cache.get_or_compute((request.db, tx_id), read_poll_state)
     
     @http.route(_simulate_webhook_url, type='json', auth='public')
     def kamipay_simulate_webhook(self, operation_id, status, amount_brl, amount_usdt, **kwargs):
         """ Simulate a webhook notification for testing."""
         simulation_start = datetime.now(pytz.UTC)
-        _logger.info("Starting webhook simulation at %s", simulation_start)
         
-        tx_sudo = request.env['payment.transaction'].sudo().search([
-            ('kamipay_operation_id', '=', operation_id),
-            ('provider_id.state', '=', 'test')
-        ], limit=1)
+        tx_sudo = request.env['payment.transaction'].sudo()._kamipay_get_tx_from_operation_id(
+            operation_id
+        )
         
-        if not tx_sudo:
+        if not tx_sudo or tx_sudo.provider_id.state != 'test':
             raise ValidationError("Test simulation is only available in test mode")
 
         timestamp = datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S.%f%z')
@@ -275,14 +496,11 @@ class KamiPayController(http.Controller):
                 
             webhook_data['data'] = common_data
 
-        _logger.info(
-            "Sending webhook simulation to KamiPay emulator for operation %s with data:\n%s",
-            operation_id, pprint.pformat(webhook_data)
-        )
+        utils.log_payload(_logger, f'webhook simulation {operation_id}', webhook_data)
 
-        access_token = tx_sudo.provider_id._get_kamipay_access_token()
-        base_url = 'https://devnakamotoapi2.kamipay.io' if tx_sudo.provider_id.state == 'test' else 'https://api2.kamipay.io'
-        url = f"{base_url}/v1/emulator/push_webhook"
+        provider_sudo = tx_sudo.provider_id
+        access_token = provider_sudo._get_kamipay_access_token()
+        url = f"{provider_sudo._kamipay_get_api_url()}/v1/emulator/push_webhook"
 
         headers = {
             'Authorization': f'Bearer {access_token}',
@@ -290,11 +508,15 @@ class KamiPayController(http.Controller):
         }
 
         try:
-            response = requests.post(url, json=webhook_data, headers=headers, timeout=10)
-            response.raise_for_status()
-            _logger.info("KamiPay emulator response at %s", datetime.now(pytz.UTC))
-            _logger.info("KamiPay emulator response status code: %s", response.status_code)
-            _logger.info("KamiPay emulator response content: %s", response.text)
+            with utils.log_operation(
+                _logger, 'simulate_webhook', pix_id=operation_id, status=status
+            ) as log_fields:
+                response = provider_sudo._kamipay_get_session().post(
+                    url, json=webhook_data, headers=headers, timeout=const.DEFAULT_TIMEOUT
+                )
+                log_fields['http_status'] = response.status_code
+                response.raise_for_status()
+            _logger.debug("KamiPay emulator response content: %s", response.text)
             return {'status': 'ok', 'simulation_start': simulation_start.isoformat()}
         except requests.exceptions.RequestException as e:
             _logger.error("Failed to send webhook simulation to KamiPay: %s", str(e))
@@ -303,22 +525,10 @@ class KamiPayController(http.Controller):
     @http.route(_return_url, type='http', methods=['GET'], auth='public', csrf=False, save_session=False)
     def kamipay_return_from_checkout(self, **data):
         """ Handle the return from KamiPay and redirect to status page. """
-        _logger.info("Handling return from KamiPay with data:\n%s", pprint.pformat(data))
-        
-        # Check if it's an expiry return
-        if data.get('expired'):
-            reference = data.get('reference')
-            if reference:
-                tx_sudo = request.env['payment.transaction'].sudo().search([
-                    ('reference', '=', reference),
-                    ('provider_code', '=', 'kamipay'),
-                    ('state', '=', 'draft'),  # Only update draft transactions
-                ], limit=1)
-                
-                if tx_sudo:
-                    _logger.info("Setting expired QR transaction %s to canceled", tx_sudo.reference)
-                    tx_sudo._set_canceled(state_message=_("Payment timeout - QR code expired"))
+        utils.log_payload(_logger, 'return', data)
 
+        # Expired charges are canceled by the expiry cron, see `_cron_kamipay_expire_charges`
+        if data.get('expired'):
             return request.redirect('/payment/status')
 
         # Handle normal return flow
@@ -331,28 +541,99 @@ class KamiPayController(http.Controller):
             return request.redirect('/payment/status')
 
         # Check transaction status and redirect to status page
-        if tx_sudo.state not in ['done', 'error']:
+        if tx_sudo.state not in ['done', 'error'] and tx_sudo.kamipay_operation_id:
             # Make a status check before redirecting
-            status_response = tx_sudo.provider_id._kamipay_make_request(
-                f'/v2/status/tx_status',
-                payload={
-                    'target': 'operation_id',
-                    'type': 'charge',
-                    'id': tx_sudo.kamipay_operation_id,
-                    'chain': 'polygon'
-                },
-                method='GET'
-            )
-            
-            if status_response.get('status') == 'ok':
-                notification_data = {
-                    'pix_id': tx_sudo.kamipay_operation_id,
-                    'status': status_response['data'].get('status', 'error'),
-                    'type': 'charge',
-                    'timestamp': datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S.%f%z')
-                }
-                request.env['payment.transaction'].sudo()._handle_notification_data(
-                    'kamipay', notification_data
-                )
+            tx_sudo._kamipay_process_status_response(tx_sudo._kamipay_fetch_status())
+
+        return request.redirect('/payment/status')
+
+    @http.route(_settlement_export_url, type='http', auth='user', methods=['GET'])
+    def kamipay_settlement_export(self, **kwargs):
+        """ Stream the daily settlement totals of the user's companies as CSV.
+
+        The rows are fetched by batches in a cursor of their own while the response is sent, so
+        that the export never holds the whole summary in memory.
+        """
+        if not request.env['payment.kamipay.settlement.report'].check_access_rights(
+            'read', raise_exception=False
+        ):
+            raise werkzeug.exceptions.Forbidden()
 
-        return request.redirect('/payment/status')
\ No newline at end of file
+        registry = request.env.registry
+        company_ids = tuple(request.env.companies.ids)
+        lang = request.env.lang or 'en_US'
+
+        def generate_rows():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow([
+                'date', 'provider', 'company', 'transactions', 'amount_brl', 'amount_usdt', 'rate'
+            ])
+            last_key = (date.min, 0, 0)
+            with registry.cursor() as cr:
+                while True:
+                    cr.execute("""
+                        SELECT report.date,
+                               report.provider_id,
+                               report.company_id,
+                               COALESCE(provider.name->>%s, provider.name->>'en_US'),
+                               company.name,
+                               report.transaction_count,
+                               report.amount_brl,
+                               report.amount_usdt,
+                               report.rate
+                          FROM payment_kamipay_settlement_report report
+                          JOIN payment_provider provider ON provider.id = report.provider_id
+                          JOIN res_company company ON company.id = report.company_id
+                         WHERE report.company_id IN %s
+                           AND (report.date, report.provider_id, report.company_id) > (%s, %s, %s)
+                      ORDER BY report.date, report.provider_id, report.company_id
+                         LIMIT %s
+                    """, [lang, company_ids, *last_key, const.SETTLEMENT_EXPORT_BATCH_SIZE])
+                    rows = cr.fetchall()
+                    for row in rows:
+                        day, _provider_id, _company_id, provider, company, *totals = row
+                        writer.writerow([day, provider, company, *totals])
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                    if len(rows) < const.SETTLEMENT_EXPORT_BATCH_SIZE:
+                        break
+                    last_key = rows[-1][:3]
+
+        return request.make_response(generate_rows(), headers=[
+            ('Content-Type', 'text/csv; charset=utf-8'),
+            ('Content-Disposition', content_disposition('kamipay_settlements.csv')),
+        ])
+
+    @http.route(_metrics_url, type='http', auth='user', methods=['GET'], save_session=False)
+    def kamipay_metrics(self, **kwargs):
+        """ Expose the KamiPay metrics in the Prometheus text format.
+
+        The counters and histograms are the totals of all the workers of the server, which publish
+        them in the data directory every few seconds; a scrape may thus miss the last seconds of
+        the other workers. The gauges (connection pools, circuit breakers) describe the serving
+        worker only and are labeled with its pid.
+
+        Only administrators can read the metrics.
+        """
+        if not request.env.user.has_group('base.group_system'):
+            raise werkzeug.exceptions.Forbidden()
+
+        gauges = {}
+        for (dbname, provider_id), stats in utils.get_session_stats().items():
+            if dbname != request.db:
+                continue
+            labels = (('provider', provider_id),)
+            gauges[('kamipay_http_connections', labels)] = stats['connections']
+            gauges[('kamipay_http_requests', labels)] = stats['requests']
+        circuit_state_values = {'closed': 0, 'half_open': 1, 'open': 2}
+        for (dbname, provider_id), state in utils.get_circuit_states().items():
+            if dbname != request.db:
+                continue
+            labels = (('provider', provider_id),)
+            gauges[('kamipay_circuit_state', labels)] = circuit_state_values[state]
+        return request.make_response(
+            metrics.render(gauges),
+            headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')],
+        )
@@ -0,0 +1,259 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+# The metrics exposed by the addon, with their type and description
+METRICS = {
+    'kamipay_api_requests_total': (
+        'counter', "Requests sent to the KamiPay API, by endpoint and outcome."
+    ),
+    'kamipay_api_errors_total': (
+        'counter', "Failed requests to the KamiPay API, by endpoint and kind of error."
+    ),
+    'kamipay_api_request_duration_seconds': (
+        'histogram', "Duration of the requests sent to the KamiPay API, by endpoint."
+    ),
+    'kamipay_token_refresh_total': (
+        'counter', "Access token refreshes, by outcome."
+    ),
+    'kamipay_webhook_stage_duration_seconds': (
+        'histogram', "Duration of the processing stages of KamiPay webhooks."
+    ),
+    'kamipay_webhook_total': (
+        'counter', "Received KamiPay webhooks, by outcome."
+    ),
+    'kamipay_order_confirmation_duration_seconds': (
+        'histogram', "Duration of the confirmation of the orders paid with KamiPay."
+    ),
+    'kamipay_rate_limited_total': (
+        'counter', "Requests to the public routes rejected by the rate limits, by scope."
+    ),
+    'kamipay_circuit_state': (
+        'gauge', "State of the circuit breakers of the KamiPay providers (0 closed, 1 half-open, 2 open)."
+    ),
+    'kamipay_http_connections': (
+        'gauge', "Connections opened by the pooled HTTP sessions, by provider."
+    ),
+    'kamipay_http_requests': (
+        'gauge', "Requests sent through the pooled HTTP sessions, by provider."
+    ),
+}
+
+# Upper bounds (in seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The counters and histograms of each worker are published to a file of this directory, so that
+# the worker serving a scrape reports the totals of all the workers: every `PUBLISH_INTERVAL`
+# seconds at most, and removed once not updated for `PUBLISH_RETENTION` seconds
+PUBLISH_INTERVAL = 5
+PUBLISH_RETENTION = 86400
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+_last_publish = 0.0
+
+
+def _reset():
+    """ Start each forked worker with empty metrics and a fresh lock. """
+    global _lock, _last_publish
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _last_publish = 0.0
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def inc(name, value=1, **labels):
+    """ Increment a counter.
+
+    :param str name: The name of the counter
+    :param float value: The increment
+    :param dict labels: The labels of the counter
+    :return: None
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _publish_if_due()
+
+
+def observe(name, value, **labels):
+    """ Record a value in a histogram.
+
+    :param str name: The name of the histogram
+    :param float value: The observed value
+    :param dict labels: The labels of the histogram
+    :return: None
+    """
+    key = (name, tuple(sorted(labels.items())))
+    bucket_index = bisect.bisect_left(DURATION_BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+        if bucket_index < len(DURATION_BUCKETS):
+            histogram[0][bucket_index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    _publish_if_due()
+
+
+@contextlib.contextmanager
+def track(name, **labels):
+    """ Record the duration of the wrapped block in a histogram, whether it raises or not.
+
+    :param str name: The name of the histogram
+    :param dict labels: The labels of the histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _get_publish_dir():
+    return os.path.join(config['data_dir'], 'payment_kamipay_metrics')
+
+
+def _snapshot():
+    """ Return a copy of the counters and histograms of this worker. """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+    return counters, histograms
+
+
+def _publish_if_due():
+    """ Publish the metrics of this worker if they were not published recently. """
+    global _last_publish
+    now = time.monotonic()
+    if now - _last_publish < PUBLISH_INTERVAL:
+        return
+    _last_publish = now
+    counters, histograms = _snapshot()
+    content = {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, value] for (name, labels), value in histograms.items()],
+    }
+    path = os.path.join(_get_publish_dir(), f'{os.getpid()}.json')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(content, file)
+        os.replace(f'{path}.tmp', path)  # Readers never see a partial file
+    except OSError as error:
+        _logger.debug("Could not publish the KamiPay metrics: %s", error)
+
+
+def _load_other_workers():
+    """ Return the counters and histograms published by the other workers, summed. """
+    counters, histograms = {}, {}
+    publish_dir = _get_publish_dir()
+    try:
+        filenames = os.listdir(publish_dir)
+    except OSError:
+        return counters, histograms
+    own_filename = f'{os.getpid()}.json'
+    expired = time.time() - PUBLISH_RETENTION
+    for filename in filenames:
+        if not filename.endswith('.json') or filename == own_filename:
+            continue
+        path = os.path.join(publish_dir, filename)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+                continue
+            with open(path) as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            continue  # Removed or replaced in the meantime
+        for name, labels, value in content['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, (bucket_counts, total, count) in content['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            _add_histogram(histograms, key, bucket_counts, total, count)
+    return counters, histograms
+
+
+def _add_histogram(histograms, key, bucket_counts, total, count):
+    histogram = histograms.get(key)
+    if histogram is None:
+        histograms[key] = (list(bucket_counts), total, count)
+    else:
+        histograms[key] = (
+            [a + b for a, b in zip(histogram[0], bucket_counts)],
+            histogram[1] + total,
+            histogram[2] + count,
+        )
+
+
+def _format_labels(labels, **extra_labels):
+    labels = dict(labels, **extra_labels)
+    if not labels:
+        return ''
+    formatted = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return f'{{{formatted}}}'
+
+
+def render(gauges=None):
+    """ Render the metrics in the Prometheus text exposition format.
+
+    The counters and histograms are the totals of all the workers of the server: those of this
+    worker, and those last published by the others, i.e. up to `PUBLISH_INTERVAL` seconds old.
+    The gauges describe the state of this worker only and are labeled with its pid.
+
+    :param dict gauges: Additional gauge values of this worker, as {(name, labels tuple): value}
+    :return: The metrics
+    :rtype: str
+    """
+    counters, histograms = _load_other_workers()
+    own_counters, own_histograms = _snapshot()
+    for key, value in own_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, (bucket_counts, total, count) in own_histograms.items():
+        _add_histogram(histograms, key, bucket_counts, total, count)
+
+    values_by_name = {}
+    for values in (counters, gauges or {}, histograms):
+        for (name, labels), value in values.items():
+            values_by_name.setdefault(name, []).append((dict(labels), value))
+
+    worker = os.getpid()
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        if name not in values_by_name:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in values_by_name[name]:
+            if metric_type == 'gauge':
+                lines.append(f'{name}{_format_labels(labels, worker=worker)} {value}')
+                continue
+            if metric_type != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            bucket_counts, total, count = value
+            cumulated = 0
+            for bound, bucket_count in zip(DURATION_BUCKETS, bucket_counts):
+                cumulated += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulated}')
+            lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -1,2 +1,7 @@
+from . import payment_kamipay_prepared_charge
+from . import payment_kamipay_rate_limit
+from . import payment_kamipay_settlement
+from . import payment_kamipay_settlement_report
+from . import payment_kamipay_webhook_event
 from . import payment_provider
 from . import payment_transaction
@@ -0,0 +1,89 @@
+import uuid
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_kamipay import const
+
+
+class PaymentKamipayPreparedCharge(models.Model):
+    _name = 'payment.kamipay.prepared.charge'
+    _description = "KamiPay Prepared Charge"
+    _order = 'id'
+
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', required=True, ondelete='cascade'
+    )
+    partner_id = fields.Many2one(string="Customer", comodel_name='res.partner', ondelete='cascade')
+    currency_id = fields.Many2one(string="Currency", comodel_name='res.currency', required=True)
+    amount = fields.Monetary(string="Amount", currency_field='currency_id', required=True)
+    reference = fields.Char(string="Reference", required=True)
+    operation_id = fields.Char(string="Operation ID", required=True)
+    emv = fields.Char(string="EMV Code")
+    rate = fields.Float(string="Exchange Rate", digits=(12, 6))
+    usdt_amount = fields.Float(string="USDT Amount", digits='Product Price')
+    expire_date = fields.Datetime(string="Expires On", required=True)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_kamipay_prepared_charge_lookup_index
+                ON payment_kamipay_prepared_charge (provider_id, partner_id, amount)
+        """)
+
+    @api.model
+    def _prepare(self, provider, amount, currency, partner):
+        """ Create a charge ahead of the payment, unless a reusable one is already prepared.
+
+        :param recordset provider: The KamiPay provider, as a `payment.provider` record
+        :param float amount: The amount of the payment
+        :param recordset currency: The currency of the payment, as a `res.currency` record
+        :param recordset partner: The paying customer, as a `res.partner` record
+        :return: The prepared charge
+        :rtype: recordset of `payment.kamipay.prepared.charge`
+        """
+        prepared_charge = self._find_reusable(provider, amount, currency, partner)
+        if prepared_charge:
+            return prepared_charge
+
+        reference = f'PRE-{uuid.uuid4().hex[:12].upper()}'
+        charge_response = provider._kamipay_create_charge(amount, reference)
+        return self.create({
+            'provider_id': provider.id,
+            'partner_id': partner.id,
+            'currency_id': currency.id,
+            'amount': amount,
+            'reference': reference,
+            'operation_id': charge_response.get('operation_id'),
+            'emv': charge_response.get('emv'),
+            'rate': charge_response.get('rate'),
+            'usdt_amount': charge_response.get('amount_usdt'),
+            'expire_date': fields.Datetime.now() + timedelta(seconds=const.CHARGE_EXPIRY),
+        })
+
+    @api.model
+    def _find_reusable(self, provider, amount, currency, partner):
+        """ Return a prepared charge for the payment that remains valid long enough to be paid.
+
+        :param recordset provider: The KamiPay provider, as a `payment.provider` record
+        :param float amount: The amount of the payment
+        :param recordset currency: The currency of the payment, as a `res.currency` record
+        :param recordset partner: The paying customer, as a `res.partner` record
+        :return: The prepared charge, if any
+        :rtype: recordset of `payment.kamipay.prepared.charge`
+        """
+        min_expire_date = fields.Datetime.now() + timedelta(
+            seconds=const.CHARGE_REUSE_MIN_VALIDITY
+        )
+        return self.search([
+            ('provider_id', '=', provider.id),
+            ('partner_id', '=', partner.id),
+            ('currency_id', '=', currency.id),
+            ('amount', '=', amount),
+            ('expire_date', '>', min_expire_date),
+        ], limit=1)
+
+    @api.autovacuum
+    def _gc_prepared_charges(self):
+        """ Remove the prepared charges that expired without being used. """
+        self.search([('expire_date', '<', fields.Datetime.now())]).unlink()
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_kamipay import const
+
+
+class PaymentKamipayRateLimit(models.Model):
+    _name = 'payment.kamipay.rate.limit'
+    _description = "KamiPay Rate Limit Bucket"
+    _log_access = False
+
+    key = fields.Char(string="Key", required=True, readonly=True)
+    tokens = fields.Float(string="Tokens", readonly=True)
+    update_date = fields.Datetime(string="Updated On", readonly=True)
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(key)', "A rate limit bucket can only exist once."),
+    ]
+
+    @api.model
+    def _consume(self, key, rate, burst):
+        """ Take a token from the bucket of the key, shared by all the workers.
+
+        The bucket is refilled and consumed by a single statement, in a transaction of its own so
+        that the row is not locked until the end of the request. A token is only taken when one is
+        available.
+
+        :param str key: The key of the bucket
+        :param float rate: The number of tokens added to the bucket per second
+        :param int burst: The capacity of the bucket
+        :return: Whether a token was available
+        :rtype: bool
+        """
+        params = {'key': key, 'rate': rate, 'burst': burst}
+        with self.env.registry.cursor() as cr:
+            cr.execute("""
+                INSERT INTO payment_kamipay_rate_limit (key, tokens, update_date)
+                     VALUES (%(key)s, %(burst)s, NOW() AT TIME ZONE 'UTC')
+                ON CONFLICT (key) DO NOTHING
+            """, params)
+            # A rejected request keeps the refilled tokens, so that it does not delay the next ones
+            cr.execute("""
+                UPDATE payment_kamipay_rate_limit AS bucket
+                   SET tokens = CASE
+                           WHEN refill.tokens >= 1 THEN refill.tokens - 1
+                           ELSE refill.tokens
+                       END,
+                       update_date = NOW() AT TIME ZONE 'UTC'
+                  FROM (
+                      SELECT id, LEAST(
+                                 %(burst)s,
+                                 tokens + %(rate)s * EXTRACT(
+                                     EPOCH FROM NOW() AT TIME ZONE 'UTC' - update_date
+                                 )
+                             ) AS tokens
+                        FROM payment_kamipay_rate_limit
+                       WHERE key = %(key)s
+                         FOR UPDATE
+                  ) AS refill
+                 WHERE bucket.id = refill.id
+             RETURNING refill.tokens >= 1
+            """, params)
+            return cr.fetchone()[0]
+
+    @api.autovacuum
+    def _gc_rate_limits(self):
+        """ Remove the buckets that have been full again for a while. """
+        self.search([
+            ('update_date', '<', fields.Datetime.now() - timedelta(
+                seconds=const.RATE_LIMIT_RETENTION
+            )),
+        ]).unlink()
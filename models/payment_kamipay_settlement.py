@@ -0,0 +1,85 @@
+from odoo import api, fields, models
+
+from odoo.addons.payment_kamipay import const
+
+
+class PaymentKamipaySettlement(models.Model):
+    _name = 'payment.kamipay.settlement'
+    _description = "KamiPay Settlement Summary"
+    _order = 'date desc, provider_id'
+    _log_access = False
+
+    date = fields.Date(string="Date", required=True, readonly=True)
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', required=True, readonly=True,
+        ondelete='cascade',
+    )
+    company_id = fields.Many2one(
+        string="Company", comodel_name='res.company', required=True, readonly=True,
+        ondelete='cascade',
+    )
+    stripe = fields.Integer(string="Stripe", readonly=True, group_operator=None)
+    transaction_count = fields.Integer(string="Transactions", readonly=True)
+    amount_brl = fields.Float(string="BRL Received", digits='Product Price', readonly=True)
+    amount_usdt = fields.Float(string="USDT Credited", digits='Product Price', readonly=True)
+
+    _sql_constraints = [
+        ('day_uniq', 'unique(date, provider_id, company_id, stripe)',
+         "A settlement summary line can only exist once per day, provider and company."),
+    ]
+
+    @api.model
+    def _add_transactions(self, txs):
+        """ Add done transactions to the totals of their settlement day.
+
+        The totals of a day are spread over `SETTLEMENT_STRIPES` lines so that transactions done
+        at the same time do not wait for each other on a single row; the report
+        `payment.kamipay.settlement.report` sums them back.
+
+        :param recordset txs: The done KamiPay transactions, as `payment.transaction` records
+        :return: None
+        """
+        for tx in txs:
+            self.env.cr.execute("""
+                INSERT INTO payment_kamipay_settlement AS settlement
+                            (date, provider_id, company_id, stripe, transaction_count, amount_brl,
+                             amount_usdt)
+                     VALUES (%s, %s, %s, %s, 1, %s, %s)
+                ON CONFLICT (date, provider_id, company_id, stripe) DO UPDATE
+                        SET transaction_count = settlement.transaction_count + 1,
+                            amount_brl = settlement.amount_brl + EXCLUDED.amount_brl,
+                            amount_usdt = settlement.amount_usdt + EXCLUDED.amount_usdt
+            """, [
+                fields.Date.to_date(tx.last_state_change or fields.Datetime.now()),
+                tx.provider_id.id,
+                tx.company_id.id,
+                tx.id % const.SETTLEMENT_STRIPES,
+                tx.amount,
+                tx.kamipay_usdt_amount or 0.0,
+            ])
+        self.invalidate_model()
+
+    @api.model
+    def action_refresh(self):
+        """ Rebuild the whole summary from the done transactions, e.g. after a backfill. """
+        self.env['payment.transaction'].flush_model()
+        self.env.cr.execute("DELETE FROM payment_kamipay_settlement")
+        self.env.cr.execute("""
+            INSERT INTO payment_kamipay_settlement
+                        (date, provider_id, company_id, stripe, transaction_count, amount_brl,
+                         amount_usdt)
+                 SELECT tx.last_state_change::date,
+                        tx.provider_id,
+                        tx.company_id,
+                        tx.id %% %s,
+                        COUNT(*),
+                        SUM(tx.amount),
+                        SUM(COALESCE(tx.kamipay_usdt_amount, 0))
+                   FROM payment_transaction tx
+                   JOIN payment_provider provider ON provider.id = tx.provider_id
+                  WHERE provider.code = 'kamipay'
+                    AND tx.state = 'done'
+               GROUP BY 1, 2, 3, 4
+        """, [const.SETTLEMENT_STRIPES])
+        self.invalidate_model()
+        return {'type': 'ir.actions.client', 'tag': 'reload'}
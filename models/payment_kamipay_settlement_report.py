@@ -0,0 +1,73 @@
+from odoo import api, fields, models, tools
+
+
+class PaymentKamipaySettlementReport(models.Model):
+    _name = 'payment.kamipay.settlement.report'
+    _description = "KamiPay Settlement Report"
+    _order = 'date desc, provider_id'
+    _auto = False
+
+    date = fields.Date(string="Date", readonly=True)
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', readonly=True
+    )
+    company_id = fields.Many2one(string="Company", comodel_name='res.company', readonly=True)
+    transaction_count = fields.Integer(string="Transactions", readonly=True)
+    amount_brl = fields.Float(string="BRL Received", digits='Product Price', readonly=True)
+    amount_usdt = fields.Float(string="USDT Credited", digits='Product Price', readonly=True)
+    rate = fields.Float(
+        string="Effective Rate", digits=(12, 6), readonly=True, group_operator='avg'
+    )
+
+    def init(self):
+        """ Sum the stripes of `payment.kamipay.settlement` into one line per day, provider and
+        company. """
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(f"""
+            CREATE OR REPLACE VIEW {self._table} AS (
+                SELECT MIN(settlement.id) AS id,
+                       settlement.date,
+                       settlement.provider_id,
+                       settlement.company_id,
+                       SUM(settlement.transaction_count) AS transaction_count,
+                       SUM(settlement.amount_brl) AS amount_brl,
+                       SUM(settlement.amount_usdt) AS amount_usdt,
+                       SUM(settlement.amount_brl) / NULLIF(SUM(settlement.amount_usdt), 0) AS rate
+                  FROM payment_kamipay_settlement settlement
+              GROUP BY settlement.date, settlement.provider_id, settlement.company_id
+            )
+        """)
+
+    @api.model
+    def read_group(self, domain, fields, groupby, offset=0, limit=None, orderby=False, lazy=True):
+        """ Override of `base` to weight the rate of the groups by their amounts.
+
+        The average of the daily rates would give a quiet day as much weight as a busy one.
+        """
+        field_names = {spec.split(':')[0] for spec in fields}
+        if 'rate' in field_names:
+            fields = list(fields) + [
+                f'{name}:sum' for name in ('amount_brl', 'amount_usdt') if name not in field_names
+            ]
+        groups = super().read_group(
+            domain, fields, groupby, offset=offset, limit=limit, orderby=orderby, lazy=lazy
+        )
+        if 'rate' in field_names:
+            for group in groups:
+                usdt = group.get('amount_usdt')
+                group['rate'] = usdt and group['amount_brl'] / usdt
+        return groups
+
+    @api.model
+    def action_refresh(self):
+        """ Rebuild the summary from the done transactions, see `payment.kamipay.settlement`. """
+        return self.env['payment.kamipay.settlement'].action_refresh()
+
+    @api.model
+    def action_export_csv(self):
+        """ Download the daily totals of the companies of the user as CSV. """
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/payment/kamipay/settlements/export',
+            'target': 'self',
+        }
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_kamipay import const
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentKamipayWebhookEvent(models.Model):
+    _name = 'payment.kamipay.webhook.event'
+    _description = "KamiPay Webhook Event"
+    _order = 'id desc'
+    _log_access = False
+
+    event_key = fields.Char(string="Event Key", required=True, readonly=True)
+    pix_id = fields.Char(string="Operation ID", readonly=True)
+    status = fields.Char(string="Status", readonly=True)
+    transaction_id = fields.Many2one(
+        string="Transaction", comodel_name='payment.transaction', readonly=True,
+        ondelete='cascade',
+    )
+    received_date = fields.Datetime(string="Received On", readonly=True)
+    state = fields.Selection(
+        string="State",
+        selection=[('pending', "Pending"), ('done', "Processed"), ('failed', "Failed")],
+        default='done',
+        readonly=True,
+    )
+    payload = fields.Json(string="Payload", readonly=True)
+    attempts = fields.Integer(string="Attempts", readonly=True)
+    next_attempt_date = fields.Datetime(string="Next Attempt", readonly=True)
+
+    _sql_constraints = [
+        ('event_key_uniq', 'unique(event_key)', "A webhook event can only be registered once."),
+    ]
+
+    @api.model
+    def _get_event_key(self, notification_data):
+        """ Return the key identifying a webhook delivery, identical across its retries.
+
+        :param dict notification_data: The notification data sent by KamiPay
+        :return: The event key
+        :rtype: str
+        """
+        canonical_data = json.dumps(notification_data, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical_data.encode()).hexdigest()
+
+    def init(self):
+        super().init()
+        # The inbox is drained by scanning the pending events only
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_kamipay_webhook_event_pending_index
+                ON payment_kamipay_webhook_event (transaction_id, id)
+             WHERE state = 'pending'
+        """)
+
+    @api.model
+    def _register(self, event_key, notification_data, tx, state='done'):
+        """ Record a webhook delivery unless it was already received.
+
+        A single indexed statement both checks and records the delivery; concurrent deliveries of
+        the same event wait for each other on the unique index.
+
+        :param str event_key: The key of the delivery, see `_get_event_key`
+        :param dict notification_data: The notification data sent by KamiPay
+        :param recordset tx: The transaction of the notification, as a `payment.transaction` record
+        :param str state: 'done' if the delivery is processed right away, 'pending' to queue it
+        :return: Whether the delivery is new
+        :rtype: bool
+        """
+        self.env.cr.execute("""
+            INSERT INTO payment_kamipay_webhook_event
+                        (event_key, pix_id, status, transaction_id, received_date, state, payload,
+                         attempts)
+                 VALUES (%s, %s, %s, %s, NOW() AT TIME ZONE 'UTC', %s, %s, 0)
+            ON CONFLICT (event_key) DO NOTHING
+              RETURNING id
+        """, [
+            event_key,
+            notification_data.get('pix_id'),
+            notification_data.get('status'),
+            tx.id or None,
+            state,
+            json.dumps(notification_data) if state == 'pending' else None,
+        ])
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _enqueue(self, event_key, notification_data, tx):
+        """ Queue a webhook delivery in the inbox and wake up the cron processing it.
+
+        :param str event_key: The key of the delivery, see `_get_event_key`
+        :param dict notification_data: The notification data sent by KamiPay
+        :param recordset tx: The transaction of the notification, as a `payment.transaction` record
+        :return: Whether the delivery is new
+        :rtype: bool
+        """
+        is_new_event = self._register(event_key, notification_data, tx, state='pending')
+        if is_new_event:
+            self.env.ref('payment_kamipay.cron_process_webhook_inbox')._trigger()
+        return is_new_event
+
+    @api.model
+    def _cron_process_inbox(self, batch_size=100):
+        """ Process the pending webhook deliveries, in their order of arrival per transaction.
+
+        The deliveries of a transaction are processed by a single worker at a time, which locks
+        the transaction with `SKIP LOCKED`; the other workers move on to other transactions. A
+        delivery that fails is retried later with an exponential backoff, and blocks the next
+        deliveries of its transaction in the meantime.
+
+        :param int batch_size: The maximum number of transactions processed in this run
+        :return: None
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        # Only the transactions whose next delivery is due, i.e. not waiting for its backoff
+        self.env.cr.execute("""
+            SELECT event.transaction_id
+              FROM payment_kamipay_webhook_event event
+             WHERE event.state = 'pending'
+               AND (event.next_attempt_date IS NULL OR event.next_attempt_date <= %s)
+               AND NOT EXISTS (
+                       SELECT 1
+                         FROM payment_kamipay_webhook_event previous
+                        WHERE previous.transaction_id = event.transaction_id
+                          AND previous.state = 'pending'
+                          AND previous.id < event.id
+                   )
+          ORDER BY event.id
+             LIMIT %s
+        """, [fields.Datetime.now(), batch_size])
+        tx_ids = [row[0] for row in self.env.cr.fetchall()]
+
+        for tx_id in tx_ids:
+            self.env.cr.execute(
+                'SELECT id FROM payment_transaction WHERE id = %s FOR UPDATE SKIP LOCKED', [tx_id]
+            )
+            if not self.env.cr.fetchone():
+                continue  # Processed by another worker
+
+            events = self.search(
+                [('transaction_id', '=', tx_id), ('state', '=', 'pending')], order='id'
+            )
+            for event in events:
+                if event.next_attempt_date and event.next_attempt_date > fields.Datetime.now():
+                    break
+                if not event._process():
+                    break  # Keep the order of the deliveries of the transaction
+            if auto_commit:
+                self.env.cr.commit()
+
+        if len(tx_ids) == batch_size:
+            # More deliveries may be pending
+            self.env.ref('payment_kamipay.cron_process_webhook_inbox')._trigger()
+
+    def _process(self):
+        """ Process the pending webhook delivery.
+
+        Note: self.ensure_one()
+
+        :return: Whether the delivery was processed
+        :rtype: bool
+        """
+        self.ensure_one()
+        tx_sudo = self.transaction_id.sudo()
+        try:
+            with self.env.cr.savepoint():
+                if not tx_sudo._kamipay_is_status_regression(self.status):
+                    tx_sudo._handle_notification_data('kamipay', self.payload)
+        except Exception as error:
+            attempts = self.attempts + 1
+            _logger.warning(
+                "KamiPay: Could not process webhook %s (attempt %d): %s", self.id, attempts, error
+            )
+            if attempts >= const.WEBHOOK_MAX_ATTEMPTS:
+                self.write({'state': 'failed', 'attempts': attempts})
+            else:
+                self.write({
+                    'attempts': attempts,
+                    'next_attempt_date': fields.Datetime.now() + timedelta(
+                        seconds=const.WEBHOOK_RETRY_BACKOFF * 2 ** (attempts - 1)
+                    ),
+                })
+            return False
+        self.write({'state': 'done', 'payload': False})
+        return True
+
+    @api.model
+    def _forget(self, event_key):
+        """ Remove a delivery that could not be processed, so that its retries are processed.
+
+        :param str event_key: The key of the delivery, see `_get_event_key`
+        :return: None
+        """
+        self.env.cr.execute(
+            'DELETE FROM payment_kamipay_webhook_event WHERE event_key = %s', [event_key]
+        )
+
+    @api.autovacuum
+    def _gc_webhook_events(self):
+        """ Remove the events older than the period during which KamiPay retries deliveries. """
+        self.env.cr.execute("""
+            DELETE FROM payment_kamipay_webhook_event
+                  WHERE received_date < NOW() AT TIME ZONE 'UTC' - make_interval(days => %s)
+                    AND state != 'pending'
+        """, [const.WEBHOOK_EVENT_RETENTION_DAYS])
@@ -1,11 +1,15 @@
 import logging
 import requests
-import pprint
+import time
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug import urls
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
 from datetime import timedelta
 
+from odoo.addons.payment_kamipay import const, metrics, utils
+from odoo.addons.payment_kamipay.controllers.main import KamiPayController
+
 _logger = logging.getLogger(__name__)
 
 class PaymentProvider(models.Model):
@@ -35,8 +39,51 @@ class PaymentProvider(models.Model):
         help="Your USDT wallet address where funds will be received",
         required_if_provider='kamipay'
     )
+    kamipay_async_charge = fields.Boolean(
+        string="Asynchronous Charge Creation",
+        help="Create the PIX charges in the background so that the QR page renders immediately",
+    )
+    kamipay_async_webhook = fields.Boolean(
+        string="Deferred Webhook Processing",
+        help="Acknowledge webhooks once authenticated and process them in the background",
+    )
+    kamipay_qr_inline_svg = fields.Boolean(
+        string="Inline SVG QR Code",
+        help="Embed the QR code in the payment page as SVG instead of loading it as an image",
+    )
+    kamipay_webhook_url = fields.Char(
+        string="Webhook URL",
+        help="The URL to register in KamiPay for the webhooks of this provider",
+        compute='_compute_kamipay_webhook_url',
+    )
     kamipay_access_token = fields.Char(string="Access Token", groups="base.group_system")
     kamipay_token_expiry = fields.Datetime(string="Token Expiry", groups="base.group_system")
+    kamipay_api_url = fields.Char(
+        string="API Base URL",
+        help="Overrides the KamiPay API of the provider's state, e.g. to target a local stand-in "
+             "server",
+        groups="base.group_system",
+    )
+    kamipay_pool_size = fields.Integer(
+        string="Connection Pool Size",
+        help="The maximum number of connections kept open to the KamiPay API by each worker",
+        default=const.DEFAULT_POOL_SIZE,
+    )
+    kamipay_keepalive = fields.Integer(
+        string="Keep-Alive (s)",
+        help="The number of seconds idle connections to the KamiPay API are kept before renewal",
+        default=const.DEFAULT_KEEPALIVE,
+    )
+    kamipay_max_retries = fields.Integer(
+        string="Max Retries",
+        help="The number of times a failed request to the KamiPay API is retried",
+        default=const.DEFAULT_MAX_RETRIES,
+    )
+    kamipay_retry_backoff = fields.Float(
+        string="Retry Backoff",
+        help="The backoff factor, in seconds, applied between retries",
+        default=const.DEFAULT_RETRY_BACKOFF,
+    )
 
     def _compute_feature_support_fields(self):
         super()._compute_feature_support_fields()
@@ -47,53 +94,247 @@ class PaymentProvider(models.Model):
             'support_manual_capture': None,
         })
 
+    @api.depends('code')
+    def _compute_kamipay_webhook_url(self):
+        for provider in self:
+            if provider.code == 'kamipay' and provider.id:
+                provider.kamipay_webhook_url = urls.url_join(
+                    provider.get_base_url(), f'{KamiPayController._webhook_url}/{provider.id}'
+                )
+            else:
+                provider.kamipay_webhook_url = False
+
+    def action_view_kamipay_settlements(self):
+        """ Open the settlement summary of the provider. """
+        self.ensure_one()
+        action = self.env['ir.actions.act_window']._for_xml_id(
+            'payment_kamipay.action_payment_kamipay_settlement'
+        )
+        action['context'] = {'search_default_provider_id': self.id}
+        return action
+
+    def _get_compatible_providers(self, *args, **kwargs):
+        """ Override of `payment` to hide the KamiPay providers while their API is unavailable.
+
+        Customers would otherwise pick KamiPay and wait for a charge that cannot be created.
+        """
+        providers = super()._get_compatible_providers(*args, **kwargs)
+        return providers.filtered(
+            lambda p: p.code != 'kamipay' or p._kamipay_is_available()
+        )
+
+    def _kamipay_is_available(self):
+        """ Return whether the KamiPay API of the provider is not known to be down by this worker.
+
+        Note: self.ensure_one()
+
+        :rtype: bool
+        """
+        self.ensure_one()
+        return self._kamipay_get_circuit_breaker().state != utils.CircuitBreaker.OPEN
+
+    def _kamipay_get_circuit_breaker(self):
+        """ Return the circuit breaker of this worker for the provider.
+
+        Each provider has its own circuit, so that the outage of one account, e.g. revoked
+        credentials or an unreachable custom API URL, does not take the others down.
+
+        Note: self.ensure_one()
+
+        :return: The circuit breaker
+        :rtype: CircuitBreaker
+        """
+        self.ensure_one()
+        return utils.get_circuit_breaker((self.env.cr.dbname, self.id), self.name)
+
+    def _kamipay_get_api_url(self):
+        """ Return the base URL of the KamiPay API for the provider's environment. """
+        self.ensure_one()
+        return self.sudo().kamipay_api_url or const.API_URLS[
+            'test' if self.state == 'test' else 'enabled'
+        ]
+
+    def _kamipay_get_session(self):
+        """ Return the pooled HTTP session of this worker for the provider.
+
+        Each provider has its own pool, so that the traffic of a provider cannot exhaust the
+        connections of the others.
+
+        Note: self.ensure_one()
+
+        :return: The pooled session
+        :rtype: requests.Session
+        """
+        self.ensure_one()
+        return utils.get_session(
+            (self.env.cr.dbname, self.id),
+            pool_size=self.kamipay_pool_size or const.DEFAULT_POOL_SIZE,
+            keepalive=self.kamipay_keepalive or const.DEFAULT_KEEPALIVE,
+            max_retries=max(self.kamipay_max_retries, 0),
+            retry_backoff=max(self.kamipay_retry_backoff, 0.0),
+        )
+
+    def write(self, values):
+        res = super().write(values)
+        if {'state', 'kamipay_api_key', 'kamipay_api_secret', 'kamipay_api_url'} & values.keys():
+            # Tokens obtained with the previous credentials or environment are no longer valid. The
+            # stored token is cleared, and the other workers drop their cached token as it no
+            # longer matches the stored one.
+            kamipay_providers = self.filtered(lambda p: p.code == 'kamipay')
+            kamipay_providers.sudo().write({
+                'kamipay_access_token': False,
+                'kamipay_token_expiry': False,
+            })
+            for provider in kamipay_providers:
+                utils.invalidate_token((self.env.cr.dbname, provider.id))
+        if {'state', 'code', 'kamipay_signature_key'} & values.keys():
+            utils.signature_keys_cache.pop(self.env.cr.dbname)
+        return res
+
+    @api.model
+    def _kamipay_get_signature_keys(self):
+        """ Return the webhook signature keys of the enabled KamiPay providers.
+
+        The keys are cached by the worker so that webhooks can be authenticated without querying
+        the database.
+
+        :return: The keys, as (provider id, encoded key, whether in test mode) tuples
+        :rtype: list
+        """
+        def load_keys():
+            providers = self.sudo().search([
+                ('code', '=', 'kamipay'),
+                ('state', '!=', 'disabled'),
+                ('kamipay_signature_key', '!=', False),
+            ])
+            return [
+                (provider.id, provider.kamipay_signature_key.encode(), provider.state == 'test')
+                for provider in providers
+            ]
+
+        return utils.signature_keys_cache.get_or_compute(self.env.cr.dbname, load_keys)
+
     def _get_kamipay_access_token(self):
-        """Get a valid access token for KamiPay API."""
+        """ Get a valid access token for KamiPay API.
+
+        The token is served from the cache of this worker and refreshed shortly before it expires,
+        or once the token stored on the provider no longer is the one cached, e.g. after a change
+        of credentials in another worker. Only one thread per worker and one worker per database
+        refresh it at a time; the others wait for the refresh and reuse its result.
+
+        Note: self.ensure_one()
+
+        :return: The access token
+        :rtype: str
+        """
         self.ensure_one()
 
-        # Check if we have a valid token
-        if self.kamipay_access_token and self.kamipay_token_expiry and self.kamipay_token_expiry > fields.Datetime.now():
-            return self.kamipay_access_token
+        cache_key = (self.env.cr.dbname, self.id)
+        stored_token = self.sudo().kamipay_access_token
+        token = utils.get_cached_token(cache_key, stored_token)
+        if token:
+            return token
 
-        # Get new token
-        base_url = 'https://api2.kamipay.io'
-        if self.state == 'test':
-            base_url = 'https://devnakamotoapi2.kamipay.io'
+        waiting_since = time.monotonic()
+        with utils.flight_lock(('token', cache_key)):
+            # Another thread may have refreshed it while this one waited
+            token = utils.get_cached_token(cache_key, stored_token, cached_after=waiting_since)
+            if not token:
+                token, expiry = self._kamipay_refresh_access_token()
+                utils.set_cached_token(cache_key, token, expiry)
+        if token != stored_token:
+            # The token was committed by another cursor, which the snapshot of the current
+            # transaction does not see: let its next calls read and match the new token
+            self.env.cache.set(self.sudo(), self._fields['kamipay_access_token'], token)
+        return token
 
-        auth_url = urls.url_join(base_url, '/auth/token')
+    def _kamipay_refresh_access_token(self):
+        """ Return the stored access token if still valid, or fetch and store a new one.
+
+        The refresh runs in a dedicated transaction holding an advisory lock on the provider, so
+        that concurrent workers do not all call the authentication endpoint nor contend on the
+        provider row. The row is only written when a new token is fetched, and committed right
+        away for the other workers to pick it up.
+
+        Note: self.ensure_one()
+
+        :return: The access token and its expiry date
+        :rtype: tuple
+        """
+        self.ensure_one()
+        with self.env.registry.cursor() as cr:
+            cr.execute(
+                'SELECT pg_advisory_xact_lock(%s, %s)', [const.TOKEN_REFRESH_LOCK_ID, self.id]
+            )
+            provider_sudo = self.with_env(self.env(cr=cr, su=True))
+            token = provider_sudo.kamipay_access_token
+            expiry = provider_sudo.kamipay_token_expiry
+            refresh_threshold = fields.Datetime.now() + timedelta(
+                seconds=const.TOKEN_REFRESH_MARGIN
+            )
+            if token and expiry and expiry > refresh_threshold:
+                return token, expiry  # Refreshed by another worker in the meantime
+
+            new_token, lifetime = provider_sudo._kamipay_fetch_access_token()
+            expiry = fields.Datetime.now() + timedelta(seconds=lifetime)
+            provider_sudo.write({
+                'kamipay_access_token': new_token,
+                'kamipay_token_expiry': expiry,
+            })
+            return new_token, expiry
+
+    def _kamipay_fetch_access_token(self):
+        """ Request a new access token from the KamiPay authentication endpoint.
+
+        Note: self.ensure_one()
+
+        :return: The access token and its lifetime in seconds
+        :rtype: tuple
+        :raise ValidationError: If the authentication fails
+        """
+        self.ensure_one()
+        auth_url = urls.url_join(self._kamipay_get_api_url(), '/auth/token')
         auth_data = {
             "username": self.kamipay_api_key,
             "password": self.kamipay_api_secret
         }
 
+        breaker = self._kamipay_get_circuit_breaker()
         try:
-            response = requests.post(auth_url, data=auth_data, timeout=10)
-            response.raise_for_status()
-            token_data = response.json()
-            
-            # Store the new token and set expiry (let's say 1 hour to be safe)
-            self.sudo().write({
-                'kamipay_access_token': token_data['access_token'],
-                'kamipay_token_expiry': fields.Datetime.now() + timedelta(hours=1)
-            })
-            return token_data['access_token']
+            with utils.log_operation(_logger, 'auth', provider=self.id), breaker.guard(), \
+                    metrics.track('kamipay_api_request_duration_seconds', endpoint='/auth/token'):
+                response = self._kamipay_get_session().post(
+                    auth_url, data=auth_data, timeout=const.DEFAULT_TIMEOUT
+                )
+                response.raise_for_status()
+                token_data = response.json()
+            metrics.inc('kamipay_api_requests_total', endpoint='/auth/token', outcome='ok')
+            metrics.inc('kamipay_token_refresh_total', outcome='ok')
+            # Fall back on 1 hour to be safe if the lifetime is not provided
+            lifetime = token_data.get('expires_in') or const.DEFAULT_TOKEN_LIFETIME
+            return token_data['access_token'], int(lifetime)
 
         except requests.exceptions.RequestException as e:
+            metrics.inc('kamipay_api_requests_total', endpoint='/auth/token', outcome='error')
+            metrics.inc(
+                'kamipay_api_errors_total', endpoint='/auth/token', kind=utils.get_error_kind(e)
+            )
+            metrics.inc('kamipay_token_refresh_total', outcome='error')
             _logger.error("KamiPay authentication failed: %s", e)
             raise ValidationError(_("Could not authenticate with KamiPay: %s", str(e)))
 
-    def _kamipay_make_request(self, endpoint, query_params=None, payload=None, method='POST'):
-        """ Make a request to KamiPay API.
-        
+    def _kamipay_prepare_request(self, endpoint):
+        """ Return everything needed to send a request to KamiPay API without using the ORM.
+
         Note: self.ensure_one()
+
+        :param str endpoint: The endpoint to reach, e.g. '/v2/status/tx_status'
+        :return: The URL, the authenticated headers and the pooled session
+        :rtype: tuple
         """
         self.ensure_one()
 
-        base_url = 'https://api2.kamipay.io'
-        if self.state == 'test':
-            base_url = 'https://devnakamotoapi2.kamipay.io'
-
-        url = urls.url_join(base_url, endpoint)
+        url = urls.url_join(self._kamipay_get_api_url(), endpoint)
         
         # Get valid access token
         access_token = self._get_kamipay_access_token()
@@ -102,27 +343,207 @@ class PaymentProvider(models.Model):
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         }
+        return url, headers, self._kamipay_get_session()
 
+    def _kamipay_make_request(self, endpoint, query_params=None, payload=None, method='POST'):
+        """ Make a request to KamiPay API.
+        
+        Note: self.ensure_one()
+        """
+        self.ensure_one()
+
+        url, headers, session = self._kamipay_prepare_request(endpoint)
+        utils.log_payload(
+            _logger,
+            f'request {method} {endpoint}',
+            query_params if method == 'GET' else payload,
+            sample_rate=utils.get_payload_sample_rate(self.env),
+        )
         try:
-            if method == 'GET':
-                response = requests.get(url, params=query_params, headers=headers, timeout=10)
-            else:
-                response = requests.post(url, json=payload, headers=headers, timeout=10)
-                
-            _logger.info(
-                "KamiPay API request to %s:\nMethod: %s\nParams: %s\nPayload: %s",
-                url, method, 
-                pprint.pformat(query_params) if query_params else None,
-                pprint.pformat(payload) if payload else None
-            )
-                
-            response.raise_for_status()
-            return response.json()
+            with utils.log_operation(_logger, 'api_request', endpoint=endpoint, method=method):
+                return utils.send_request(
+                    session,
+                    method,
+                    url,
+                    headers,
+                    query_params=query_params,
+                    payload=payload,
+                    circuit_breaker=self._kamipay_get_circuit_breaker(),
+                )
             
         except requests.exceptions.RequestException as e:
             _logger.error("KamiPay API request failed: %s", e)
             raise ValidationError(_("Could not connect to KamiPay: %s", str(e)))
+
+    def _kamipay_make_concurrent_requests(
+        self, endpoint, requests_data, method='POST', max_workers=const.DEFAULT_MAX_WORKERS
+    ):
+        """ Make several requests to the same KamiPay API endpoint with bounded concurrency.
+
+        The requests are sent from a thread pool sharing the pooled session of the provider; the
+        threads never use the ORM. Failed requests are logged and yield `None`.
+
+        Note: self.ensure_one()
+
+        :param str endpoint: The endpoint to reach, e.g. '/v2/status/tx_status'
+        :param list requests_data: The query parameters (GET) or payloads (POST) of the requests
+        :param str method: The HTTP method of the requests
+        :param int max_workers: The maximum number of requests sent at the same time
+        :return: The responses content, in the order of `requests_data`
+        :rtype: list
+        """
+        self.ensure_one()
+        if not requests_data:
+            return []
+
+        url, headers, session = self._kamipay_prepare_request(endpoint)
+        circuit_breaker = self._kamipay_get_circuit_breaker()
+        is_get = method == 'GET'
+
+        def send(data):
+            try:
+                return utils.send_request(
+                    session,
+                    method,
+                    url,
+                    headers,
+                    query_params=data if is_get else None,
+                    payload=None if is_get else data,
+                    circuit_breaker=circuit_breaker,
+                )
+            except requests.exceptions.RequestException as e:
+                _logger.warning("KamiPay API request to %s failed: %s", url, e)
+                return None
+
+        # Stay within the connection pool so that no connection is opened only to be discarded
+        max_workers = max(1, min(max_workers, self.kamipay_pool_size or const.DEFAULT_POOL_SIZE))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(send, requests_data))
         
+    def _kamipay_create_charge(self, amount, reference, expiry=const.CHARGE_EXPIRY):
+        """ Create a dynamic PIX charge in KamiPay, credited to the provider's wallet.
+
+        Note: self.ensure_one()
+
+        :param float amount: The amount of the charge, in BRL
+        :param str reference: The external reference of the charge
+        :param int expiry: The lifetime of the charge, in seconds
+        :return: The content of the charge creation response
+        :rtype: dict
+        """
+        self.ensure_one()
+        payload = self._kamipay_get_charge_payload(amount, reference, expiry)
+        with utils.log_operation(_logger, 'create_charge', reference=reference) as log_fields:
+            charge_response = self._kamipay_make_request(
+                '/v2/charge/create_dynamic_pix_b2b', 
+                payload=payload
+            )
+            log_fields['operation_id'] = charge_response.get('operation_id')
+
+        self._kamipay_update_quote(
+            amount, charge_response.get('amount_usdt'), charge_response.get('rate')
+        )
+        return charge_response
+
+    def _kamipay_get_charge_payload(self, amount, reference, expiry=const.CHARGE_EXPIRY):
+        """ Return the payload of the creation of a dynamic PIX charge.
+
+        Note: self.ensure_one()
+
+        :param float amount: The amount of the charge, in BRL
+        :param str reference: The external reference of the charge
+        :param int expiry: The lifetime of the charge, in seconds
+        :return: The payload
+        :rtype: dict
+        """
+        self.ensure_one()
+        return {
+            'address': self.kamipay_wallet_address,
+            'amount': amount,
+            'external_reference': reference,
+            'expire': expiry,
+        }
+
+    def _kamipay_get_quote(self):
+        """ Return the latest BRL/USDT quote of the provider.
+
+        KamiPay quotes the conversion when a charge is created. The quote of the latest charge is
+        kept in the memory of the worker for a short time, so that USDT estimates can be shown
+        without creating charges nor querying the database on every page view; a single thread
+        of the worker reloads it once expired. A quote older than `QUOTE_MAX_AGE`, e.g. after days
+        without any charge, no longer reflects the market and is not returned.
+
+        Note: self.ensure_one()
+
+        :return: The rate, the USDT amount per BRL and the quote date, or None if no recent quote
+                 exists
+        :rtype: dict
+        """
+        self.ensure_one()
+
+        def load_quote():
+            self.env.cr.execute("""
+                SELECT kamipay_rate, kamipay_usdt_amount / amount, create_date
+                  FROM payment_transaction
+                 WHERE provider_id = %s
+                   AND kamipay_operation_id IS NOT NULL
+                   AND kamipay_usdt_amount > 0
+                   AND amount > 0
+              ORDER BY id DESC
+                 LIMIT 1
+            """, [self.id])
+            row = self.env.cr.fetchone()
+            if not row:
+                return None
+            rate, usdt_per_brl, quote_date = row
+            return {'rate': rate, 'usdt_per_brl': usdt_per_brl, 'quote_date': quote_date}
+
+        quote = utils.quote_cache.get_or_compute((self.env.cr.dbname, self.id), load_quote)
+        max_age = timedelta(seconds=const.QUOTE_MAX_AGE)
+        if not quote or quote['quote_date'] < fields.Datetime.now() - max_age:
+            return None
+        return quote
+
+    def _kamipay_update_quote(self, amount, amount_usdt, rate):
+        """ Cache the quote of a charge that was just created.
+
+        Note: self.ensure_one()
+
+        :param float amount: The amount of the charge, in BRL
+        :param float amount_usdt: The USDT amount quoted by KamiPay
+        :param float rate: The exchange rate quoted by KamiPay
+        :return: None
+        """
+        self.ensure_one()
+        if not amount or not amount_usdt:
+            return
+        utils.quote_cache.set((self.env.cr.dbname, self.id), {
+            'rate': float(rate or 0.0),
+            'usdt_per_brl': float(amount_usdt) / amount,
+            'quote_date': fields.Datetime.now(),
+        })
+
+    def _kamipay_estimate_usdt(self, amount):
+        """ Estimate the USDT amount credited for a payment, based on the latest quote.
+
+        Note: self.ensure_one()
+
+        :param float amount: The amount to pay, in BRL
+        :return: The estimated USDT amount, the rate and the quote date, or None if no recent quote
+                 exists
+        :rtype: dict
+        """
+        self.ensure_one()
+        quote = self._kamipay_get_quote()
+        if not quote:
+            return None
+        return {
+            'amount': amount,
+            'amount_usdt': round(amount * quote['usdt_per_brl'], 2),
+            'rate': quote['rate'],
+            'quote_date': fields.Datetime.to_string(quote['quote_date']),
+        }
+
     def _get_redirect_form_view(self, is_validation=False):
         if self.code == 'kamipay':
             return self.redirect_form_view_id
@@ -1,54 +1,105 @@
+import functools
 import logging
-import pprint
+import threading
+import time
+from datetime import timedelta
+
 from odoo import _, fields, models
 from odoo.exceptions import ValidationError
 from odoo.http import request
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_kamipay import const, metrics, utils
 
 _logger = logging.getLogger(__name__)
 
 class PaymentTransaction(models.Model):
     _inherit = 'payment.transaction'
 
-    kamipay_operation_id = fields.Char('KamiPay Operation ID')
+    kamipay_operation_id = fields.Char('KamiPay Operation ID', copy=False)
     kamipay_usdt_amount = fields.Float('USDT Amount', digits='Product Price')
     kamipay_rate = fields.Float('Exchange Rate', digits=(12, 6))
     kamipay_emv = fields.Char('EMV Code')  # Add this field
+    kamipay_charge_state = fields.Selection(
+        string="KamiPay Charge State",
+        selection=[('queued', "Queued"), ('created', "Created"), ('failed', "Failed")],
+        copy=False,
+        readonly=True,
+    )
+    kamipay_charge_attempts = fields.Integer("KamiPay Charge Attempts", copy=False, readonly=True)
+    kamipay_charge_expiry = fields.Datetime("KamiPay Charge Expiry", copy=False, readonly=True)
+    kamipay_status = fields.Char("KamiPay Status", copy=False, readonly=True)
+
+    _sql_constraints = [
+        # The unique constraint also provides the index used by webhook lookups
+        ('kamipay_operation_id_uniq', 'unique(kamipay_operation_id)',
+         'The KamiPay operation ID must be unique.'),
+    ]
+
+    def _auto_init(self):
+        res = super()._auto_init()
+        # Status queries on KamiPay transactions filter on provider and state
+        create_index(
+            self._cr,
+            'payment_transaction_kamipay_provider_state_index',
+            self._table,
+            ['provider_id', 'state'],
+            where='kamipay_operation_id IS NOT NULL',
+        )
+        # The charge queue is drained by scanning the queued transactions only
+        create_index(
+            self._cr,
+            'payment_transaction_kamipay_charge_queue_index',
+            self._table,
+            ['id'],
+            where="kamipay_charge_state = 'queued'",
+        )
+        return res
 
     def _get_specific_rendering_values(self, processing_values):
-        _logger.info("--- Generating rendering values for KamiPay")
         res = super()._get_specific_rendering_values(processing_values)
         if self.provider_code != 'kamipay':
             return res
 
-        if not self.kamipay_operation_id:
-            self._create_kamipay_payment()
-
-        _logger.info("Generating rendering values for KamiPay transaction %s", self.reference)
+        with utils.log_operation(_logger, 'rendering_values', reference=self.reference):
+            self._kamipay_ensure_charge()
 
-        # Generate the redirect form HTML
-        template = request.env.ref('payment_kamipay.redirect_form')
-        values = {
-            'api_url': f'/payment/kamipay/qr/{self.id}',
-            'tx_id': self.id,
-            'reference': self.reference,
-        }
-        try:
+            # Generate the redirect form HTML
+            template = request.env.ref('payment_kamipay.redirect_form')
+            values = {
+                'api_url': f'/payment/kamipay/qr/{self.id}',
+                'tx_id': self.id,
+                'reference': self.reference,
+                'access_token': self._kamipay_get_access_token(),
+            }
             redirect_form_html = request.env['ir.qweb']._render(template.id, values)
-            _logger.info("Generated redirect form HTML: %s", redirect_form_html)
-        except Exception as e:
-            _logger.error("Error generating redirect form: %s", e)
-            raise
 
         rendering_values = {
             'api_url': f'/payment/kamipay/qr/{self.id}',
             'tx_id': self.id,
             'reference': self.reference,
+            'access_token': values['access_token'],
             'redirect_form_html': redirect_form_html,
         }
-        
-        _logger.info("Final rendering values: %s", rendering_values)
         return rendering_values
         
+    def _kamipay_get_access_token(self):
+        """ Return the access token granting the customer access to the public KamiPay routes of
+        the transaction.
+
+        The token is checked against the transaction id alone, so that requests for other
+        transactions are rejected without reading them.
+
+        Note: self.ensure_one()
+
+        :return: The access token
+        :rtype: str
+        """
+        self.ensure_one()
+        return payment_utils.generate_access_token(self.id)
+
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         tx = super()._get_tx_from_notification_data(provider_code, notification_data)
         if provider_code != 'kamipay':
@@ -60,88 +111,839 @@ class PaymentTransaction(models.Model):
                 "KamiPay: " + _("Received data with missing operation ID.")
             )
 
-        tx = self.search([('kamipay_operation_id', '=', operation_id), ('provider_code', '=', 'kamipay')])
+        # The caller may already have resolved the transaction (e.g. the webhook)
+        if len(self) == 1 and self.kamipay_operation_id == operation_id:
+            return self
+
+        tx = self._kamipay_get_tx_from_operation_id(operation_id)
         if not tx:
             raise ValidationError(
                 "KamiPay: " + _("No transaction found matching Operation ID %s.", operation_id)
             )
         return tx
 
+    def _kamipay_get_tx_from_operation_id(self, operation_id):
+        """ Return the KamiPay transaction matching the operation ID, using its unique index.
+
+        :param str operation_id: The KamiPay operation ID (``pix_id`` in notifications)
+        :return: The matching transaction, if any
+        :rtype: recordset of `payment.transaction`
+        """
+        if not operation_id:
+            return self.browse()
+        tx = self.search([('kamipay_operation_id', '=', operation_id)], limit=1)
+        return tx.filtered(lambda t: t.provider_code == 'kamipay')
+
+    def _kamipay_get_bus_channel(self):
+        """ Return the bus channel on which the updates of the transaction are pushed.
+
+        The channel embeds an access token so that it cannot be guessed from the transaction id.
+
+        Note: self.ensure_one()
+
+        :return: The channel name
+        :rtype: str
+        """
+        self.ensure_one()
+        return f'payment_kamipay_tx_{self.id}_{payment_utils.generate_access_token(self.id)}'
+
+    def _kamipay_notify_update(self):
+        """ Push the state and QR code of the transactions to the payment pages listening to them.
+
+        The states cached for the polling pages are dropped once the change is committed; until
+        then, the other transactions still read the previous state.
+
+        :return: None
+        """
+        for tx in self.filtered(lambda t: t.provider_code == 'kamipay'):
+            self.env.cr.postcommit.add(
+                functools.partial(utils.poll_state_cache.pop, (self.env.cr.dbname, tx.id))
+            )
+            self.env['bus.bus']._sendone(tx._kamipay_get_bus_channel(), 'payment_kamipay/tx_update', {
+                'tx_id': tx.id,
+                'state': tx.state,
+                'emv': tx.kamipay_emv,
+            })
+
+    def _update_state(self, allowed_states, target_state, state_message):
+        """ Override of `payment` to push the new state to the open KamiPay payment pages. """
+        txs_to_process = super()._update_state(allowed_states, target_state, state_message)
+        txs_to_process._kamipay_notify_update()
+        return txs_to_process
+
     def _process_notification_data(self, notification_data):
         super()._process_notification_data(notification_data)
         if self.provider_code != 'kamipay':
             return
 
         status = notification_data.get('status')
-        _logger.info("_process_notification_data status: %s", status)
-            
+        _logger.debug("_process_notification_data status: %s", status)
+        if self._kamipay_is_status_regression(status):
+            _logger.debug(
+                "Ignoring status %s of tx %s: already %s", status, self.reference, self.kamipay_status
+            )
+            return
+
+        # The status is only recorded once applied, so that a notification missing its data does
+        # not make the complete one look like a regression
         if status == 'processing':
             # Store additional transaction details if available 
             if notification_data.get('data'):
                 self.provider_reference = notification_data['data'].get('bank_txid')
                 state_message = _("Your PIX payment has been received and is being processed.")
                 self._set_pending(state_message=state_message)
+                self.kamipay_status = status
         elif status == 'done':
             # Store additional transaction details if available 
             if notification_data.get('data'):
                 self.provider_reference = notification_data['data'].get('bank_txid')
                 state_message = _("Your PIX payment has been confirmed.")
                 self._set_done(state_message=state_message)
+                self.kamipay_status = status
+                if self.state == 'done':
+                    self.env['payment.kamipay.settlement'].sudo()._add_transactions(self)
         elif status == 'expired':
             state_message = _("Payment expired after 10 minutes.")
             self._set_canceled(state_message=state_message)
+            self.kamipay_status = status
         elif status == 'failed':
             self._set_error(_("Payment failed"))
+            self.kamipay_status = status
         else:
             _logger.warning("Received data with invalid status: %s", status)
             self._set_error(_("Invalid payment status"))
             
-    def _create_kamipay_payment(self):
-        """ Create a payment request in KamiPay """
+    def _kamipay_is_status_regression(self, status):
+        """ Return whether a notified status does not progress from the last processed one.
+
+        This is the case of retried notifications and of notifications delivered out of order,
+        e.g. 'processing' arriving after 'done'.
+
+        Note: self.ensure_one()
+
+        :param str status: The notified status
+        :return: Whether the notification must be dropped
+        :rtype: bool
+        """
         self.ensure_one()
-        
-        _logger.info("KamiPay: Creating payment for tx %s", self.reference)
+        if self.state == 'done':
+            return True
+        rank = const.STATUS_RANK.get(status)
+        current_rank = const.STATUS_RANK.get(self.kamipay_status, 0)
+        return rank is not None and rank <= current_rank
 
-        payload = {
-            'address': self.provider_id.kamipay_wallet_address,
-            'amount': self.amount,
-            'external_reference': self.reference,
-            'expire': 600,  # 10 minutes expiry
-        }
+    def _kamipay_ensure_charge(self):
+        """ Make sure a KamiPay charge exists or is being created for the transaction.
+
+        If the provider creates charges asynchronously, the charge is queued and the QR code is
+        picked up by the payment page once available; otherwise it is created right away.
+
+        Note: self.ensure_one()
+
+        :return: None
+        """
+        self.ensure_one()
+        if self.kamipay_operation_id or self.kamipay_charge_state in ('queued', 'failed'):
+            return
+        if self._kamipay_reuse_charge():
+            return
+        if self.provider_id.kamipay_async_charge:
+            self._kamipay_enqueue_charge()
+        else:
+            self._create_kamipay_payment()
+
+    def _kamipay_reuse_charge(self):
+        """ Take over a still valid charge of the same amount, instead of creating a new one.
 
-        tx_response = self.provider_id._kamipay_make_request(
-            '/v2/charge/create_dynamic_pix_b2b', 
-            payload=payload
+        The charge is taken from a charge prepared ahead of the payment, or from a previous draft
+        transaction of the same customer for the same documents and amount, which is canceled.
+
+        Note: self.ensure_one()
+
+        :return: Whether a charge was reused
+        :rtype: bool
+        """
+        self.ensure_one()
+        prepared_charge = self.env['payment.kamipay.prepared.charge'].sudo()._find_reusable(
+            self.provider_id, self.amount, self.currency_id, self.partner_id
         )
-        
+        if prepared_charge:
+            self._kamipay_set_charge_values(
+                prepared_charge.operation_id,
+                prepared_charge.emv,
+                prepared_charge.rate,
+                prepared_charge.usdt_amount,
+                prepared_charge.expire_date,
+            )
+            prepared_charge.unlink()
+            return True
+
+        previous_tx = self._kamipay_get_reusable_tx()
+        if not previous_tx:
+            return False
+        charge_values = (
+            previous_tx.kamipay_operation_id,
+            previous_tx.kamipay_emv,
+            previous_tx.kamipay_rate,
+            previous_tx.kamipay_usdt_amount,
+            previous_tx.kamipay_charge_expiry,
+        )
+        # Release the operation ID first, it is unique
+        previous_tx.write({'kamipay_operation_id': False, 'kamipay_charge_state': False})
+        previous_tx.flush_recordset(['kamipay_operation_id'])
+        previous_tx._set_canceled(state_message=_("Replaced by transaction %s", self.reference))
+        self._kamipay_set_charge_values(*charge_values)
+        return True
+
+    def _kamipay_get_reusable_tx(self):
+        """ Return a previous draft transaction for the same payment, with a still valid charge.
+
+        The transactions paying the same orders or invoices are the same payment. Those linked to
+        no document may be distinct payments of the same amount, unless their references derive
+        from the same one: a payment link given the reference of a transaction, e.g. one whose
+        charge was created ahead by `_kamipay_create_charges`, creates transactions suffixed with
+        a sequence number from it, see `_compute_reference`.
+
+        Note: self.ensure_one()
+
+        :return: The transaction, if any
+        :rtype: recordset of `payment.transaction`
+        """
+        self.ensure_one()
+        document_fields = [name for name in ('sale_order_ids', 'invoice_ids') if name in self._fields]
+        if any(self[name] for name in document_fields):
+            reference_domain = []
+        else:
+            # The reference is only suffixed if the requested one is taken
+            base_reference = self._kamipay_get_base_reference()
+            if not base_reference or not self.search_count(
+                [('reference', '=', base_reference)], limit=1
+            ):
+                return self.browse()
+            reference_domain = [
+                '|',
+                ('reference', '=', base_reference),
+                ('reference', '=like', f'{base_reference}-%'),
+            ]
+
+        min_expiry = fields.Datetime.now() + timedelta(seconds=const.CHARGE_REUSE_MIN_VALIDITY)
+        candidates = self.search(reference_domain + [
+            ('id', '!=', self.id),
+            ('provider_id', '=', self.provider_id.id),
+            ('state', '=', 'draft'),
+            ('partner_id', '=', self.partner_id.id),
+            ('currency_id', '=', self.currency_id.id),
+            ('amount', '=', self.amount),
+            ('kamipay_operation_id', '!=', False),
+            ('kamipay_charge_expiry', '>', min_expiry),
+        ], order='id desc')
+        # The transactions must pay the same documents, or none derived from the same reference
+        return candidates.filtered(
+            lambda tx: all(tx[name] == self[name] for name in document_fields) and (
+                not reference_domain
+                or base_reference in (tx.reference, tx._kamipay_get_base_reference())
+            )
+        )[:1]
+
+    def _kamipay_get_base_reference(self):
+        """ Return the reference the transaction's reference was derived from, if any.
+
+        Transactions whose requested reference is already taken are given that reference suffixed
+        with a sequence number, e.g. 'S00042-2' for 'S00042'.
+
+        Note: self.ensure_one()
+
+        :return: The base reference, or None if the reference has no sequence number
+        :rtype: str
+        """
+        self.ensure_one()
+        base_reference, _separator, sequence = self.reference.rpartition('-')
+        return base_reference if base_reference and sequence.isdigit() else None
+
+    def _kamipay_get_charge_expires_in(self):
+        """ Return the number of seconds left before the charge of the transaction expires.
+
+        Note: self.ensure_one()
+
+        :return: The seconds left, or the default validity if the charge is not created yet
+        :rtype: int
+        """
+        self.ensure_one()
+        if not self.kamipay_charge_expiry:
+            return const.CHARGE_EXPIRY
+        return max(0, int((self.kamipay_charge_expiry - fields.Datetime.now()).total_seconds()))
+
+    def _kamipay_set_charge_values(self, operation_id, emv, rate, usdt_amount, expiry):
+        """ Store the charge of the transaction and push its QR code to the payment page.
+
+        Note: self.ensure_one()
+
+        :return: None
+        """
+        self.ensure_one()
         self.write({
-            'kamipay_operation_id': tx_response.get('operation_id'),
-            'kamipay_usdt_amount': tx_response.get('amount_usdt'),
-            'kamipay_rate': tx_response.get('rate'),
-            'kamipay_emv': tx_response.get('emv'),  # Store the EMV code
+            'kamipay_operation_id': operation_id,
+            'kamipay_usdt_amount': usdt_amount,
+            'kamipay_rate': rate,
+            'kamipay_emv': emv,  # Store the EMV code
+            'kamipay_charge_state': 'created',
+            'kamipay_charge_expiry': expiry,
         })
+        self._kamipay_notify_update()
 
-        return tx_response
+    def _kamipay_enqueue_charge(self):
+        """ Queue the creation of the KamiPay charges and wake up the cron creating them.
 
-    def _finalize_post_processing(self):
-        """Finalize KamiPay payment post-processing"""
-        super()._finalize_post_processing()
-        if self.provider_code != 'kamipay':
+        :return: None
+        """
+        self.write({'kamipay_charge_state': 'queued'})
+        self.env.ref('payment_kamipay.cron_create_charges')._trigger()
+
+    def _cron_kamipay_create_charges(self, limit=const.CHARGE_QUEUE_BATCH_SIZE):
+        """ Create the KamiPay charges of the queued transactions.
+
+        Each transaction is locked with `SKIP LOCKED` and committed on its own, so that several
+        cron workers can drain the queue in parallel and a slow charge does not hold the others.
+
+        :param int limit: The maximum number of charges to create in this run
+        :return: None
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        processed_ids = [0]
+        for _i in range(limit):
+            self.env.cr.execute("""
+                SELECT id
+                  FROM payment_transaction
+                 WHERE kamipay_charge_state = 'queued'
+                   AND id != ALL(%s)
+              ORDER BY id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+            """, [processed_ids])
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+
+            tx = self.browse(row[0])
+            processed_ids.append(tx.id)
+            try:
+                with self.env.cr.savepoint():
+                    tx._create_kamipay_payment()
+            except Exception as error:
+                _logger.warning("KamiPay: Could not create charge for tx %s: %s", tx.reference, error)
+                tx._kamipay_handle_charge_failure(error)
+            if auto_commit:
+                self.env.cr.commit()
+        else:
+            # The batch is exhausted but charges may still be queued
+            self.env.ref('payment_kamipay.cron_create_charges')._trigger()
+
+    def _kamipay_handle_charge_failure(self, error):
+        """ Requeue the charge creation, or put the transaction in error after too many attempts.
+
+        Note: self.ensure_one()
+
+        :param Exception error: The error raised while creating the charge
+        :return: None
+        """
+        self.ensure_one()
+        attempts = self.kamipay_charge_attempts + 1
+        if attempts < const.CHARGE_MAX_ATTEMPTS:
+            self.kamipay_charge_attempts = attempts
             return
+        self.write({'kamipay_charge_state': 'failed', 'kamipay_charge_attempts': attempts})
+        self._set_error(_("Could not create the PIX charge: %s", error))
 
-        if self.state == 'done':
-            # The payment is confirmed, proceed with order confirmation 
-            if hasattr(self, 'sale_order_ids'):
-                # Add logging to track order states
-                _logger.info(
-                    "Processing order confirmation for transaction %s. Order states: %s",
-                    self.reference,
-                    {so.name: so.state for so in self.sale_order_ids}
+    def _kamipay_get_status_query_params(self):
+        """ Return the query parameters of the KamiPay status request of the transaction.
+
+        Note: self.ensure_one()
+
+        :return: The query parameters
+        :rtype: dict
+        """
+        self.ensure_one()
+        return {
+            'target': 'operation_id',
+            'type': 'charge',
+            'id': self.kamipay_operation_id,
+            'chain': 'polygon'
+        }
+
+    def _kamipay_get_status_notification_data(self, status_response):
+        """ Convert a KamiPay status response into notification data.
+
+        Note: self.ensure_one()
+
+        :param dict status_response: The content of the status response
+        :return: The notification data, or None if the status could not be retrieved
+        :rtype: dict
+        """
+        self.ensure_one()
+        if not status_response or status_response.get('status') != 'ok':
+            return None
+        status_data = status_response.get('data') or {}
+        return {
+            'pix_id': self.kamipay_operation_id,
+            'status': status_data.get('status', 'error'),
+            'external_reference': self.reference,
+            'data': status_data
+        }
+
+    def _kamipay_fetch_status(self):
+        """ Fetch the status of the transaction's charge from KamiPay.
+
+        The concurrent checks of a charge within the worker share a single request, whose response
+        is reused for `STATUS_CACHE_TTL` seconds, or for good once the status is final.
+
+        Note: self.ensure_one()
+
+        :return: The content of the status response
+        :rtype: dict
+        """
+        self.ensure_one()
+        provider = self.provider_id
+        return utils.status_cache.get_or_compute(
+            (self.env.cr.dbname, provider.id, self.kamipay_operation_id),
+            lambda: provider._kamipay_make_request(
+                '/v2/status/tx_status',
+                query_params=self._kamipay_get_status_query_params(),
+                method='GET',
+            ),
+            ttl=utils.get_status_ttl,
+        )
+
+    def _kamipay_process_status_response(self, status_response):
+        """ Process a status response of KamiPay if it makes the transaction progress.
+
+        Statuses still waiting for the payment and statuses already processed, e.g. by another
+        check sharing the same response, are ignored without writing on the transaction.
+
+        Note: self.ensure_one()
+
+        :param dict status_response: The content of the status response
+        :return: None
+        """
+        self.ensure_one()
+        notification_data = self._kamipay_get_status_notification_data(status_response)
+        if (
+            not notification_data
+            or notification_data['status'] not in const.STATUS_HANDLED
+            or self._kamipay_is_status_regression(notification_data['status'])
+        ):
+            return
+        self._handle_notification_data('kamipay', notification_data)
+
+    def _cron_kamipay_reconcile_status(
+        self,
+        max_age_hours=const.RECONCILE_MAX_AGE_HOURS,
+        batch_size=100,
+        max_workers=const.DEFAULT_MAX_WORKERS,
+    ):
+        """ Fetch the status of the pending KamiPay transactions and process the changes.
+
+        This recovers the transactions whose webhook was lost. The statuses of each batch are
+        fetched concurrently, then processed and committed together.
+
+        :param int max_age_hours: Only reconcile transactions created within this many hours
+        :param int batch_size: The number of transactions processed and committed together
+        :param int max_workers: The maximum number of status requests sent at the same time
+        :return: None
+        """
+        start = time.monotonic()
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        providers = self.env['payment.provider'].search([('code', '=', 'kamipay')])
+        txs = self.search([
+            ('provider_id', 'in', providers.ids),
+            ('state', 'in', ('draft', 'pending')),
+            ('kamipay_operation_id', '!=', False),
+            ('create_date', '>=', fields.Datetime.now() - timedelta(hours=max_age_hours)),
+        ], order='id')
+
+        updated_count = 0
+        for tx_ids in split_every(batch_size, txs.ids):
+            batch_txs = self.browse(tx_ids)
+            for provider in batch_txs.provider_id:
+                provider_txs = batch_txs.filtered(lambda tx: tx.provider_id == provider)
+                responses = provider._kamipay_make_concurrent_requests(
+                    '/v2/status/tx_status',
+                    [tx._kamipay_get_status_query_params() for tx in provider_txs],
+                    method='GET',
+                    max_workers=max_workers,
                 )
-                
-                # Only try to confirm orders that are in draft/sent state
-                orders_to_confirm = self.sale_order_ids.filtered(
-                    lambda so: so.state in ['draft', 'sent']
+                for tx, response in zip(provider_txs, responses):
+                    notification_data = tx._kamipay_get_status_notification_data(response)
+                    if not notification_data:
+                        continue
+                    if notification_data['status'] not in const.STATUS_HANDLED:
+                        continue  # The charge is still waiting for the payment
+                    try:
+                        with self.env.cr.savepoint():
+                            tx._handle_notification_data('kamipay', notification_data)
+                        updated_count += 1
+                    except Exception as error:
+                        _logger.warning(
+                            "KamiPay: Could not reconcile tx %s: %s", tx.reference, error
+                        )
+            if auto_commit:
+                self.env.cr.commit()
+
+        elapsed = time.monotonic() - start
+        _logger.info(
+            "KamiPay: Reconciled %d transactions (%d updated) in %.2fs (%.1f tx/s)",
+            len(txs), updated_count, elapsed, len(txs) / elapsed if elapsed else 0.0,
+        )
+
+    def _cron_kamipay_expire_charges(
+        self, batch_size=200, max_workers=const.DEFAULT_MAX_WORKERS
+    ):
+        """ Cancel the draft KamiPay transactions whose charge expired without being paid.
+
+        The candidates are selected and locked by batches. The charges that expired recently may
+        still have been paid right before their expiry, and those of the transactions older than
+        the reconciliation window were not necessarily polled by the reconciliation cron: their
+        status is verified with KamiPay first. The others have already been checked by the
+        reconciliation cron after their expiry, and are canceled without any request.
+
+        :param int batch_size: The number of transactions canceled and committed together
+        :param int max_workers: The maximum number of status requests sent at the same time
+        :return: None
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        providers = self.env['payment.provider'].search([('code', '=', 'kamipay')])
+        if not providers:
+            return
+
+        self.flush_model(['provider_id', 'state', 'kamipay_operation_id', 'kamipay_charge_expiry'])
+        now = fields.Datetime.now()
+        verify_after = now - timedelta(seconds=const.CHARGE_SETTLEMENT_WINDOW)
+        reconciled_after = now - timedelta(hours=const.RECONCILE_MAX_AGE_HOURS)
+        canceled_count = 0
+        last_id = 0
+        while True:
+            # Transactions created before the expiry was stored expire with their default window
+            self.env.cr.execute("""
+                SELECT id,
+                       COALESCE(
+                           kamipay_charge_expiry, create_date + make_interval(secs => %(expiry)s)
+                       ) >= %(verify_after)s
+                       OR create_date < %(reconciled_after)s
+                  FROM payment_transaction
+                 WHERE provider_id IN %(provider_ids)s
+                   AND state = 'draft'
+                   AND kamipay_operation_id IS NOT NULL
+                   AND COALESCE(
+                           kamipay_charge_expiry, create_date + make_interval(secs => %(expiry)s)
+                       ) < %(now)s
+                   AND id > %(last_id)s
+              ORDER BY id
+                 LIMIT %(limit)s
+                   FOR UPDATE SKIP LOCKED
+            """, {
+                'expiry': const.CHARGE_EXPIRY,
+                'verify_after': verify_after,
+                'reconciled_after': reconciled_after,
+                'provider_ids': tuple(providers.ids),
+                'now': now,
+                'last_id': last_id,
+                'limit': batch_size,
+            })
+            rows = self.env.cr.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            txs_to_cancel = self.browse(tx_id for tx_id, must_verify in rows if not must_verify)
+            txs_to_verify = self.browse(tx_id for tx_id, must_verify in rows if must_verify)
+            txs_to_cancel |= txs_to_verify._kamipay_get_unpaid_txs(max_workers)
+            txs_to_cancel._set_canceled(
+                state_message=_("The PIX charge expired before being paid.")
+            )
+            canceled_count += len(txs_to_cancel)
+            if auto_commit:
+                self.env.cr.commit()
+
+        _logger.info("KamiPay: Canceled %d transactions with an expired charge", canceled_count)
+
+    def _kamipay_get_unpaid_txs(self, max_workers=const.DEFAULT_MAX_WORKERS):
+        """ Fetch the status of the charges and return the transactions that were not paid.
+
+        The transactions whose charge progressed are processed on the way. Those whose status
+        could not be fetched are neither processed nor returned, to be verified again later.
+
+        :param int max_workers: The maximum number of status requests sent at the same time
+        :return: The transactions whose charge was not paid
+        :rtype: recordset of `payment.transaction`
+        """
+        unpaid_txs = self.browse()
+        for provider in self.provider_id:
+            provider_txs = self.filtered(lambda tx: tx.provider_id == provider)
+            responses = provider._kamipay_make_concurrent_requests(
+                '/v2/status/tx_status',
+                [tx._kamipay_get_status_query_params() for tx in provider_txs],
+                method='GET',
+                max_workers=max_workers,
+            )
+            for tx, response in zip(provider_txs, responses):
+                notification_data = tx._kamipay_get_status_notification_data(response)
+                if not notification_data:
+                    continue
+                if notification_data['status'] not in const.STATUS_HANDLED:
+                    unpaid_txs |= tx  # The charge is still waiting for a payment that won't come
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        tx._handle_notification_data('kamipay', notification_data)
+                except Exception as error:
+                    _logger.warning(
+                        "KamiPay: Could not process the status of tx %s: %s", tx.reference, error
+                    )
+        return unpaid_txs
+
+    def _create_kamipay_payment(self):
+        """ Create a payment request in KamiPay """
+        self.ensure_one()
+
+        # Keep the longer lifetime chosen for a charge requested ahead of the payment, see
+        # `_kamipay_create_charges`
+        now = fields.Datetime.now()
+        expiry_date = max(
+            self.kamipay_charge_expiry or now, now + timedelta(seconds=const.CHARGE_EXPIRY)
+        )
+        tx_response = self.provider_id._kamipay_create_charge(
+            self.amount, self.reference, expiry=int((expiry_date - now).total_seconds())
+        )
+        self._kamipay_set_charge_values(
+            tx_response.get('operation_id'),
+            tx_response.get('emv'),
+            tx_response.get('rate'),
+            tx_response.get('amount_usdt'),
+            expiry_date,
+        )
+
+        return tx_response
+
+    def action_kamipay_create_charges(self, expiry=const.CHARGE_EXPIRY):
+        """ Create the KamiPay charges of the selected transactions ahead of their payment page.
+
+        :param int expiry: The lifetime of the charges, in seconds
+        :return: The notification of the outcome
+        :rtype: dict
+        """
+        created_count, queued_count = self._kamipay_create_charges(expiry=expiry)
+        message = _("%(count)s PIX charges created.", count=created_count)
+        if queued_count:
+            message = "%s %s" % (message, _(
+                "%(count)s charges could not be created and were queued to be retried.",
+                count=queued_count,
+            ))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'message': message,
+                'type': 'warning' if queued_count else 'success',
+                'sticky': False,
+            },
+        }
+
+    def _kamipay_create_charges(
+        self, max_workers=const.DEFAULT_MAX_WORKERS, expiry=const.CHARGE_EXPIRY
+    ):
+        """ Create the KamiPay charges of many transactions at once, e.g. for a billing campaign.
+
+        The draft transactions without a charge are locked with `SKIP LOCKED` so that the charge
+        cron does not create theirs at the same time. Their charges are requested concurrently for
+        each provider, and stored with a single query. The transactions whose charge could not be
+        created are queued, to be retried by the charge cron with the same expiry date.
+
+        :param int max_workers: The maximum number of charge requests sent at the same time
+        :param int expiry: The lifetime of the charges, in seconds
+        :return: The number of charges created and the number of transactions queued
+        :rtype: tuple
+        """
+        kamipay_txs = self.filtered(lambda tx: tx.provider_code == 'kamipay')
+        if not kamipay_txs:
+            return 0, 0
+
+        self.flush_model(['state', 'kamipay_operation_id', 'kamipay_charge_state'])
+        self.env.cr.execute("""
+            SELECT id
+              FROM payment_transaction
+             WHERE id IN %s
+               AND state = 'draft'
+               AND kamipay_operation_id IS NULL
+               AND kamipay_charge_state IS DISTINCT FROM 'failed'
+          ORDER BY id
+               FOR UPDATE SKIP LOCKED
+        """, [tuple(kamipay_txs.ids)])
+        txs = self.browse(row[0] for row in self.env.cr.fetchall())
+
+        start = time.monotonic()
+        expiry_date = fields.Datetime.now() + timedelta(seconds=expiry)
+        charge_rows = []
+        failed_txs = self.browse()
+        for provider in txs.provider_id:
+            provider_txs = txs.filtered(lambda tx: tx.provider_id == provider)
+            responses = provider._kamipay_make_concurrent_requests(
+                '/v2/charge/create_dynamic_pix_b2b',
+                [
+                    provider._kamipay_get_charge_payload(tx.amount, tx.reference, expiry)
+                    for tx in provider_txs
+                ],
+                max_workers=max_workers,
+            )
+            for tx, response in zip(provider_txs, responses):
+                if not response or not response.get('operation_id'):
+                    failed_txs |= tx
+                    continue
+                charge_rows.append((
+                    tx.id,
+                    response['operation_id'],
+                    response.get('emv'),
+                    response.get('rate'),
+                    response.get('amount_usdt'),
+                ))
+                provider._kamipay_update_quote(
+                    tx.amount, response.get('amount_usdt'), response.get('rate')
                 )
-                if orders_to_confirm:
-                    orders_to_confirm.action_confirm()
\ No newline at end of file
+
+        created_txs = self.browse(row[0] for row in charge_rows)
+        if charge_rows:
+            self.env.cr.execute("""
+                UPDATE payment_transaction tx
+                   SET kamipay_operation_id = charge.operation_id,
+                       kamipay_emv = charge.emv,
+                       kamipay_rate = charge.rate::numeric,
+                       kamipay_usdt_amount = charge.usdt_amount::numeric,
+                       kamipay_charge_state = 'created',
+                       kamipay_charge_expiry = %%s,
+                       write_uid = %%s,
+                       write_date = (now() at time zone 'UTC')
+                  FROM (VALUES %s) AS charge(id, operation_id, emv, rate, usdt_amount)
+                 WHERE tx.id = charge.id
+            """ % ', '.join(['(%s, %s, %s, %s, %s)'] * len(charge_rows)), [
+                expiry_date, self.env.uid, *(value for row in charge_rows for value in row)
+            ])
+            created_txs.invalidate_recordset([
+                'kamipay_operation_id', 'kamipay_emv', 'kamipay_rate', 'kamipay_usdt_amount',
+                'kamipay_charge_state', 'kamipay_charge_expiry', 'write_uid', 'write_date',
+            ])
+            created_txs._kamipay_notify_update()
+        if failed_txs:
+            failed_txs.kamipay_charge_expiry = expiry_date
+            failed_txs._kamipay_enqueue_charge()
+
+        _logger.info(
+            "KamiPay: Created %d charges (%d queued after a failure) in %.2fs",
+            len(created_txs), len(failed_txs), time.monotonic() - start,
+        )
+        return len(created_txs), len(failed_txs)
+
+    def _cron_kamipay_finalize_post_processing(self, batch_size=100, chunk_size=50):
+        """ Post-process the done KamiPay transactions in batches.
+
+        Unlike the generic post-processing cron, which handles transactions one by one, the orders
+        of a whole batch are confirmed together, see `_kamipay_confirm_orders`.
+
+        :param int batch_size: The number of transactions post-processed and committed together
+        :param int chunk_size: The number of orders confirmed in a single call
+        :return: None
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        providers = self.env['payment.provider'].search([('code', '=', 'kamipay')])
+        txs = self.search([
+            ('provider_id', 'in', providers.ids),
+            ('state', '=', 'done'),
+            ('is_post_processed', '=', False),
+        ], order='id')
+        for tx_ids in split_every(batch_size, txs.ids):
+            # Skip the transactions being post-processed elsewhere, e.g. by the status page
+            self.env.cr.execute("""
+                SELECT id FROM payment_transaction WHERE id IN %s FOR UPDATE SKIP LOCKED
+            """, [tuple(tx_ids)])
+            batch_txs = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not batch_txs:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    batch_txs.with_context(
+                        kamipay_order_chunk_size=chunk_size
+                    )._finalize_post_processing()
+            except Exception:
+                # Isolate the failing transactions
+                for tx in batch_txs:
+                    try:
+                        with self.env.cr.savepoint():
+                            tx._finalize_post_processing()
+                    except Exception as error:
+                        _logger.warning(
+                            "KamiPay: Could not post-process tx %s: %s", tx.reference, error
+                        )
+            if auto_commit:
+                self.env.cr.commit()
+
+    def _finalize_post_processing(self):
+        """ Override of `payment` to confirm the orders of the KamiPay transactions in chunks.
+
+        When `sale` is installed, it confirms the order of each transaction with its own
+        `action_confirm` while the transactions are post-processed. The orders of the done KamiPay
+        transactions are confirmed together beforehand, see `_kamipay_confirm_orders`; `sale` then
+        skips them as they are no longer quotations.
+
+        This overrides a method of `payment` rather than of `sale`, which this module does not
+        depend on: the override is always called, whatever the order in which the modules load.
+        """
+        if 'sale_order_ids' in self._fields:
+            self.filtered(
+                lambda tx: tx.provider_code == 'kamipay'
+                and tx.state == 'done'
+                and tx.operation != 'validation'
+            )._kamipay_confirm_orders()
+        return super()._finalize_post_processing()
+
+    def _kamipay_confirm_orders(self):
+        """ Confirm the quotations paid by the transactions, in chunks.
+
+        As in `sale`, a transaction only confirms its quotation if it is linked to no other order
+        and the confirmation amount of the quotation is reached. The quotations of all the
+        transactions are then confirmed with one `action_confirm` call per chunk rather than one
+        per transaction. If a chunk fails, its quotations are confirmed one by one so that a
+        failing order does not block the others.
+
+        The chunk size is read from the `kamipay_order_chunk_size` context key.
+
+        :return: The confirmed orders
+        :rtype: recordset of `sale.order`
+        """
+        # Reading the orders of the whole recordset prefetches them at once
+        quotations = self.sale_order_ids.browse()
+        for tx in self:
+            if len(tx.sale_order_ids) == 1:
+                quotation = tx.sale_order_ids.filtered(lambda so: so.state in ('draft', 'sent'))
+                if quotation and quotation._is_confirmation_amount_reached():
+                    quotations |= quotation
+        confirmed_orders = quotations.browse()
+        if not quotations:
+            return confirmed_orders
+
+        _logger.debug("Confirming %d orders paid with KamiPay", len(quotations))
+        chunk_size = self.env.context.get('kamipay_order_chunk_size', const.ORDER_CHUNK_SIZE)
+        quotations = quotations.with_context(send_email=True)
+        for chunk in split_every(chunk_size, quotations.ids, quotations.browse):
+            try:
+                with metrics.track('kamipay_order_confirmation_duration_seconds'), \
+                        self.env.cr.savepoint():
+                    chunk.action_confirm()
+                confirmed_orders |= chunk
+            except Exception:
+                for order in chunk:
+                    try:
+                        with self.env.cr.savepoint():
+                            order.action_confirm()
+                        confirmed_orders |= order
+                    except Exception as error:
+                        _logger.warning(
+                            "KamiPay: Could not confirm order %s: %s", order.name, error
+                        )
+        return confirmed_orders
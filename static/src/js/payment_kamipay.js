@@ -51,8 +51,11 @@ publicWidget.registry.KamiPayQRStatus = publicWidget.Widget.extend({
     selector: '.kamipay-qr-container',
 
     // Constants
-    QR_EXPIRY_MS: 600 * 1000,  // 10 minute expiry
+    QR_EXPIRY_MS: 600 * 1000,  // 10 minute expiry, unless the charge states otherwise
+    MAX_TIMEOUT_MS: 2 ** 31 - 1,  // Longer timeouts fire right away
     POLLING_INTERVAL: 5000,    // Check every 5 seconds
+    FALLBACK_POLLING_INTERVAL: 60000,  // Check every minute when updates are pushed on the bus
+    BUS_NOTIFICATION_TYPE: 'payment_kamipay/tx_update',
     DRAFT_STATE: 'draft',
 
     start: async function () {
@@ -61,6 +64,12 @@ publicWidget.registry.KamiPayQRStatus = publicWidget.Widget.extend({
         this.notification = this.bindService("notification");
         this.txId = this.el.dataset.txId;
         this.reference = this.el.dataset.reference;
+        this.busChannel = this.el.dataset.busChannel;
+        this.accessToken = this.el.dataset.accessToken;
+        const expiresIn = parseInt(this.el.dataset.expiresIn);
+        this.expiryMs = Number.isNaN(expiresIn)
+            ? this.QR_EXPIRY_MS
+            : Math.min(expiresIn * 1000, this.MAX_TIMEOUT_MS);
         
         if (this.txId) {
             this._startTimers();
@@ -71,49 +80,109 @@ publicWidget.registry.KamiPayQRStatus = publicWidget.Widget.extend({
         // Start expiry timer
         this.expiryTimeout = setTimeout(() => {
             this._handleExpiry();
-        }, this.QR_EXPIRY_MS);
+        }, this.expiryMs);
+
+        // Listen to pushed updates, and only poll as a fallback if they are available
+        const pollingInterval = this._subscribeToUpdates()
+            ? this.FALLBACK_POLLING_INTERVAL
+            : this.POLLING_INTERVAL;
 
         // Start polling for status changes
         this.pollingInterval = setInterval(() => {
             this._checkTransactionStatus();
-        }, this.POLLING_INTERVAL);
+        }, pollingInterval);
+    },
+
+    /**
+     * Subscribe to the updates of the transaction pushed on the bus.
+     *
+     * @private
+     * @return {boolean} Whether the subscription succeeded
+     */
+    _subscribeToUpdates() {
+        if (!this.busChannel) {
+            return false;
+        }
+        try {
+            this.busService = this.bindService("bus_service");
+            this._onBusNotification = this._onBusNotification.bind(this);
+            this.busService.addChannel(this.busChannel);
+            this.busService.subscribe(this.BUS_NOTIFICATION_TYPE, this._onBusNotification);
+            return true;
+        } catch (error) {
+            console.warn('KamiPay: Bus unavailable, falling back to polling:', error);
+            this.busService = null;
+            return false;
+        }
+    },
+
+    _onBusNotification(payload) {
+        if (payload && String(payload.tx_id) === String(this.txId)) {
+            this._applyUpdate(payload);
+        }
     },
 
     async _checkTransactionStatus() {
 		try {
-			const response = await this.rpc(`/payment/kamipay/poll/${this.txId}`, {});
-			
-			if (response && response.state && response.state !== 'draft') {
-				// Transaction state has changed, redirect to status page
-				this._cleanup();
-				window.location = '/payment/status';
+			const params = new URLSearchParams({ access_token: this.accessToken });
+			const response = await fetch(`/payment/kamipay/poll/${this.txId}/state?${params}`, {
+				// Revalidate the last state with its ETag: unchanged states are not sent again
+				cache: 'no-cache',
+				credentials: 'same-origin',
+			});
+			if (!response.ok) {
+				throw new Error(`HTTP ${response.status}`);
 			}
+			this._applyUpdate(await response.json());
 		} catch (error) {
 			console.error('Error checking local transaction status:', error);
 		}
 	},
 
-    async _handleExpiry() {
-        try {
-            // Do one final status check before expiring
-            const statusData = await this.rpc('/payment/kamipay/status', {
-                tx_id: this.txId
-            });
+    /**
+     * Display the QR code once available and leave the page once the transaction state changed.
+     *
+     * @private
+     * @param {Object} update - The state and EMV of the transaction
+     */
+    _applyUpdate(update) {
+        if (update && update.emv) {
+            this._showQRCode();
+        }
 
-            if (statusData.status === 'ok' && 
-                statusData.data && 
-                statusData.data.status !== this.DRAFT_STATE) {
-                window.location = '/payment/status';
-                return;
-            }
-            
-            // If still in draft state, mark as expired
-            window.location = `/payment/kamipay/return?expired=1&reference=${this.reference}`;
+        if (update && update.state && update.state !== this.DRAFT_STATE) {
+            // Transaction state has changed, redirect to status page
+            this._cleanup();
+            window.location = '/payment/status';
+        }
+    },
 
-        } catch (error) {
-            console.error('Error handling expiry:', error);
-            window.location = '/shop/payment';
+    /**
+     * Replace the placeholder by the QR code once the charge has been created in the background.
+     *
+     * @private
+     */
+    _showQRCode() {
+        const placeholder = this.el.querySelector('.kamipay-qr-placeholder');
+        const image = this.el.querySelector('.kamipay-qr-image');
+        if (!placeholder || !image) {
+            return;
         }
+        const params = new URLSearchParams({ access_token: this.accessToken });
+        image.src = `/payment/kamipay/qr/${this.txId}/image?${params}`;
+        image.classList.remove('d-none');
+        placeholder.remove();
+    },
+
+    /**
+     * Leave the QR page once the charge expired. The transaction is canceled on the server by the
+     * expiry cron, which the status page picks up.
+     *
+     * @private
+     */
+    _handleExpiry() {
+        this._cleanup();
+        window.location = '/payment/status';
     },
 
     _cleanup() {
@@ -125,6 +194,11 @@ publicWidget.registry.KamiPayQRStatus = publicWidget.Widget.extend({
             clearInterval(this.pollingInterval);
             this.pollingInterval = null;
         }
+        if (this.busService) {
+            this.busService.unsubscribe(this.BUS_NOTIFICATION_TYPE, this._onBusNotification);
+            this.busService.deleteChannel(this.busChannel);
+            this.busService = null;
+        }
     },
 
     destroy() {
@@ -133,7 +207,59 @@ publicWidget.registry.KamiPayQRStatus = publicWidget.Widget.extend({
     },
 });
 
+// Prepare a charge while the customer is still on the payment form, so that the QR code is ready
+// when they click on Pay
+publicWidget.registry.KamiPayChargePreparation = publicWidget.Widget.extend({
+    selector: '#o_payment_form',
+    events: {
+        'change input[name="o_payment_radio"]': '_onChangePaymentOption',
+    },
+
+    start: async function () {
+        await this._super(...arguments);
+        this.rpc = this.bindService("rpc");
+        this.isPrepared = false;
+        const checkedRadio = this.el.querySelector('input[name="o_payment_radio"]:checked');
+        if (checkedRadio) {
+            this._prepareCharge(checkedRadio);
+        }
+    },
+
+    _onChangePaymentOption(ev) {
+        this._prepareCharge(ev.currentTarget);
+    },
+
+    /**
+     * Ask the server to create a charge in the background if KamiPay is selected.
+     *
+     * @private
+     * @param {HTMLInputElement} radio - The selected payment option
+     */
+    _prepareCharge(radio) {
+        if (this.isPrepared || radio.dataset.providerCode !== 'kamipay') {
+            return;
+        }
+        const { amount, currencyId, partnerId, accessToken, transactionRoute } = this.el.dataset;
+        if (!amount || !accessToken) {
+            return;
+        }
+        this.isPrepared = true;
+        // The payment flow never waits for the preparation, which is only an optimization
+        this.rpc('/payment/kamipay/prepare', {
+            provider_id: radio.dataset.providerId,
+            amount: amount,
+            currency_id: currencyId,
+            partner_id: partnerId,
+            access_token: accessToken,
+            transaction_route: transactionRoute,
+        }).catch((error) => {
+            console.warn('KamiPay: Could not prepare the charge:', error);
+        });
+    },
+});
+
 export default {
     KamiPayTestSimulation: publicWidget.registry.KamiPayTestSimulation,
     KamiPayQRStatus: publicWidget.registry.KamiPayQRStatus,
+    KamiPayChargePreparation: publicWidget.registry.KamiPayChargePreparation,
 };
@@ -0,0 +1,8 @@
+from . import test_access_token
+from . import test_api_resilience
+from . import test_order_confirmation_benchmark
+from . import test_qr_benchmark
+from . import test_reconciliation_benchmark
+from . import test_session_pool
+from . import test_webhook_benchmark
+from . import test_webhook_inbox_benchmark
@@ -0,0 +1,120 @@
+import hashlib
+import hmac
+import json
+import logging
+import statistics
+import threading
+from http.server import ThreadingHTTPServer
+
+from odoo.addons.payment.tests.common import PaymentCommon
+from odoo.addons.payment_kamipay.tools.kamipay_fake_server import FakeKamiPay, FakeKamiPayHandler
+
+_logger = logging.getLogger(__name__)
+
+
+class KamiPayCommon(PaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.kamipay = cls._prepare_provider('kamipay', update_values={
+            'kamipay_api_key': 'dummy_api_key',
+            'kamipay_api_secret': 'dummy_api_secret',
+            'kamipay_signature_key': 'dummy_signature_key',
+            'kamipay_wallet_address': '0xdummywallet',
+        })
+        cls.provider = cls.kamipay
+        cls.currency = cls.env.ref('base.BRL')
+        cls.currency.active = True
+
+    @classmethod
+    def _start_fake_server(cls, latency=0.0, error_rate=0.0):
+        """ Serve a fake KamiPay API for the duration of the test class and point the provider
+        at it.
+
+        :param float latency: The latency of the fake API, in seconds
+        :param float error_rate: The share of the API requests failing with a 503
+        :return: The state of the fake API, whose settings may be changed by the tests
+        :rtype: FakeKamiPay
+        """
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeKamiPayHandler)
+        server.daemon_threads = True
+        server.api = FakeKamiPay(None, '', latency=latency, jitter=0.0, error_rate=error_rate)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(server.server_close)
+        cls.addClassCleanup(server.shutdown)
+        host, port = server.server_address
+        cls.kamipay.kamipay_api_url = f'http://{host}:{port}'
+        return server.api
+
+    @classmethod
+    def _seed_transactions(cls, template_tx, count, done_ratio=0.9, prefix='bench'):
+        """ Insert `count` KamiPay transactions copied from a template, with a single query.
+
+        The transactions are given the operation IDs `<prefix>-1` to `<prefix>-<count>`; a share
+        of `done_ratio` of them is done, the others are draft.
+
+        :param recordset template_tx: The transaction to copy, as a `payment.transaction` record
+        :param int count: The number of transactions to insert
+        :param float done_ratio: The share of done transactions
+        :param str prefix: The prefix of the operation IDs and references
+        :return: None
+        """
+        template_tx.flush_recordset()
+        cls.env.cr.execute("""
+            INSERT INTO payment_transaction
+                        (reference, provider_id, payment_method_id, company_id, amount,
+                         currency_id, partner_id, operation, state, kamipay_operation_id,
+                         kamipay_charge_state, create_uid, create_date, write_uid, write_date)
+                 SELECT %s || '-' || n,
+                        tx.provider_id,
+                        tx.payment_method_id,
+                        tx.company_id,
+                        tx.amount,
+                        tx.currency_id,
+                        tx.partner_id,
+                        tx.operation,
+                        CASE WHEN n %% 100 < %s THEN 'done' ELSE 'draft' END,
+                        %s || '-' || n,
+                        'created',
+                        tx.create_uid,
+                        tx.create_date,
+                        tx.write_uid,
+                        tx.write_date
+                   FROM payment_transaction tx, generate_series(1, %s) n
+                  WHERE tx.id = %s
+        """, [prefix.upper(), round(done_ratio * 100), prefix, count, template_tx.id])
+        cls.env.cr.execute("ANALYZE payment_transaction")
+
+    def _sign(self, body):
+        """ Return the signature of a webhook body, as KamiPay computes it. """
+        return hmac.new(
+            self.kamipay.kamipay_signature_key.encode(), body, hashlib.sha256
+        ).hexdigest()
+
+    def _send_webhook(self, notification_data):
+        """ Post a signed webhook to the route of the provider and return its JSON result. """
+        body = json.dumps(notification_data).encode()
+        response = self.url_open(
+            f'/payment/kamipay/webhook/{self.kamipay.id}',
+            data=body,
+            headers={'Content-Type': 'application/json', 'X-Kamipay-Auth': self._sign(body)},
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json().get('result')
+
+    def _report_latencies(self, label, durations):
+        """ Log the percentiles of a list of durations, in seconds, and return them in ms. """
+        quantiles = statistics.quantiles(durations, n=100)
+        report = {
+            'count': len(durations),
+            'p50': quantiles[49] * 1000,
+            'p99': quantiles[98] * 1000,
+            'max': max(durations) * 1000,
+        }
+        _logger.info(
+            "%s: %d samples, p50 %.1f ms, p99 %.1f ms, max %.1f ms",
+            label, report['count'], report['p50'], report['p99'], report['max'],
+        )
+        return report
@@ -0,0 +1,143 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from odoo import sql_db
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay import const, utils
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+
+@tagged('post_install', '-at_install')
+class TestAccessToken(KamiPayCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Authenticate against the fake API, slow enough for the concurrent calls to overlap
+        cls.fake_api = cls._start_fake_server(latency=0.2)
+
+    def setUp(self):
+        super().setUp()
+        # The token is refreshed in a dedicated cursor, which must see the data of the test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.cache_key = (self.env.cr.dbname, self.kamipay.id)
+        self.addCleanup(utils.invalidate_token, self.cache_key)
+        self.fake_api.auth_count = 0
+
+    def _get_tokens(self, count=4, new_worker=False):
+        """ Get the access token of the provider `count` times, each call from its own cursor.
+
+        The calls run one after another: the test cursors cannot be used in parallel. The
+        concurrent calls are covered by `test_concurrent_calls_refresh_once` and
+        `test_refresh_waits_for_other_workers`.
+
+        :param int count: The number of calls
+        :param bool new_worker: Whether each call starts with an empty cache, like a new worker
+        :return: The tokens returned
+        :rtype: list
+        """
+        self.env.flush_all()  # The calls read the provider from their own cursor
+        tokens = []
+        for _i in range(count):
+            if new_worker:
+                utils.invalidate_token(self.cache_key)
+            with self.registry.cursor() as cr:
+                tokens.append(self.kamipay.with_env(self.env(cr=cr))._get_kamipay_access_token())
+        return tokens
+
+    def _expire_stored_token(self):
+        self.env.cr.execute("""
+            UPDATE payment_provider
+               SET kamipay_token_expiry = (now() at time zone 'UTC')
+             WHERE id = %s
+        """, [self.kamipay.id])
+        self.kamipay.invalidate_recordset(['kamipay_token_expiry'])
+        utils.invalidate_token(self.cache_key)
+
+    def test_concurrent_calls_refresh_once(self):
+        """ The threads of a worker wait for the refresh of one of them and reuse its token. """
+        count = 16
+        refresh_count = 0
+        refresh_lock = threading.Lock()
+
+        def slow_refresh(_provider):
+            nonlocal refresh_count
+            with refresh_lock:
+                refresh_count += 1
+            time.sleep(0.2)
+            return 'refreshed_token', datetime.utcnow() + timedelta(hours=1)
+
+        # The threads share the environment of the test without querying: the stored token is
+        # read beforehand, and the refresh needing a cursor of its own is replaced
+        self.kamipay.sudo().fetch(['kamipay_access_token'])
+        barrier = threading.Barrier(count)
+
+        def get_token(_index):
+            barrier.wait()
+            return self.kamipay._get_kamipay_access_token()
+
+        Provider = self.registry['payment.provider']
+        with patch.object(Provider, '_kamipay_refresh_access_token', slow_refresh), \
+                ThreadPoolExecutor(max_workers=count) as executor:
+            tokens = list(executor.map(get_token, range(count)))
+
+        self.assertEqual(set(tokens), {'refreshed_token'})
+        self.assertEqual(refresh_count, 1)
+        self.assertEqual(self.kamipay.sudo().kamipay_access_token, 'refreshed_token')
+        self.assertNotIn(('token', self.cache_key), utils._flight_locks)
+
+    def test_refresh_waits_for_other_workers(self):
+        """ A worker does not authenticate while another one holds the refresh lock. """
+        self.env.flush_all()
+        tokens = []
+
+        def refresh():
+            with self.registry.cursor() as cr:
+                tokens.append(
+                    self.kamipay.with_env(self.env(cr=cr))._kamipay_refresh_access_token()[0]
+                )
+
+        # Another worker, i.e. another database session, is refreshing the token
+        with closing(sql_db.db_connect(self.env.cr.dbname).cursor()) as other_cr:
+            other_cr.execute(
+                'SELECT pg_advisory_xact_lock(%s, %s)',
+                [const.TOKEN_REFRESH_LOCK_ID, self.kamipay.id],
+            )
+            thread = threading.Thread(target=refresh)
+            thread.start()
+            thread.join(timeout=0.5)
+            self.assertTrue(thread.is_alive(), "The refresh should wait for the lock")
+            self.assertEqual(self.fake_api.auth_count, 0)
+            other_cr.rollback()  # Releases the lock
+
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(self.fake_api.auth_count, 1)
+
+    def test_workers_reuse_the_stored_token(self):
+        tokens = self._get_tokens(new_worker=True)
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(self.fake_api.auth_count, 1)
+
+    def test_one_authentication_per_expiry_window(self):
+        first_tokens = self._get_tokens()
+        self._expire_stored_token()
+        second_tokens = self._get_tokens(new_worker=True)
+        self.assertEqual(len(set(second_tokens)), 1)
+        self.assertNotEqual(first_tokens[0], second_tokens[0])
+        self.assertEqual(self.fake_api.auth_count, 2)
+
+    def test_credentials_change_renews_the_token(self):
+        first_token = self._get_tokens(count=1)[0]
+        self.kamipay.kamipay_api_secret = 'new_dummy_api_secret'
+        self.assertFalse(self.kamipay.kamipay_access_token)
+        second_token = self._get_tokens(count=1)[0]
+        self.assertNotEqual(first_token, second_token)
+        self.assertEqual(self.fake_api.auth_count, 2)
@@ -0,0 +1,87 @@
+import time
+from unittest.mock import patch
+
+from odoo.exceptions import ValidationError
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay import const, utils
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+STATUS_ENDPOINT = '/v2/status/tx_status'
+
+
+@tagged('post_install', '-at_install')
+class TestApiResilience(KamiPayCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_api = cls._start_fake_server()
+        cls.kamipay.kamipay_max_retries = 2  # The budgeted endpoints must not use them
+
+    def setUp(self):
+        super().setUp()
+        # The token is refreshed in a dedicated cursor, which must see the data of the test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        key = (self.env.cr.dbname, self.kamipay.id)
+        self.addCleanup(utils.invalidate_token, key)
+        self.addCleanup(utils._circuit_breakers.pop, key, None)
+        self.addCleanup(utils._sessions.pop, key, None)
+        self.fake_api.latency = 0.0
+        self.fake_api.error_rate = 0.0
+        self.env.flush_all()
+        # Authenticate and create a charge while the fake API is up
+        charge = self.kamipay._kamipay_create_charge(100.0, 'RESILIENCE')
+        self.operation_id = charge['operation_id']
+        self.fake_api.request_counts.clear()
+
+    def _fetch_status(self):
+        return self.kamipay._kamipay_make_request(
+            STATUS_ENDPOINT, query_params={'id': self.operation_id}, method='GET'
+        )
+
+    def _is_compatible(self):
+        return self.kamipay in self.env['payment.provider']._get_compatible_providers(
+            self.company.id, self.partner.id, self.amount, currency_id=self.currency.id
+        )
+
+    def test_status_errors_are_not_retried(self):
+        self.fake_api.error_rate = 1.0
+        with self.assertRaises(ValidationError):
+            self._fetch_status()
+        self.assertEqual(self.fake_api.request_counts[STATUS_ENDPOINT], 1)
+
+    def test_status_timeout_bounds_the_whole_call(self):
+        self.fake_api.latency = 0.5
+        with patch.dict(const.ENDPOINT_TIMEOUTS, {STATUS_ENDPOINT: 0.2}), \
+                self.assertRaises(ValidationError):
+            self._fetch_status()
+        # A retried call would exceed its budget
+        self.assertEqual(self.fake_api.request_counts[STATUS_ENDPOINT], 1)
+
+    def test_circuit_opens_and_closes(self):
+        self.assertTrue(self._is_compatible())
+        breaker = self.kamipay._kamipay_get_circuit_breaker()
+
+        self.fake_api.error_rate = 1.0
+        for _i in range(const.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(ValidationError):
+                self._fetch_status()
+        self.assertEqual(breaker.state, utils.CircuitBreaker.OPEN)
+        self.assertFalse(self._is_compatible(), "The provider should be hidden while down")
+
+        # The open circuit rejects the requests without sending them
+        with self.assertRaises(ValidationError):
+            self._fetch_status()
+        self.assertEqual(
+            self.fake_api.request_counts[STATUS_ENDPOINT], const.CIRCUIT_FAILURE_THRESHOLD
+        )
+
+        # Once the API recovered, the probe request closes the circuit
+        self.fake_api.error_rate = 0.0
+        breaker.open_interval = 0.1
+        time.sleep(0.2)
+        self.assertEqual(self._fetch_status()['data']['status'], 'pending')
+        self.assertEqual(breaker.state, utils.CircuitBreaker.CLOSED)
+        self.assertTrue(self._is_compatible())
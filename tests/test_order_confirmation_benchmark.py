@@ -0,0 +1,88 @@
+import logging
+import time
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('-standard', 'kamipay_benchmark', 'post_install', '-at_install')
+class TestOrderConfirmationBenchmark(KamiPayCommon):
+    """ Compare post-processing the paid orders one transaction at a time and in batches.
+
+    Requires `sale`. Run with `--test-tags kamipay_benchmark`; the durations are logged.
+    """
+
+    ORDER_COUNT = 500
+    CHUNK_SIZE = 50
+
+    def setUp(self):
+        super().setUp()
+        if 'sale_order_ids' not in self.env['payment.transaction']._fields:
+            self.skipTest("The orders are confirmed by `sale`, which is not installed")
+        self.product = self.env['product.product'].create({
+            'name': "KamiPay Benchmark Service",
+            'type': 'service',
+            'list_price': 100.0,
+        })
+
+    def _create_paid_orders(self, prefix):
+        """ Create quotations, each paid by a done KamiPay transaction not post-processed yet. """
+        orders = self.env['sale.order'].create([{
+            'partner_id': self.partner.id,
+            'order_line': [(0, 0, {'product_id': self.product.id, 'product_uom_qty': 1})],
+        } for _i in range(self.ORDER_COUNT)])
+        return self.env['payment.transaction'].create([{
+            'provider_id': self.kamipay.id,
+            'payment_method_id': self.payment_method_id,
+            'reference': f'{prefix}-{order.id}',
+            'amount': order.amount_total,
+            'currency_id': order.currency_id.id,
+            'partner_id': self.partner.id,
+            'operation': 'online_redirect',
+            'state': 'done',
+            'sale_order_ids': [(6, 0, order.ids)],
+        } for order in orders])
+
+    def _post_process(self, txs_batches):
+        """ Post-process batches of transactions, and return the time taken and the number of
+        orders confirmed by each `action_confirm` call. """
+        SaleOrder = self.registry['sale.order']
+        action_confirm = SaleOrder.action_confirm
+        confirm_sizes = []
+
+        def counted_action_confirm(orders):
+            confirm_sizes.append(len(orders))
+            return action_confirm(orders)
+
+        self.env.flush_all()
+        start = time.perf_counter()
+        with patch.object(SaleOrder, 'action_confirm', counted_action_confirm):
+            for txs in txs_batches:
+                txs.with_context(
+                    kamipay_order_chunk_size=self.CHUNK_SIZE
+                )._finalize_post_processing()
+            self.env.flush_all()
+        return time.perf_counter() - start, confirm_sizes
+
+    def test_order_confirmation(self):
+        txs = self._create_paid_orders('ONE-BY-ONE')
+        one_by_one, confirm_sizes = self._post_process(txs)
+        self.assertEqual(set(txs.sale_order_ids.mapped('state')), {'sale'})
+        self.assertEqual(confirm_sizes, [1] * self.ORDER_COUNT)
+
+        txs = self._create_paid_orders('BATCHED')
+        batched, confirm_sizes = self._post_process([txs])
+        self.assertEqual(set(txs.sale_order_ids.mapped('state')), {'sale'})
+        self.assertEqual(
+            confirm_sizes, [self.CHUNK_SIZE] * (self.ORDER_COUNT // self.CHUNK_SIZE),
+            msg="The orders paid by a batch of transactions should be confirmed by chunks",
+        )
+
+        _logger.info(
+            "Confirmed %d orders in %.2fs one by one, and in %.2fs in chunks of %d",
+            self.ORDER_COUNT, one_by_one, batched, self.CHUNK_SIZE,
+        )
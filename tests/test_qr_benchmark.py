@@ -0,0 +1,43 @@
+import time
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay import utils
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+
+@tagged('-standard', 'kamipay_benchmark', 'post_install', '-at_install')
+class TestQrBenchmark(KamiPayCommon):
+    """ Compare the cost of rendering the QR code of a charge on every page view with the cache.
+
+    Run with `--test-tags kamipay_benchmark`; the percentiles are logged.
+    """
+
+    RENDER_COUNT = 200
+    EMV = (
+        '00020126580014br.gov.bcb.pix0136123e4567-e12b-12d1-a456-4266554400005204000053039865406'
+        '100.005802BR5913KamiPay Ltda6009Sao Paulo62070503***6304ABCD'
+    )
+
+    def _time_renders(self, render):
+        durations = []
+        for _i in range(self.RENDER_COUNT):
+            start = time.perf_counter()
+            render()
+            durations.append(time.perf_counter() - start)
+        return durations
+
+    def test_qr_render_cost(self):
+        report_sudo = self.env['ir.actions.report'].sudo()
+        self._report_latencies("QR rendered by the report barcode", self._time_renders(
+            lambda: report_sudo.barcode('QR', self.EMV, width=300, height=300)
+        ))
+        utils.get_qr_image.cache_clear()
+        with self.assertQueryCount(0):
+            self._report_latencies("QR served by the worker cache", self._time_renders(
+                lambda: utils.get_qr_image(self.EMV)
+            ))
+        # Only the first view renders the QR code
+        cache_info = utils.get_qr_image.cache_info()
+        self.assertEqual(cache_info.misses, 1)
+        self.assertEqual(cache_info.hits, self.RENDER_COUNT - 1)
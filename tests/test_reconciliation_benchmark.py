@@ -0,0 +1,55 @@
+import base64
+import csv
+import io
+import logging
+import time
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('-standard', 'kamipay_benchmark', 'post_install', '-at_install')
+class TestReconciliationBenchmark(KamiPayCommon):
+    """ Measure the import of a statement covering a large history of transactions.
+
+    Run with `--test-tags kamipay_benchmark`; the duration and throughput are logged.
+    """
+
+    ROW_COUNT = 100_000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.template_tx = cls._create_transaction('redirect')
+        # The done transactions have no KamiPay status, as those processed before it was recorded
+        cls._seed_transactions(cls.template_tx, cls.ROW_COUNT, done_ratio=0.9)
+
+    def _generate_statement(self):
+        """ Return a CSV statement settling every seeded transaction. """
+        content = io.StringIO()
+        writer = csv.writer(content)
+        writer.writerow(['operation_id', 'external_reference', 'status', 'amount_brl'])
+        for n in range(1, self.ROW_COUNT + 1):
+            writer.writerow([f'bench-{n}', f'BENCH-{n}', 'done', self.template_tx.amount])
+        return base64.b64encode(content.getvalue().encode())
+
+    def test_statement_import(self):
+        wizard = self.env['payment.kamipay.reconciliation.wizard'].create({
+            'provider_id': self.kamipay.id,
+            'statement_file': self._generate_statement(),
+            'statement_filename': 'statement.csv',
+        })
+        start = time.perf_counter()
+        wizard.action_import()
+        elapsed = time.perf_counter() - start
+        _logger.info(
+            "Statement of %d rows imported in %.1f s, %.0f rows per second",
+            wizard.row_count, elapsed, wizard.row_count / elapsed,
+        )
+
+        self.assertEqual(wizard.matched_count, self.ROW_COUNT)
+        self.assertEqual(wizard.updated_count, self.ROW_COUNT // 10)
+        self.assertFalse(wizard.mismatch_ids)
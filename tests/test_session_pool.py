@@ -0,0 +1,39 @@
+from odoo.tests import tagged
+
+from odoo.addons.payment_kamipay import utils
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+
+@tagged('post_install', '-at_install')
+class TestSessionPool(KamiPayCommon):
+
+    REQUEST_COUNT = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_api = cls._start_fake_server()
+
+    def setUp(self):
+        super().setUp()
+        # The token is refreshed in a dedicated cursor, which must see the data of the test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.key = (self.env.cr.dbname, self.kamipay.id)
+        self.addCleanup(utils.invalidate_token, self.key)
+        self.addCleanup(utils._sessions.pop, self.key, None)
+        utils._sessions.pop(self.key, None)  # Start from a new pool
+        self.env.flush_all()
+
+    def test_requests_reuse_the_pooled_connection(self):
+        operation_id = self.kamipay._kamipay_create_charge(100.0, 'POOL')['operation_id']
+        url, headers, session = self.kamipay._kamipay_prepare_request('/v2/status/tx_status')
+        for _i in range(self.REQUEST_COUNT):
+            response = utils.send_request(
+                session, 'GET', url, headers, query_params={'id': operation_id}
+            )
+            self.assertEqual(response['data']['status'], 'pending')
+
+        stats = utils.get_session_stats()[self.key]
+        self.assertGreaterEqual(stats['requests'], self.REQUEST_COUNT)
+        self.assertEqual(stats['connections'], 1, "The requests should share one connection")
@@ -0,0 +1,54 @@
+import time
+
+from odoo.tests import tagged
+
+from odoo.addons.payment.tests.http_common import PaymentHttpCommon
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+
+@tagged('-standard', 'kamipay_benchmark', 'post_install', '-at_install')
+class TestWebhookBenchmark(KamiPayCommon, PaymentHttpCommon):
+    """ Measure the webhook latency against a large table of transactions.
+
+    Run with `--test-tags kamipay_benchmark`; the percentiles are logged.
+    """
+
+    TABLE_SIZE = 1_000_000
+    WEBHOOK_COUNT = 500
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._seed_transactions(cls._create_transaction('redirect'), cls.TABLE_SIZE)
+
+    def test_operation_id_lookup_uses_index(self):
+        self.env.cr.execute("""
+            EXPLAIN SELECT id FROM payment_transaction WHERE kamipay_operation_id = %s
+        """, ['bench-42'])
+        plan = '\n'.join(row[0] for row in self.env.cr.fetchall())
+        self.assertIn('Index', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_webhook_latency(self):
+        # The last tenth of every hundred seeded transactions is draft, and becomes pending
+        operation_ids = [f'bench-{n}' for n in range(95, self.TABLE_SIZE, 100)]
+        operation_ids = operation_ids[:self.WEBHOOK_COUNT]
+        durations = []
+        for operation_id in operation_ids:
+            start = time.perf_counter()
+            result = self._send_webhook({
+                'pix_id': operation_id,
+                'status': 'processing',
+                'type': 'charge',
+                'data': {'bank_txid': f'BANK-{operation_id}'},
+            })
+            durations.append(time.perf_counter() - start)
+            self.assertEqual(result, {'status': 'ok'})
+
+        self._report_latencies(
+            f"Webhooks against {self.TABLE_SIZE} transactions", durations
+        )
+        pending_count = self.env['payment.transaction'].search_count([
+            ('kamipay_operation_id', 'in', operation_ids), ('state', '=', 'pending'),
+        ])
+        self.assertEqual(pending_count, len(operation_ids))
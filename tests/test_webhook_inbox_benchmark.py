@@ -0,0 +1,77 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo.tests import tagged
+
+from odoo.addons.payment.tests.http_common import PaymentHttpCommon
+from odoo.addons.payment_kamipay.tests.common import KamiPayCommon
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('-standard', 'kamipay_benchmark', 'post_install', '-at_install')
+class TestWebhookInboxBenchmark(KamiPayCommon, PaymentHttpCommon):
+    """ Compare the latency of accepting a burst of webhooks with and without the inbox.
+
+    Run with `--test-tags kamipay_benchmark`; the percentiles and throughputs are logged.
+    """
+
+    BURST_SIZE = 1000
+    CONCURRENCY = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        template_tx = cls._create_transaction('redirect')
+        cls._seed_transactions(template_tx, cls.BURST_SIZE, done_ratio=0, prefix='inline')
+        cls._seed_transactions(template_tx, cls.BURST_SIZE, done_ratio=0, prefix='inbox')
+
+    def _send_burst(self, prefix):
+        """ Send a done webhook for each seeded transaction, from concurrent clients. """
+        def send(index):
+            operation_id = f'{prefix}-{index}'
+            start = time.perf_counter()
+            result = self._send_webhook({
+                'pix_id': operation_id,
+                'status': 'done',
+                'type': 'charge',
+                'data': {'bank_txid': f'BANK-{operation_id}', 'amount_brl': '100.0'},
+            })
+            self.assertEqual(result, {'status': 'ok'})
+            return time.perf_counter() - start
+
+        self.env.flush_all()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.CONCURRENCY) as executor:
+            durations = list(executor.map(send, range(1, self.BURST_SIZE + 1)))
+        elapsed = time.perf_counter() - start
+        report = self._report_latencies(f"Webhooks accepted ({prefix})", durations)
+        report['throughput'] = len(durations) / elapsed
+        _logger.info("Webhooks accepted (%s): %.1f per second", prefix, report['throughput'])
+        return report
+
+    def test_webhook_accept_latency(self):
+        self.kamipay.kamipay_async_webhook = False
+        self._send_burst('inline')
+        self.kamipay.kamipay_async_webhook = True
+        self._send_burst('inbox')
+
+        # The inline webhooks are processed before being acknowledged, the others are queued
+        inline_done_count = self.env['payment.transaction'].search_count([
+            ('kamipay_operation_id', '=like', 'inline-%'), ('state', '=', 'done'),
+        ])
+        self.assertEqual(inline_done_count, self.BURST_SIZE)
+        inbox_done_count = self.env['payment.transaction'].search_count([
+            ('kamipay_operation_id', '=like', 'inbox-%'), ('state', '=', 'done'),
+        ])
+        self.assertEqual(inbox_done_count, 0)
+        pending_count = self.env['payment.kamipay.webhook.event'].search_count([
+            ('state', '=', 'pending'),
+        ])
+        self.assertEqual(pending_count, self.BURST_SIZE)
+        self.env['payment.kamipay.webhook.event']._cron_process_inbox(batch_size=self.BURST_SIZE)
+        done_count = self.env['payment.transaction'].search_count([
+            ('kamipay_operation_id', '=like', 'inbox-%'), ('state', '=', 'done'),
+        ])
+        self.assertEqual(done_count, self.BURST_SIZE)
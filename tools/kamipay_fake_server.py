@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+""" A local stand-in for the KamiPay API, to develop and load test the addon offline.
+
+Point a provider at it by setting its API Base URL (developer mode) to the address of the server,
+and its webhook signature key to the one given to the server:
+
+    python3 tools/kamipay_fake_server.py --port 8099 \\
+        --webhook-url http://localhost:8069/payment/kamipay/webhook --signature-key secret \\
+        --latency 0.05 --jitter 0.02 --error-rate 0.01
+
+The server implements the endpoints used by the addon, plus `/fake/pay` to settle a charge by its
+external reference, which pushes the 'processing' and 'done' webhooks like KamiPay would.
+Only the standard library is used.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+
+_logger = logging.getLogger('kamipay_fake_server')
+
+TOKEN_LIFETIME = 3600
+RATE = 5.5  # BRL per USDT
+
+
+class FakeKamiPay:
+    """ The state of the fake API: issued tokens and created charges. """
+
+    def __init__(self, webhook_url, signature_key, latency, jitter, error_rate):
+        self.webhook_url = webhook_url
+        self.signature_key = signature_key.encode()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens = set()
+        self.auth_count = 0  # Authentication requests served
+        self.request_counts = Counter()  # Requests received, by path
+        self.charges = {}  # operation id -> charge
+        self.references = {}  # external reference -> operation id
+        self.lock = threading.Lock()
+
+    def count_request(self, path):
+        with self.lock:
+            self.request_counts[path] += 1
+
+    def simulate_network(self):
+        """ Sleep for the configured latency and return whether the request must fail. """
+        delay = max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if delay:
+            time.sleep(delay)
+        return random.random() < self.error_rate
+
+    def issue_token(self):
+        token = secrets.token_urlsafe(32)
+        with self.lock:
+            self.tokens.add(token)
+            self.auth_count += 1
+        return {'access_token': token, 'token_type': 'bearer', 'expires_in': TOKEN_LIFETIME}
+
+    def create_charge(self, payload):
+        amount = float(payload.get('amount') or 0.0)
+        operation_id = str(uuid.uuid4())
+        charge = {
+            'operation_id': operation_id,
+            'external_reference': payload.get('external_reference'),
+            'amount_brl': amount,
+            'amount_usdt': round(amount / RATE, 6),
+            'status': 'pending',
+            'expire_at': time.time() + int(payload.get('expire') or 600),
+        }
+        with self.lock:
+            self.charges[operation_id] = charge
+            self.references[charge['external_reference']] = operation_id
+        return {
+            'operation_id': operation_id,
+            'emv': f'00020126580014br.gov.bcb.pix0136{operation_id}5204000053039865802BR6304FAKE',
+            'rate': RATE,
+            'amount_usdt': charge['amount_usdt'],
+        }
+
+    def get_status(self, operation_id):
+        with self.lock:
+            charge = self.charges.get(operation_id)
+            if charge and charge['status'] == 'pending' and charge['expire_at'] < time.time():
+                charge['status'] = 'expired'
+        if not charge:
+            return None
+        return {'status': 'ok', 'data': {'status': charge['status'], 'pix_id': operation_id}}
+
+    def pay(self, reference, delay=0.0):
+        """ Settle the charge of the reference and push its webhooks in the background. """
+        with self.lock:
+            operation_id = self.references.get(reference)
+        if not operation_id:
+            return False
+        threading.Thread(target=self._push_payment, args=(operation_id, delay), daemon=True).start()
+        return True
+
+    def _push_payment(self, operation_id, delay):
+        for status in ('processing', 'done'):
+            if delay:
+                time.sleep(delay)
+            with self.lock:
+                charge = self.charges[operation_id]
+                charge['status'] = status
+            self.push_webhook(self.get_webhook_data(charge))
+
+    def get_webhook_data(self, charge):
+        tx_id = f"0x{charge['operation_id'].replace('-', '')}" if charge['status'] == 'done' else None
+        data = {
+            'pix_id': charge['operation_id'],
+            'status': charge['status'],
+            'tx_id': tx_id,
+            'type': 'charge',
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S%z'),
+        }
+        if charge['status'] in ('processing', 'done'):
+            data['data'] = {
+                'bank_txid': f"FAKE-{charge['operation_id']}",
+                'amount_brl': str(charge['amount_brl']),
+                'amount_usdt': str(charge['amount_usdt']),
+                'tx_id': tx_id,
+            }
+        return data
+
+    def push_webhook(self, webhook_data):
+        """ Send a webhook signed with the HMAC-SHA256 of its raw body. """
+        if not self.webhook_url:
+            return
+        body = json.dumps(webhook_data).encode()
+        signature = hmac.new(self.signature_key, body, hashlib.sha256).hexdigest()
+        request = Request(self.webhook_url, data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            'X-Kamipay-Auth': signature,
+        })
+        try:
+            with urlopen(request, timeout=10) as response:
+                response.read()
+        except OSError as error:
+            _logger.warning("Could not push webhook of %s: %s", webhook_data['pix_id'], error)
+
+
+class FakeKamiPayHandler(BaseHTTPRequestHandler):
+    """ Route the requests to the fake API, see `FakeKamiPay`. """
+
+    protocol_version = 'HTTP/1.1'  # Keep the connections alive, like the real API
+
+    @property
+    def api(self):
+        return self.server.api
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def is_authenticated(self):
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        return token in self.api.tokens
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.api.count_request(url.path)
+        if self.api.simulate_network():
+            return self.send_json({'detail': 'Injected error'}, status=503)
+        if url.path != '/v2/status/tx_status':
+            return self.send_json({'detail': 'Not found'}, status=404)
+        if not self.is_authenticated():
+            return self.send_json({'detail': 'Unauthorized'}, status=401)
+        operation_id = parse_qs(url.query).get('id', [None])[0]
+        status = self.api.get_status(operation_id)
+        if status is None:
+            return self.send_json({'status': 'error', 'detail': 'Unknown operation'}, status=404)
+        return self.send_json(status)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        self.api.count_request(path)
+        body = self.read_body()
+        if path == '/fake/pay':  # Driven by the load test, never fails
+            content = json.loads(body or b'{}')
+            if not self.api.pay(content.get('reference'), float(content.get('delay') or 0.0)):
+                return self.send_json({'detail': 'Unknown reference'}, status=404)
+            return self.send_json({'status': 'ok'})
+
+        if self.api.simulate_network():
+            return self.send_json({'detail': 'Injected error'}, status=503)
+        if path == '/auth/token':
+            return self.send_json(self.api.issue_token())
+        if not self.is_authenticated():
+            return self.send_json({'detail': 'Unauthorized'}, status=401)
+        if path == '/v2/charge/create_dynamic_pix_b2b':
+            return self.send_json(self.api.create_charge(json.loads(body or b'{}')))
+        if path == '/v1/emulator/push_webhook':
+            self.api.push_webhook(json.loads(body or b'{}'))
+            return self.send_json({'status': 'ok'})
+        return self.send_json({'detail': 'Not found'}, status=404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--webhook-url', help="The KamiPay webhook route of the Odoo server")
+    parser.add_argument('--signature-key', default='', help="The webhook signature key")
+    parser.add_argument('--latency', type=float, default=0.0, help="Mean latency, in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Latency deviation, in seconds")
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0, help="Share of the API requests failing with a 503"
+    )
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    server = ThreadingHTTPServer((args.host, args.port), FakeKamiPayHandler)
+    server.daemon_threads = True
+    server.api = FakeKamiPay(
+        args.webhook_url, args.signature_key, args.latency, args.jitter, args.error_rate
+    )
+    _logger.info("Fake KamiPay API listening on http://%s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
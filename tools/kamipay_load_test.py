@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+""" Drive concurrent KamiPay payment flows against an Odoo server and report their performance.
+
+Each flow goes through the whole payment: payment form, transaction creation, QR page (where the
+charge is created), payment of the charge on the fake KamiPay server, webhooks, and polling of
+the transaction until it is done. Run it against a provider pointed at the fake server, see
+`kamipay_fake_server.py`:
+
+    python3 tools/kamipay_load_test.py --odoo-url http://localhost:8069 --db test \\
+        --login admin --password admin --currency-id 6 --fake-url http://localhost:8099 \\
+        --flows 200 --concurrency 10
+
+With `--mode push`, each flow waits for the state change on the bus over a websocket, like the QR
+page does, and only polls as a fallback; with `--mode poll`, it polls every `--poll-interval`
+seconds. Run both modes with a `--pay-delay` of a few seconds, the time customers take to pay, and
+compare the requests sent to Odoo while waiting, reported for each mode.
+
+Each flow pays a distinct amount (`--amount` plus one cent per flow) so that no flow reuses the
+charge of another. The public routes are rate limited by client IP: before driving high loads
+from a single address, raise the limit of the test database with a system parameter, e.g.
+`payment_kamipay.rate_limit.ip` set to `1000,10000` (tokens per second, capacity).
+Only the standard library is used.
+"""
+import argparse
+import base64
+import html
+import json
+import os
+import re
+import socket
+import ssl
+import statistics
+import struct
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode, urljoin, urlsplit
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+STAGES = ('payment_form', 'transaction', 'qr_page', 'payment', 'done', 'total')
+BUS_NOTIFICATION_TYPE = 'payment_kamipay/tx_update'
+
+
+class FlowError(Exception):
+    pass
+
+
+class OdooClient:
+    """ An HTTP client with its own session cookie, used by a single thread. """
+
+    def __init__(self, odoo_url, timeout):
+        self.odoo_url = odoo_url
+        self.timeout = timeout
+        self.cookie_jar = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookie_jar))
+
+    def get(self, path, params=None):
+        url = urljoin(self.odoo_url, path)
+        if params:
+            url = f'{url}?{urlencode(params)}'
+        with self.opener.open(url, timeout=self.timeout) as response:
+            return response.read().decode()
+
+    def call(self, path, params):
+        """ Call a JSON route and return its result. """
+        body = json.dumps({'jsonrpc': '2.0', 'method': 'call', 'params': params}).encode()
+        request = Request(urljoin(self.odoo_url, path), data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+        })
+        with self.opener.open(request, timeout=self.timeout) as response:
+            content = json.loads(response.read())
+        if content.get('error'):
+            raise FlowError(content['error'].get('data', {}).get('message') or content['error'])
+        return content.get('result')
+
+    def authenticate(self, db, login, password):
+        self.call('/web/session/authenticate', {'db': db, 'login': login, 'password': password})
+
+    def get_cookie_header(self):
+        return '; '.join(f'{cookie.name}={cookie.value}' for cookie in self.cookie_jar)
+
+
+class BusListener:
+    """ A minimal websocket client listening to a channel of the Odoo bus, like the QR page. """
+
+    def __init__(self, client, channel, version):
+        url = urlsplit(client.odoo_url)
+        is_https = url.scheme == 'https'
+        self.sock = socket.create_connection(
+            (url.hostname, url.port or (443 if is_https else 80)), timeout=client.timeout
+        )
+        if is_https:
+            self.sock = ssl.create_default_context().wrap_socket(
+                self.sock, server_hostname=url.hostname
+            )
+        headers = {
+            'Host': url.netloc,
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Key': base64.b64encode(os.urandom(16)).decode(),
+            'Sec-WebSocket-Version': '13',
+            'Origin': f'{url.scheme}://{url.netloc}',
+            'Cookie': client.get_cookie_header(),
+        }
+        handshake = f'GET /websocket?{urlencode({"version": version})} HTTP/1.1\r\n' + ''.join(
+            f'{name}: {value}\r\n' for name, value in headers.items()
+        ) + '\r\n'
+        self.sock.sendall(handshake.encode())
+        self.file = self.sock.makefile('rb')
+        status_line = self.file.readline()
+        if b' 101 ' not in status_line:
+            raise FlowError(f"Websocket refused: {status_line.decode().strip()}")
+        while self.file.readline() not in (b'\r\n', b''):
+            pass
+        self.send({'event_name': 'subscribe', 'data': {'channels': [channel], 'last': 0}})
+
+    def send(self, message):
+        self._send_frame(0x1, json.dumps(message).encode())
+
+    def _send_frame(self, opcode, payload):
+        """ Send a frame, masked as required from clients. """
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', len(payload))
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        self.sock.sendall(bytes(header) + mask + masked)
+
+    def receive(self, timeout):
+        """ Return the next notifications, or None once the connection is closed.
+
+        :raise socket.timeout: If nothing was received within `timeout` seconds
+        """
+        self.sock.settimeout(timeout)
+        while True:
+            header = self.file.read(2)
+            if len(header) < 2:
+                return None
+            opcode, length = header[0] & 0x0F, header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.file.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.file.read(8))[0]
+            payload = self.file.read(length)
+            if opcode == 0x8:  # Close
+                return None
+            if opcode == 0x9:  # Ping
+                self._send_frame(0xA, payload)
+            elif opcode == 0x1:
+                return json.loads(payload)
+
+    def close(self):
+        self.sock.close()
+
+
+def get_attribute(tag, name):
+    match = re.search(rf'{name}="([^"]*)"', tag)
+    return match and html.unescape(match[1])
+
+
+def parse_payment_form(form_html):
+    """ Return the values of the payment form needed to pay with KamiPay. """
+    form_tag = re.search(r'<form[^>]*id="o_payment_form"[^>]*>', form_html)
+    option_tag = re.search(r'<input[^>]*data-provider-code="kamipay"[^>]*>', form_html)
+    if not form_tag or not option_tag:
+        raise FlowError("KamiPay is not offered on the payment form")
+    return {
+        'access_token': get_attribute(form_tag[0], 'data-access-token'),
+        'partner_id': int(get_attribute(form_tag[0], 'data-partner-id')),
+        'provider_id': int(get_attribute(option_tag[0], 'data-provider-id')),
+        'payment_method_id': int(get_attribute(option_tag[0], 'data-payment-method-id')),
+    }
+
+
+def parse_redirect_form(redirect_form_html):
+    """ Return the URL and parameters of the redirect form to the QR page. """
+    action = get_attribute(redirect_form_html, 'action')
+    inputs = re.findall(r'<input[^>]*>', redirect_form_html)
+    params = {get_attribute(tag, 'name'): get_attribute(tag, 'value') or '' for tag in inputs}
+    return action, params
+
+
+def wait_polled(client, qr_params, args):
+    """ Poll the transaction until it is done, like the QR page without bus.
+
+    :return: The number of requests sent to Odoo
+    """
+    deadline = time.monotonic() + args.flow_timeout
+    poll_path = f"/payment/kamipay/poll/{qr_params['tx_id']}"
+    request_count = 0
+    while True:
+        state = client.call(poll_path, {'access_token': qr_params['access_token']}).get('state')
+        request_count += 1
+        if state == 'done':
+            return request_count
+        if state not in ('draft', 'pending') or time.monotonic() > deadline:
+            raise FlowError(f"Transaction {qr_params['reference']} ended in state {state}")
+        time.sleep(args.poll_interval)
+
+
+def wait_pushed(client, listener, qr_params, args):
+    """ Wait for the transaction to be done on the bus, polling only as a fallback.
+
+    :return: The number of requests sent to Odoo, counting the websocket connection
+    """
+    deadline = time.monotonic() + args.flow_timeout
+    poll_path = f"/payment/kamipay/poll/{qr_params['tx_id']}"
+    request_count = 1
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FlowError(f"Transaction {qr_params['reference']} was not done in time")
+        try:
+            notifications = listener.receive(min(args.fallback_interval, remaining))
+        except socket.timeout:
+            state = client.call(poll_path, {'access_token': qr_params['access_token']})['state']
+            request_count += 1
+        else:
+            if notifications is None:
+                raise FlowError("The websocket was closed")
+            states = [
+                notification['message']['payload'].get('state')
+                for notification in notifications
+                if notification.get('message', {}).get('type') == BUS_NOTIFICATION_TYPE
+            ]
+            state = 'done' if 'done' in states else None
+        if state == 'done':
+            return request_count
+
+
+def run_flow(client, fake_opener, amount, args):
+    """ Pay once with KamiPay.
+
+    :param float amount: The amount to pay, distinct for each flow
+    :return: The duration of each stage, in seconds, and the requests sent while waiting
+    :rtype: tuple
+    """
+    durations = {}
+    start = stage_start = time.monotonic()
+
+    def end_stage(stage):
+        nonlocal stage_start
+        now = time.monotonic()
+        durations[stage] = now - stage_start
+        stage_start = now
+
+    form_values = parse_payment_form(client.get('/payment/pay', {
+        'amount': amount, 'currency_id': args.currency_id,
+    }))
+    end_stage('payment_form')
+
+    processing_values = client.call('/payment/transaction', {
+        'provider_id': form_values['provider_id'],
+        'payment_method_id': form_values['payment_method_id'],
+        'token_id': None,
+        'amount': amount,
+        'currency_id': args.currency_id,
+        'partner_id': form_values['partner_id'],
+        'flow': 'redirect',
+        'tokenization_requested': False,
+        'landing_route': '/payment/confirmation',
+        'is_validation': False,
+        'access_token': form_values['access_token'],
+    })
+    end_stage('transaction')
+
+    qr_url, qr_params = parse_redirect_form(processing_values['redirect_form_html'])
+    qr_page_html = client.get(qr_url, qr_params)
+    listener = None
+    if args.mode == 'push':
+        channel = re.search(r'data-bus-channel="([^"]*)"', qr_page_html)
+        if not channel:
+            raise FlowError("The QR page has no bus channel")
+        listener = BusListener(client, html.unescape(channel[1]), args.websocket_version)
+    end_stage('qr_page')
+
+    try:
+        pay_request = Request(
+            urljoin(args.fake_url, '/fake/pay'),
+            data=json.dumps({
+                'reference': qr_params['reference'], 'delay': args.pay_delay,
+            }).encode(),
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+        )
+        with fake_opener.open(pay_request, timeout=args.timeout) as response:
+            response.read()
+        end_stage('payment')
+
+        if listener:
+            request_count = wait_pushed(client, listener, qr_params, args)
+        else:
+            request_count = wait_polled(client, qr_params, args)
+        end_stage('done')
+    finally:
+        if listener:
+            listener.close()
+
+    durations['total'] = time.monotonic() - start
+    return durations, request_count
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def report(durations_by_stage, request_counts, errors, elapsed, args):
+    succeeded = len(durations_by_stage['total'])
+    print(f"\n{succeeded}/{args.flows} flows succeeded in {elapsed:.1f}s "
+          f"({succeeded / elapsed:.2f} flows/s)")
+    if request_counts:
+        print(f"Requests to Odoo while waiting ({args.mode} mode): {sum(request_counts)} in total, "
+              f"{statistics.fmean(request_counts):.1f} per flow")
+    print(f"{'stage':<14}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+    for stage in STAGES:
+        values = durations_by_stage[stage]
+        if not values:
+            continue
+        print(f"{stage:<14}" + ''.join(f"{value * 1000:>9.0f}" for value in (
+            statistics.fmean(values),
+            percentile(values, 50),
+            percentile(values, 90),
+            percentile(values, 99),
+            max(values),
+        )))
+    if errors:
+        print("\nErrors:")
+        for message, count in sorted(errors.items(), key=lambda item: -item[1]):
+            print(f"{count:>6}  {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--odoo-url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--login', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--fake-url', default='http://localhost:8099')
+    parser.add_argument('--currency-id', type=int, required=True, help="The id of BRL")
+    parser.add_argument(
+        '--amount', type=float, default=100.0, help="Of the first flow, one cent more per flow",
+    )
+    parser.add_argument('--flows', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--mode', choices=('poll', 'push'), default='poll')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help="As the QR page")
+    parser.add_argument(
+        '--fallback-interval', type=float, default=60.0, help="Polling interval in push mode"
+    )
+    parser.add_argument(
+        '--pay-delay', type=float, default=0.0, help="Seconds before each webhook of a payment"
+    )
+    parser.add_argument('--websocket-version', default='17.0-1', help="Of the Odoo bus")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Timeout of each request")
+    parser.add_argument('--flow-timeout', type=float, default=60.0, help="Wait for done at most")
+    args = parser.parse_args()
+
+    durations_by_stage = defaultdict(list)
+    request_counts = []
+    errors = defaultdict(int)
+    results_lock = threading.Lock()
+    local = threading.local()
+
+    def worker(flow_index):
+        if not hasattr(local, 'client'):
+            local.client = OdooClient(args.odoo_url, args.timeout)
+            local.client.authenticate(args.db, args.login, args.password)
+            local.fake_opener = build_opener()
+        try:
+            amount = round(args.amount + flow_index * 0.01, 2)
+            durations, request_count = run_flow(local.client, local.fake_opener, amount, args)
+        except Exception as error:  # Report every failure, whatever its kind
+            with results_lock:
+                errors[f'{type(error).__name__}: {error}'] += 1
+            return
+        with results_lock:
+            for stage, duration in durations.items():
+                durations_by_stage[stage].append(duration)
+            request_counts.append(request_count)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.flows)))
+    report(durations_by_stage, request_counts, errors, time.monotonic() - start, args)
+
+
+if __name__ == '__main__':
+    main()
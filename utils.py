@@ -0,0 +1,767 @@
+import contextlib
+import functools
+import hashlib
+import hmac
+import logging
+import math
+import os
+import pprint
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import requests
+from reportlab.graphics.barcode import createBarcodeDrawing
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from odoo.addons.payment_kamipay import const, metrics
+
+_logger = logging.getLogger(__name__)
+
+# Pooled HTTP sessions, shared by the threads of a worker and keyed by database and provider
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Access tokens cached by this worker, keyed by database and provider
+_tokens = {}
+
+# Locks serializing the computation of a value across the threads of this worker, by key, with
+# the number of threads holding or waiting for them
+_flight_locks = {}
+_flight_locks_lock = threading.Lock()
+
+# The caches of this worker, see `TTLCache`
+_caches = []
+
+# The circuit breakers of this worker, keyed by database and provider, see `CircuitBreaker`
+_circuit_breakers = {}
+
+
+def _reset_process_state():
+    """ Drop the sessions and locks inherited from the parent process after a fork.
+
+    Prefork workers must never share sockets with their parent or siblings, so each child starts
+    with an empty pool and builds its own sessions on first use. Locks are recreated as they may
+    have been held by another thread of the parent at the time of the fork.
+    """
+    global _sessions_lock, _flight_locks_lock
+    _sessions.clear()
+    _sessions_lock = threading.Lock()
+    _flight_locks.clear()
+    _flight_locks_lock = threading.Lock()
+    _circuit_breakers.clear()
+    for cache in _caches:
+        cache._reset()
+
+
+os.register_at_fork(after_in_child=_reset_process_state)
+
+
+@contextlib.contextmanager
+def flight_lock(key):
+    """ Hold the lock ensuring a single thread of this worker computes the value of `key`.
+
+    The lock of a key only exists while threads hold or wait for it, so that the locks of the many
+    short-lived keys (e.g. one per charge) do not pile up in long-lived workers.
+
+    :param key: The hashable key of the computed value
+    """
+    with _flight_locks_lock:
+        entry = _flight_locks.get(key)
+        if entry is None:
+            entry = _flight_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _flight_locks_lock:
+            entry[1] -= 1
+            if not entry[1] and _flight_locks.get(key) is entry:
+                del _flight_locks[key]
+
+
+class TTLCache:
+    """ A cache local to the worker whose entries expire after a delay.
+
+    The cache is safe to share between the threads of a worker, and the concurrent computations
+    of a missing entry through `get_or_compute` are coalesced into a single one.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, name, ttl, max_size=None):
+        """
+        :param str name: The name of the cache, unique within the worker
+        :param float ttl: The default lifetime of the entries, in seconds
+        :param int max_size: The maximum number of entries, if bounded
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def _reset(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the value of the key if cached and not expired, or `default`. """
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """ Cache the value of the key for `ttl` seconds (the cache's lifetime by default). """
+        expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if self.max_size and key not in self._data and len(self._data) >= self.max_size:
+                self._evict()
+            self._data[key] = (value, expiry)
+
+    def pop(self, key):
+        """ Remove the key from the cache. """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Remove all the entries of the cache. """
+        with self._lock:
+            self._data = {}
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """ Return the cached value of the key, or compute and cache it.
+
+        A single thread of the worker computes a missing value; the others wait for its result.
+
+        :param key: The hashable key of the value
+        :param callable compute: The function returning the value, called without argument
+        :param ttl: The lifetime of the computed value, in seconds, or a function returning it from
+                    the value
+        :return: The value
+        """
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            with flight_lock((self.name, key)):
+                value = self.get(key, self._MISSING)  # Another thread may have computed it
+                if value is self._MISSING:
+                    value = compute()
+                    self.set(key, value, ttl(value) if callable(ttl) else ttl)
+        return value
+
+    def _evict(self):
+        """ Remove the expired entries or, if there are none, the oldest one. Lock is held. """
+        now = time.monotonic()
+        expired_keys = [key for key, (_value, expiry) in self._data.items() if expiry <= now]
+        for key in expired_keys or [next(iter(self._data))]:
+            del self._data[key]
+
+
+# The webhook signature keys of the enabled providers, by database
+signature_keys_cache = TTLCache('signature_keys', ttl=const.SIGNATURE_KEYS_TTL)
+
+# The latest BRL/USDT quotes, by database and provider
+quote_cache = TTLCache('quotes', ttl=const.QUOTE_TTL)
+
+# The status responses of the charges, by database, provider and operation id
+status_cache = TTLCache('statuses', ttl=const.STATUS_CACHE_TTL, max_size=const.STATUS_CACHE_SIZE)
+
+# The states served to the polling payment pages, by database and transaction id
+poll_state_cache = TTLCache(
+    'poll_states', ttl=const.POLL_STATE_TTL, max_size=const.POLL_STATE_CACHE_SIZE
+)
+
+
+def get_status_ttl(status_response):
+    """ Return how long a status response of KamiPay can be reused, in seconds.
+
+    :param dict status_response: The content of the status response
+    :return: The lifetime of the response
+    :rtype: float
+    """
+    status_response = status_response or {}
+    status_data = status_response.get('data') or {}
+    if status_response.get('status') == 'ok' and status_data.get('status') in const.STATUS_FINAL:
+        return math.inf
+    return const.STATUS_CACHE_TTL
+
+
+class RateLimiter:
+    """ Token buckets local to the worker, keyed by client or resource.
+
+    Each worker enforces the limits on its own share of the traffic; see
+    `payment.kamipay.rate.limit` for buckets shared through the database.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param int max_size: The maximum number of buckets; the least recently used are dropped
+        """
+        self.max_size = max_size
+        self._buckets = {}
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def _reset(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        """ Take a token from the bucket of the key.
+
+        :param key: The hashable key of the bucket
+        :param float rate: The number of tokens added to the bucket per second
+        :param int burst: The capacity of the bucket
+        :return: Whether a token was available
+        :rtype: bool
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if len(self._buckets) >= self.max_size:
+                del self._buckets[next(iter(self._buckets))]
+            self._buckets[key] = (tokens, now)  # Reinserted last, as the most recently used
+        return allowed
+
+
+rate_limiter = RateLimiter(max_size=const.RATE_LIMIT_CACHE_SIZE)
+
+
+def get_rate_limit(env, scope):
+    """ Return the limit of the given scope, overridden by its system parameter if set.
+
+    :param odoo.api.Environment env: The environment used to read the configuration
+    :param str scope: The scope of the limit, e.g. 'ip' or 'tx'
+    :return: The tokens added per second and the capacity of the buckets
+    :rtype: tuple
+    """
+    default = const.RATE_LIMITS[scope]
+    value = env['ir.config_parameter'].sudo().get_param(const.RATE_LIMIT_PARAM % scope)
+    if not value:
+        return default
+    try:
+        rate, burst = (float(part) for part in value.split(','))
+    except ValueError:
+        _logger.warning("Invalid rate limit %r for scope %s, using the default", value, scope)
+        return default
+    return rate, int(burst)
+
+
+def check_rate_limit(env, scope, key):
+    """ Take a token from the bucket of the key in the given scope, see `get_rate_limit`.
+
+    :param odoo.api.Environment env: The environment used to read the configuration
+    :param str scope: The scope of the limit, e.g. 'ip' or 'tx'
+    :param key: The client or resource limited within the scope
+    :return: Whether the request is allowed
+    :rtype: bool
+    """
+    rate, burst = get_rate_limit(env, scope)
+    bucket_key = f'{scope}:{key}'
+    if env['ir.config_parameter'].sudo().get_param(const.RATE_LIMIT_BACKEND_PARAM) == 'db':
+        allowed = env['payment.kamipay.rate.limit'].sudo()._consume(bucket_key, rate, burst)
+    else:
+        allowed = rate_limiter.consume((env.cr.dbname, bucket_key), rate, burst)
+    if not allowed:
+        metrics.inc('kamipay_rate_limited_total', scope=scope)
+    return allowed
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """ Raised instead of sending a request to an API whose circuit is open. """
+
+
+class CircuitBreaker:
+    """ Stop sending requests to an API that keeps failing, for the threads of a worker.
+
+    The circuit opens after `failure_threshold` consecutive failures; requests then fail right
+    away instead of waiting for their timeout. After `open_interval` seconds, the circuit is
+    half-open: a single probe request is let through, whose outcome closes or reopens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold, open_interval):
+        """
+        :param str name: The name of the circuit, e.g. the provider name
+        :param int failure_threshold: The number of consecutive failures opening the circuit
+        :param float open_interval: The number of seconds before probing an open circuit
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_interval = open_interval
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ The state of the circuit, without letting any probe through. """
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._probing or time.monotonic() - self._opened_at >= self.open_interval:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """ Return whether a request may be sent, and reserve the probe of a half-open circuit.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.open_interval:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                _logger.info("KamiPay: API %s recovered, closing the circuit", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (
+                self._opened_at is None and self._failures >= self.failure_threshold
+            ):
+                _logger.warning(
+                    "KamiPay: API %s failed %d times in a row, opening the circuit for %ss",
+                    self.name, self._failures, self.open_interval,
+                )
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        """ Send the request of the block through the circuit.
+
+        Timeouts, connection errors and server errors count as failures; client errors show that
+        the API is up and count as successes.
+
+        :raise CircuitOpenError: If the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"The circuit of the KamiPay API {self.name} is open")
+        try:
+            yield
+        except requests.exceptions.HTTPError as error:
+            if error.response is not None and error.response.status_code < 500:
+                self.record_success()
+            else:
+                self.record_failure()
+            raise
+        except BaseException:
+            self.record_failure()
+            raise
+        else:
+            self.record_success()
+
+
+def get_circuit_breaker(key, name):
+    """ Return the circuit breaker of this worker for the given key, creating it if needed.
+
+    :param key: The key of the circuit, e.g. the database and provider
+    :param str name: The name of the circuit, used in the logs
+    :return: The circuit breaker
+    :rtype: CircuitBreaker
+    """
+    breaker = _circuit_breakers.get(key)
+    if breaker is None:
+        breaker = _circuit_breakers.setdefault(key, CircuitBreaker(
+            name, const.CIRCUIT_FAILURE_THRESHOLD, const.CIRCUIT_OPEN_INTERVAL
+        ))
+    return breaker
+
+
+def get_circuit_states():
+    """ Return the state of the circuit breakers of this worker, by key.
+
+    :rtype: dict
+    """
+    return {host: breaker.state for host, breaker in list(_circuit_breakers.items())}
+
+
+class EndpointRetry(Retry):
+    """ Retry policy that never retries the endpoints having their own time budget.
+
+    The timeout of those endpoints (see `const.ENDPOINT_TIMEOUTS`) bounds the whole call: retrying
+    would multiply it by the number of attempts. Their callers retry on their own schedule instead.
+    """
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        if url and urlsplit(url).path in const.ENDPOINT_TIMEOUTS:
+            if error is not None and self._is_read_error(error):
+                # Raise the read error as such, as urllib3 does when read retries are exhausted
+                raise error.with_traceback(_stacktrace)
+            cause = error or ResponseError(f"{response.status} error response")
+            raise MaxRetryError(_pool, url, cause) from error
+        return super().increment(
+            method=method, url=url, response=response, error=error, _pool=_pool,
+            _stacktrace=_stacktrace,
+        )
+
+
+def _build_session(pool_size, max_retries, retry_backoff):
+    """ Build a session whose connections are pooled and kept alive between requests.
+
+    Only idempotent requests are retried on server errors; connection errors are retried for all
+    methods since the request never reached the server. The endpoints having their own time budget
+    are never retried, see `EndpointRetry`.
+
+    :param int pool_size: The maximum number of connections kept open per host
+    :param int max_retries: The maximum number of retries of a failed request
+    :param float retry_backoff: The backoff factor applied between retries
+    :return: The configured session
+    :rtype: requests.Session
+    """
+    retry = EndpointRetry(
+        total=max_retries,
+        backoff_factor=retry_backoff,
+        status_forcelist=const.RETRY_STATUSES,
+        allowed_methods=frozenset({'GET'}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def get_session(key, pool_size, keepalive, max_retries, retry_backoff):
+    """ Return the pooled session of this worker for the given key, building it if needed.
+
+    A session that stayed idle for longer than `keepalive` seconds is replaced, as the server has
+    most likely closed its connections in the meantime. A session whose settings changed is
+    replaced as well.
+
+    :param key: The key of the session, e.g. the provider environment
+    :param int pool_size: The maximum number of connections kept open per host
+    :param int keepalive: The number of seconds a session may stay idle
+    :param int max_retries: The maximum number of retries of a failed request
+    :param float retry_backoff: The backoff factor applied between retries
+    :return: The pooled session
+    :rtype: requests.Session
+    """
+    settings = (pool_size, max_retries, retry_backoff)
+    now = time.monotonic()
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry is None or entry['settings'] != settings or now - entry['last_used'] > keepalive:
+            # In-flight requests on a replaced session complete normally; it is then collected
+            entry = _sessions[key] = {
+                'session': _build_session(pool_size, max_retries, retry_backoff),
+                'settings': settings,
+                'created': now,
+            }
+        entry['last_used'] = now
+        return entry['session']
+
+
+def send_request(
+    session, method, url, headers, query_params=None, payload=None, circuit_breaker=None
+):
+    """ Send a request to KamiPay API and return its JSON content.
+
+    This function does not use the ORM and can safely be called from any thread.
+
+    :param requests.Session session: The pooled session to send the request with
+    :param str method: The HTTP method of the request
+    :param str url: The URL of the request
+    :param dict headers: The headers of the request
+    :param dict query_params: The query parameters of GET requests
+    :param dict payload: The JSON payload of POST requests
+    :param CircuitBreaker circuit_breaker: The circuit breaker of the API, if any
+    :return: The JSON content of the response
+    :rtype: dict
+    :raise requests.exceptions.RequestException: If the request fails
+    :raise CircuitOpenError: If the API kept failing and the request was not sent
+    """
+    endpoint = urlsplit(url).path
+    timeout = const.ENDPOINT_TIMEOUTS.get(endpoint, const.DEFAULT_TIMEOUT)
+    try:
+        guard = circuit_breaker.guard() if circuit_breaker else contextlib.nullcontext()
+        with guard, metrics.track(
+            'kamipay_api_request_duration_seconds', endpoint=endpoint
+        ):
+            if method == 'GET':
+                response = session.get(url, params=query_params, headers=headers, timeout=timeout)
+            else:
+                response = session.post(url, json=payload, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            response_content = response.json()
+    except CircuitOpenError:
+        metrics.inc('kamipay_api_requests_total', endpoint=endpoint, outcome='rejected')
+        raise
+    except requests.exceptions.RequestException as error:
+        metrics.inc('kamipay_api_requests_total', endpoint=endpoint, outcome='error')
+        metrics.inc('kamipay_api_errors_total', endpoint=endpoint, kind=get_error_kind(error))
+        raise
+    metrics.inc('kamipay_api_requests_total', endpoint=endpoint, outcome='ok')
+    return response_content
+
+
+def get_error_kind(error):
+    """ Return the kind of a request error, as reported in the metrics.
+
+    :param requests.exceptions.RequestException error: The request error
+    :return: 'circuit_open', 'timeout', 'connection', 'http' or 'other'
+    :rtype: str
+    """
+    if isinstance(error, CircuitOpenError):
+        return 'circuit_open'
+    if isinstance(error, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return 'connection'
+    if isinstance(error, requests.exceptions.HTTPError):
+        return 'http'
+    return 'other'
+
+
+def get_session_stats():
+    """ Return the connection reuse statistics of the pooled sessions of this worker.
+
+    Each opened connection costs a TCP and TLS handshake; when pooling works, the number of
+    requests grows while the number of connections stays close to the pool size.
+
+    :return: The number of opened connections and sent requests, by session key
+    :rtype: dict
+    """
+    with _sessions_lock:
+        entries = list(_sessions.items())
+    stats = {}
+    for key, entry in entries:
+        connections = sent_requests = 0
+        for adapter in set(entry['session'].adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    sent_requests += pool.num_requests
+        stats[key] = {
+            'connections': connections,
+            'requests': sent_requests,
+            'reuse_ratio': 1 - connections / sent_requests if sent_requests else 0.0,
+        }
+    return stats
+
+
+def get_cached_token(key, stored_token, cached_after=None):
+    """ Return the cached access token of the given key if it does not expire soon.
+
+    The cached token is only returned while it is the token stored in the database, so that the
+    tokens cleared or replaced by another worker are no longer used. A token cached after
+    `cached_after` was just refreshed by another thread, and is returned even if the database
+    snapshot of the caller still holds the previous one.
+
+    :param key: The cache key, i.e. the database name and provider id
+    :param str stored_token: The access token currently stored on the provider
+    :param float cached_after: The monotonic time after which a cached token is trusted, if any
+    :return: The access token, or None if it is missing or must be refreshed
+    :rtype: str
+    """
+    entry = _tokens.get(key)
+    if entry is None:
+        return None
+    token, expiry, cached_at = entry
+    if token != stored_token and (cached_after is None or cached_at < cached_after):
+        return None
+    if expiry - timedelta(seconds=const.TOKEN_REFRESH_MARGIN) <= datetime.utcnow():
+        return None
+    return token
+
+
+def set_cached_token(key, token, expiry):
+    """ Cache the access token of the given key until its expiry date.
+
+    :param key: The cache key, i.e. the database name and provider id
+    :param str token: The access token
+    :param datetime expiry: The naive UTC expiry date of the token
+    :return: None
+    """
+    _tokens[key] = (token, expiry, time.monotonic())
+
+
+def invalidate_token(key):
+    """ Remove the access token of the given key from the cache.
+
+    :param key: The cache key, i.e. the database name and provider id
+    :return: None
+    """
+    _tokens.pop(key, None)
+
+
+@functools.lru_cache(maxsize=const.QR_CACHE_SIZE)
+def get_qr_image(emv, image_format='png'):
+    """ Return the QR code image of an EMV payload, generating it only once per worker.
+
+    :param str emv: The EMV payload of the PIX charge
+    :param str image_format: The format of the image, 'png' or 'svg'
+    :return: The image content
+    :rtype: bytes
+    """
+    drawing = createBarcodeDrawing(
+        'QR', value=emv, width=const.QR_SIZE, height=const.QR_SIZE, humanReadable=0
+    )
+    image = drawing.asString(image_format)
+    return image.encode() if isinstance(image, str) else image
+
+
+def get_qr_inline_svg(emv):
+    """ Return the QR code of an EMV payload as an SVG element to embed in an HTML page.
+
+    :param str emv: The EMV payload of the PIX charge
+    :return: The SVG element, without the XML prolog
+    :rtype: str
+    """
+    svg = get_qr_image(emv, 'svg').decode()
+    return svg[svg.find('<svg'):]
+
+
+def get_qr_etag(emv, image_format):
+    """ Return the strong ETag of the QR code image of an EMV payload.
+
+    :param str emv: The EMV payload of the PIX charge
+    :param str image_format: The format of the image, 'png' or 'svg'
+    :return: The unquoted ETag
+    :rtype: str
+    """
+    return hashlib.sha256(f'{image_format}:{emv}'.encode()).hexdigest()[:32]
+
+
+def redact(value):
+    """ Return a copy of a payload where the values of sensitive keys are masked.
+
+    :param value: The payload, or any value nested in it
+    :return: The redacted copy
+    """
+    if isinstance(value, dict):
+        return {
+            key: '***' if str(key).lower() in const.SENSITIVE_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class LazyPayload:
+    """ A log argument rendering a redacted payload only if the log record is emitted. """
+
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        return pprint.pformat(redact(self.payload))
+
+
+def get_payload_sample_rate(env):
+    """ Return the share of operations whose full payload is logged at INFO level.
+
+    :param odoo.api.Environment env: The environment used to read the configuration
+    :return: The sample rate, between 0 and 1
+    :rtype: float
+    """
+    value = env['ir.config_parameter'].sudo().get_param(const.LOG_SAMPLE_RATE_PARAM)
+    try:
+        return min(max(float(value or 0.0), 0.0), 1.0)
+    except ValueError:
+        return 0.0
+
+
+def log_payload(logger, label, payload, sample_rate=0.0):
+    """ Log a redacted dump of a payload, in full at DEBUG level and sampled at INFO level.
+
+    :param logging.Logger logger: The logger to log with
+    :param str label: The description of the payload
+    :param payload: The payload to dump
+    :param float sample_rate: The share of payloads dumped when DEBUG level is disabled
+    :return: None
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("kamipay payload %s:\n%s", label, LazyPayload(payload))
+    elif sample_rate and random.random() < sample_rate and logger.isEnabledFor(logging.INFO):
+        logger.info("kamipay payload %s (sampled):\n%s", label, LazyPayload(payload))
+
+
+@contextlib.contextmanager
+def log_operation(logger, operation, **fields):
+    """ Log a single compact record with the outcome and duration of the wrapped operation.
+
+    The yielded dict can be completed with fields known only during the operation. The record is
+    logged at INFO level, or WARNING level if the operation raised or an `error` field was set.
+
+    :param logging.Logger logger: The logger to log with
+    :param str operation: The name of the operation, e.g. 'webhook'
+    :param dict fields: The fields to log along with the operation
+    :return: The fields of the record
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield fields
+    except Exception as error:
+        outcome = 'error'
+        fields.setdefault('error', type(error).__name__)
+        raise
+    finally:
+        if 'error' in fields:
+            outcome = 'error'
+        level = logging.WARNING if outcome == 'error' else logging.INFO
+        if logger.isEnabledFor(level):
+            fields['outcome'] = outcome
+            logger.log(
+                level,
+                "kamipay op=%s %s duration_ms=%.1f",
+                operation,
+                ' '.join(f'{key}={value}' for key, value in fields.items()),
+                (time.perf_counter() - start) * 1000,
+            )
+
+
+def find_signing_key(signature_keys, raw_body, signature):
+    """ Return the id of the provider whose key produced the signature of a webhook.
+
+    The signature is the hex HMAC-SHA256 digest of the raw body. Digests are compared in constant
+    time.
+
+    :param list signature_keys: The providers signature keys, as (provider id, key, is test) tuples
+    :param bytes raw_body: The raw body of the webhook request
+    :param str signature: The signature sent with the webhook
+    :return: The provider id, or None if no key matches
+    :rtype: int
+    """
+    signature = signature.encode()
+    for provider_id, key, _is_test in signature_keys:
+        digest = hmac.new(key, raw_body, hashlib.sha256).hexdigest().encode()
+        if hmac.compare_digest(digest, signature):
+            return provider_id
+    return None
@@ -0,0 +1,2 @@
+from . import payment_kamipay_charge_wizard
+from . import payment_kamipay_reconciliation_wizard
@@ -0,0 +1,44 @@
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+
+from odoo.addons.payment_kamipay import const
+
+
+class PaymentKamipayChargeWizard(models.TransientModel):
+    _name = 'payment.kamipay.charge.wizard'
+    _description = "KamiPay Charge Creation"
+
+    transaction_ids = fields.Many2many(
+        string="Transactions", comodel_name='payment.transaction',
+        default=lambda self: self.env.context.get('active_ids'),
+    )
+    transaction_count = fields.Integer(
+        string="Number of Transactions", compute='_compute_transaction_count'
+    )
+    charge_lifetime = fields.Integer(
+        string="Charge Lifetime",
+        help="The number of hours during which the customers can pay the charges.",
+        default=const.CAMPAIGN_CHARGE_LIFETIME,
+        required=True,
+    )
+
+    @api.depends('transaction_ids')
+    def _compute_transaction_count(self):
+        for wizard in self:
+            wizard.transaction_count = len(wizard.transaction_ids)
+
+    @api.constrains('charge_lifetime')
+    def _check_charge_lifetime(self):
+        for wizard in self:
+            if not 1 <= wizard.charge_lifetime <= const.CAMPAIGN_CHARGE_MAX_LIFETIME:
+                raise ValidationError(_(
+                    "The charge lifetime must be between 1 and %s hours.",
+                    const.CAMPAIGN_CHARGE_MAX_LIFETIME,
+                ))
+
+    def action_create_charges(self):
+        """ Create the KamiPay charges of the transactions, valid for the chosen lifetime. """
+        self.ensure_one()
+        return self.transaction_ids.action_kamipay_create_charges(
+            expiry=self.charge_lifetime * 3600
+        )
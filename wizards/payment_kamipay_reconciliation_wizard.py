@@ -0,0 +1,233 @@
+import base64
+import csv
+import io
+import json
+import logging
+
+from odoo import _, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import float_compare, split_every
+
+from odoo.addons.payment_kamipay import const
+
+_logger = logging.getLogger(__name__)
+
+# Accepted column names of the statement exports, by field
+COLUMN_ALIASES = {
+    'operation_id': ('operation_id', 'pix_id'),
+    'reference': ('external_reference', 'reference'),
+    'status': ('status',),
+    'amount_brl': ('amount_brl', 'amount'),
+    'amount_usdt': ('amount_usdt',),
+    'rate': ('rate',),
+    'bank_txid': ('bank_txid',),
+}
+
+
+def _to_float(value):
+    """ Return the number of a statement cell, or None if it is empty or invalid. """
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+class PaymentKamipayReconciliationWizard(models.TransientModel):
+    _name = 'payment.kamipay.reconciliation.wizard'
+    _description = "KamiPay Statement Reconciliation"
+
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', required=True,
+        domain=[('code', '=', 'kamipay')],
+    )
+    statement_file = fields.Binary(string="Statement", required=True, attachment=False)
+    statement_filename = fields.Char(string="File Name")
+    state = fields.Selection(
+        selection=[('draft', "Draft"), ('done', "Done")], default='draft', readonly=True
+    )
+    row_count = fields.Integer(string="Rows", readonly=True)
+    matched_count = fields.Integer(string="Matched", readonly=True)
+    updated_count = fields.Integer(string="Updated", readonly=True)
+    mismatch_ids = fields.One2many(
+        string="Mismatches", comodel_name='payment.kamipay.reconciliation.mismatch',
+        inverse_name='wizard_id', readonly=True,
+    )
+
+    def action_import(self):
+        """ Reconcile the transactions of the provider with the uploaded statement.
+
+        The rows are read one by one and processed by batches: the transactions of a batch are
+        fetched with a single query and indexed by operation ID and reference, then the statuses
+        that make them progress are applied through the notification processing path.
+        """
+        self.ensure_one()
+        counts = {'rows': 0, 'matched': 0, 'updated': 0}
+        mismatch_values = []
+        for rows in split_every(const.RECONCILIATION_BATCH_SIZE, self._read_statement()):
+            self._reconcile_rows(rows, counts, mismatch_values)
+        self.env['payment.kamipay.reconciliation.mismatch'].create(mismatch_values)
+        self.write({
+            'state': 'done',
+            'row_count': counts['rows'],
+            'matched_count': counts['matched'],
+            'updated_count': counts['updated'],
+        })
+        _logger.info(
+            "KamiPay: Reconciled %(rows)d statement rows (%(matched)d matched, %(updated)d "
+            "updated)", counts,
+        )
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def _read_statement(self):
+        """ Yield the rows of the statement, normalized, without loading them all at once.
+
+        Statements are CSV files with a header, or JSON lines files.
+
+        :return: The rows, as dicts with the keys of `COLUMN_ALIASES`
+        :rtype: iterator
+        """
+        self.ensure_one()
+        content = io.TextIOWrapper(
+            io.BytesIO(base64.b64decode(self.statement_file)), encoding='utf-8-sig'
+        )
+        filename = (self.statement_filename or '').lower()
+        if filename.endswith(('.jsonl', '.ndjson', '.json')):
+            raw_rows = (json.loads(line) for line in content if line.strip())
+        else:
+            raw_rows = csv.DictReader(content)
+        try:
+            for raw_row in raw_rows:
+                yield {
+                    key: next((raw_row[alias] for alias in aliases if raw_row.get(alias)), None)
+                    for key, aliases in COLUMN_ALIASES.items()
+                }
+        except (ValueError, csv.Error) as error:
+            raise UserError(_("The statement could not be read: %s", error))
+
+    def _reconcile_rows(self, rows, counts, mismatch_values):
+        """ Match a batch of statement rows with their transactions and apply their statuses.
+
+        :param list rows: The normalized statement rows
+        :param dict counts: The counters of the import, updated in place
+        :param list mismatch_values: The values of the mismatches found, extended in place
+        :return: None
+        """
+        operation_ids = [row['operation_id'] for row in rows if row['operation_id']]
+        references = [row['reference'] for row in rows if row['reference']]
+        txs = self.env['payment.transaction'].search([
+            ('provider_id', '=', self.provider_id.id),
+            '|', ('kamipay_operation_id', 'in', operation_ids), ('reference', 'in', references),
+        ])
+        txs_by_operation_id = {tx.kamipay_operation_id: tx for tx in txs if tx.kamipay_operation_id}
+        txs_by_reference = {tx.reference: tx for tx in txs}
+
+        for row in rows:
+            counts['rows'] += 1
+            tx = txs_by_operation_id.get(row['operation_id']) or txs_by_reference.get(
+                row['reference']
+            )
+            if not tx:
+                mismatch_values.append(self._prepare_mismatch_values(row, 'missing'))
+                continue
+            counts['matched'] += 1
+
+            status = row['status']
+            if (
+                row['operation_id']
+                and status in const.STATUS_HANDLED
+                and not tx._kamipay_is_status_regression(status)
+            ):
+                try:
+                    with self.env.cr.savepoint():
+                        if not tx.kamipay_operation_id:  # The charge response was lost
+                            tx.kamipay_operation_id = row['operation_id']
+                        tx._handle_notification_data(
+                            'kamipay', self._prepare_notification_data(row, tx)
+                        )
+                    counts['updated'] += 1
+                except Exception as error:
+                    _logger.warning(
+                        "KamiPay: Could not apply the statement status of tx %s: %s",
+                        tx.reference, error,
+                    )
+            mismatch_values.extend(self._check_row(row, tx))
+
+    def _prepare_notification_data(self, row, tx):
+        """ Convert a statement row into notification data, as sent by KamiPay webhooks. """
+        return {
+            'pix_id': row['operation_id'],
+            'status': row['status'],
+            'external_reference': tx.reference,
+            'data': {
+                'bank_txid': row['bank_txid'],
+                'amount_brl': row['amount_brl'],
+                'amount_usdt': row['amount_usdt'],
+            },
+        }
+
+    def _check_row(self, row, tx):
+        """ Return the values of the mismatches between a statement row and its transaction. """
+        mismatches = []
+        amount = _to_float(row['amount_brl'])
+        if amount is not None and tx.currency_id.compare_amounts(amount, tx.amount):
+            mismatches.append(self._prepare_mismatch_values(
+                row, 'amount', tx, expected=tx.amount, found=row['amount_brl']
+            ))
+        rate = _to_float(row['rate'])
+        if rate is not None and tx.kamipay_rate and float_compare(
+            rate, tx.kamipay_rate, precision_digits=6
+        ):
+            mismatches.append(self._prepare_mismatch_values(
+                row, 'rate', tx, expected=tx.kamipay_rate, found=row['rate']
+            ))
+        status = row['status']
+        if status in const.STATUS_FINAL and (
+            status != tx.kamipay_status if tx.kamipay_status
+            # Processed before the status was recorded on the transaction, compare its state
+            else const.STATUS_TX_STATES[status] != tx.state
+        ):
+            mismatches.append(self._prepare_mismatch_values(
+                row, 'status', tx, expected=tx.kamipay_status or tx.state, found=status
+            ))
+        return mismatches
+
+    def _prepare_mismatch_values(self, row, kind, tx=None, expected=None, found=None):
+        return {
+            'wizard_id': self.id,
+            'kind': kind,
+            'transaction_id': tx and tx.id,
+            'operation_id': row['operation_id'],
+            'reference': row['reference'],
+            'expected': expected is not None and str(expected) or False,
+            'found': found is not None and str(found) or False,
+        }
+
+
+class PaymentKamipayReconciliationMismatch(models.TransientModel):
+    _name = 'payment.kamipay.reconciliation.mismatch'
+    _description = "KamiPay Statement Mismatch"
+
+    wizard_id = fields.Many2one(
+        comodel_name='payment.kamipay.reconciliation.wizard', required=True, ondelete='cascade'
+    )
+    kind = fields.Selection(
+        string="Mismatch",
+        selection=[
+            ('missing', "Unknown Operation"),
+            ('amount', "Amount"),
+            ('rate', "Rate"),
+            ('status', "Status"),
+        ],
+        required=True,
+    )
+    transaction_id = fields.Many2one(string="Transaction", comodel_name='payment.transaction')
+    operation_id = fields.Char(string="Operation ID")
+    reference = fields.Char(string="Reference")
+    expected = fields.Char(string="In Odoo")
+    found = fields.Char(string="In Statement")